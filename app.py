@@ -1,48 +1,316 @@
-from flask import Flask, render_template, request, Response
+from flask import Flask, render_template, request, Response, stream_with_context
 from flask.json import jsonify
-import json
-import sqlite3
+import functools
+import heapq
+import itertools
+import queue
 import time
-import statistics
+from urllib.parse import urlencode
+
 import numpy as np
 
+from cache import get_hot_tier, get_result_cache, result_cache_metrics
+from db import (DEVICES_CHUNK_SIZE, INSERT_READING, MAX_READING_COLUMNS, MIN_READING_COLUMNS, READING_COLUMNS,
+                database_path, database_paths, fan_out, format_cursor, get_db, get_shard_db, init_app,
+                parse_cursor, request_devices_query, request_page_query, request_query, request_series_query,
+                write_watermark)
+from formats import COLUMN_ENCODERS, JSON_MIMETYPE, STREAM_ENCODERS, iter_batches, iter_row_batches
+from ingest import (BULK_CHUNK_SIZE, BULK_MAX_ERRORS, VALID_TYPES, batch_results, get_writer, iter_ndjson_chunks,
+                    parse_readings_body, validate_bulk_readings, validate_readings)
+from metrics import instrument_app, record_error, register_collector
+from parallel import parallel_fleet_histograms
+from rollups import (FLEET_DEFAULT_K, FLEET_METRICS, fleet_histograms, fleet_top, find_reading,
+                     merge_fleet_histograms, merge_fleet_top, rollup_plan, window_aggregate, window_histogram)
+from segments import scan, scan_devices
+from stats import (HISTOGRAM_BINS, SERIES_AGGREGATES, STATS_METRICS, SUMMARY_COLUMNS, bucket_series, histogram_mode,
+                   histogram_quantile, histogram_stats, lttb, summary_columns)
+
 app = Flask(__name__)
 
-# Setup the SQLite DB
-conn = sqlite3.connect('database.db')
-conn.execute(
-    'CREATE TABLE IF NOT EXISTS readings (device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)')
-conn.close()
-
-# Function for DB queries
-def request_query(device_uuid, sensor_type, start_time, end_time):
-    # db query
-    query = 'select * from readings where device_uuid="' + device_uuid + '"'.format(device_uuid)
-    if sensor_type is not None:
-        query += ' and type = "' + sensor_type + '"'
-    if start_time is not None:
-        query += ' and date_created >= "' + start_time + '"'
-    if end_time is not None:
-        query += ' and date_created <= "' + end_time + '"'
-    return query
-
-def request_summary_query(sensor_type, start_time, end_time):
-    # db query to get the summary
-    query = 'select device_uuid, value from readings'
-    if sensor_type is None and start_time is None and end_time is None:
-        return query
-    query += ' where'
-    if sensor_type is not None:
-        query += ' type = "' + sensor_type + '" and'
-    if start_time is not None:
-        query += ' date_created >= "' + start_time + '" and'
-    if end_time is not None:
-        query += ' date_created <= "' + end_time + '" and'
-    query = query[: len(query) - 4]
-    return query    
+# Write-behind ingest, off by default. Readings posted to a device are queued
+# and group committed by a background writer, acked after the commit or, with
+# durability 'enqueue', as soon as they are queued.
+app.config.from_mapping(
+    WRITE_BEHIND=False,
+    WRITE_BEHIND_MAX_ROWS=5000,
+    WRITE_BEHIND_FLUSH_INTERVAL=0.05,
+    # Rows waiting for the writer before new posts get a 429
+    WRITE_BEHIND_QUEUE_SIZE=10000,
+    WRITE_BEHIND_DURABILITY='commit'
+)
+
+# In-memory hot tier, off by default. Ring buffers of the latest readings per
+# device and type serve recent windows without touching the db. The tier only
+# sees this process's writes, so enable it where one process owns ingest.
+app.config.from_mapping(
+    HOT_TIER=False,
+    HOT_TIER_CAPACITY=1024,
+    HOT_TIER_HORIZON=3600,
+    HOT_TIER_BUDGET=64 * 1024 * 1024
+)
+
+# Result cache of the statistics endpoints, off while the size is 0. Results
+# are dropped when this process commits a reading inside their window and
+# otherwise live for RESULT_CACHE_TTL seconds.
+app.config.from_mapping(
+    RESULT_CACHE_SIZE=0,
+    RESULT_CACHE_TTL=60
+)
+
+# Summary computed by a pool of this many worker processes, off while 0.
+# Every worker reads a range of devices on a read-only connection.
+app.config.from_mapping(
+    SUMMARY_PROCESSES=0
+)
+
+# Setup the SQLite DB, connections are pooled and migrated when first opened
+init_app(app)
+
+# Time every request and serve the timings at /metrics
+instrument_app(app)
+register_collector(lambda: result_cache_metrics(app))
+
+
+def server_error(error):
+    """Log and count an exception a handler could not deal with, and answer 500."""
+    app.logger.exception('Request failed')
+    record_error(error)
+    return 'Server Error', 500
+
+
+def readings_committed(cur, rows):
+    """Update the in-memory tiers with rows just committed to the db."""
+    if app.config['RESULT_CACHE_SIZE']:
+        get_result_cache(app).invalidate(rows)
+    if app.config['HOT_TIER']:
+        tier = get_hot_tier(app, create=False)
+        if tier is not None:
+            tier.add(cur, rows)
+        else:
+            # Warming the tier reads the new rows along with the rest
+            get_hot_tier(app)
+
+
+def request_window():
+    """
+    The start and end query parameters as epoch integers, either None.
+
+    Raises ValueError when one is not an integer.
+    """
+    return tuple(None if request.args.get(arg) is None else int(request.args.get(arg)) for arg in ('start', 'end'))
+
+
+def readings_args():
+    """
+    The type, start, end, limit, after and max_points query parameters of
+    GET readings, the last three None when not given.
+
+    Raises ValueError when one is malformed or they do not go together.
+    """
+    sensor_type = request.args.get('type')
+    limit = request.args.get('limit')
+    after = request.args.get('after')
+    max_points = request.args.get('max_points')
+    start_time, end_time = request_window()
+    limit = int(limit) if limit is not None else None
+    after = parse_cursor(after) if after is not None else None
+    max_points = int(max_points) if max_points is not None else None
+    if limit is not None and limit < 1:
+        raise ValueError('invalid limit')
+    if max_points is not None and (max_points < 3 or sensor_type is None or limit is not None or after is not None):
+        raise ValueError('invalid max_points')
+    return sensor_type, start_time, end_time, limit, after, max_points
+
+
+def metric_args():
+    """
+    The mandatory type and the start and end query parameters of a
+    per-device metric.
+
+    Raises ValueError when type is missing or the window is malformed.
+    """
+    sensor_type = request.args.get('type')
+    if sensor_type is None:
+        raise ValueError('missing type')
+    return (sensor_type,) + request_window()
+
+
+def quartiles_args():
+    """The type, start and end of the quartiles, all three mandatory. Raises ValueError."""
+    sensor_type, start_time, end_time = metric_args()
+    if start_time is None or end_time is None:
+        raise ValueError('missing start or end')
+    return sensor_type, start_time, end_time
+
+
+def stats_args():
+    """The type, start and end of the stats and the metrics asked for. Raises ValueError."""
+    metrics = request.args.get('metrics')
+    metrics = STATS_METRICS if metrics is None else [metric.strip() for metric in metrics.split(',')]
+    if not metrics or any(metric not in STATS_METRICS for metric in metrics):
+        raise ValueError('invalid metrics')
+    return metric_args() + (metrics,)
+
+
+def series_args():
+    """The type, start and end of a series, its aggregates and bucket interval. Raises ValueError."""
+    aggregates = request.args.get('agg')
+    aggregates = SERIES_AGGREGATES if aggregates is None else [agg.strip() for agg in aggregates.split(',')]
+    if not aggregates or any(aggregate not in SERIES_AGGREGATES for aggregate in aggregates):
+        raise ValueError('invalid agg')
+    interval = int(request.args.get('interval', ''))
+    if interval < 1:
+        raise ValueError('invalid interval')
+    return metric_args() + (aggregates, interval)
+
+
+def cached_result(view):
+    """
+    Serve a per-device statistics endpoint from the result cache.
+
+    Results are keyed on the endpoint, its other arguments and the Accept
+    header, the device, type and start/end window. Only 200 responses are cached; the X-Cache
+    header tells hits from misses.
+    """
+    @functools.wraps(view)
+    def wrapper(device_uuid):
+        if not app.config['RESULT_CACHE_SIZE']:
+            return view(device_uuid)
+        sensor_type = request.args.get('type')
+        try:
+            window = request_window()
+        except ValueError:
+            return view(device_uuid)
+        cache = get_result_cache(app)
+        arguments = tuple(sorted((name, value) for name, value in request.args.items(multi=True)
+                                 if name not in ('type', 'start', 'end')))
+        key = ((view.__name__, arguments, request.headers.get('Accept')), device_uuid, sensor_type) + window
+        cached = cache.get(key)
+        if cached is not None:
+            data, mimetype = cached
+            return Response(data, 200, mimetype=mimetype, headers={'X-Cache': 'HIT'})
+        generation = cache.generation(device_uuid, sensor_type)
+        response = app.make_response(view(device_uuid))
+        if response.status_code == 200:
+            cache.put(key, (response.get_data(), response.mimetype), generation)
+        response.headers['X-Cache'] = 'MISS'
+        return response
+    return wrapper
+
+
+def conditional_get(parse_args):
+    """
+    Answer the GETs of a per-device endpoint conditionally.
+
+    The weak ETag and Last-Modified come from the write watermark of the
+    device and type, which every insert moves. A GET whose If-None-Match
+    holds the current ETag is answered 304 from the watermark alone,
+    without reading any readings. The query parameters are checked with
+    parse_args first, so a request the endpoint would reject is answered
+    400 rather than 304. Other methods pass straight through.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(device_uuid):
+            if request.method != 'GET':
+                return view(device_uuid)
+            try:
+                parse_args()
+            except ValueError:
+                return 'Bad Request', 400
+            try:
+                writes, last_rowid, modified_at = write_watermark(get_db(device_uuid).cursor(), device_uuid,
+                                                                  request.args.get('type'))
+            except Exception as e:
+                return server_error(e)
+            etag = '{}-{}'.format(writes, last_rowid)
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+            else:
+                response = app.make_response(view(device_uuid))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag, weak=True)
+            if modified_at:
+                response.last_modified = modified_at
+            response.vary.add('Accept')
+            return response
+        return wrapper
+    return decorator
+
+
+def hot_window(device_uuid, sensor_type, start_time, end_time):
+    """The dates and values of a window from the hot tier, or None if it cannot serve it."""
+    if not app.config['HOT_TIER'] or sensor_type is None:
+        return None
+    return get_hot_tier(app).window(device_uuid, sensor_type, start_time, end_time)
+
+
+def window_arrays(cur, device_uuid, sensor_type, start_time, end_time, compacted):
+    """
+    The dates and values of a window as arrays ordered by date_created.
+
+    The rows are read from SQL in one pass straight into an array, without
+    an object per reading, and merged with the compacted readings of scan.
+    """
+    query, params = request_query(device_uuid, sensor_type, start_time, end_time, ['date_created', 'value'])
+    cur.execute(query + ' order by date_created', params)
+    flat = np.fromiter(itertools.chain.from_iterable(cur), dtype=np.int64)
+    dates, values = flat[0::2], flat[1::2]
+    if len(compacted[0]):
+        dates = np.concatenate([compacted[0], dates])
+        values = np.concatenate([compacted[1], values])
+        order = np.argsort(dates, kind='stable')
+        dates, values = dates[order], values[order]
+    return dates, values
+
+
+def window_response(device_uuid, sensor_type, dates, values, mimetype):
+    """Respond with the readings of one device and type given as arrays, in a streaming format."""
+    if mimetype in COLUMN_ENCODERS:
+        columns = [np.full(len(dates), device_uuid), np.full(len(dates), sensor_type), values, dates]
+        return Response(COLUMN_ENCODERS[mimetype]([columns], READING_COLUMNS), 200, mimetype=mimetype)
+    rows = [(device_uuid, sensor_type, value, date_created)
+            for date_created, value in zip(dates.tolist(), values.tolist())]
+    return Response(STREAM_ENCODERS[mimetype]([rows], READING_COLUMNS), 200, mimetype=mimetype)
+
+
+def columns_response(columns, names):
+    """Respond with columns as a JSON array of objects, or in the columnar format the client accepts."""
+    mimetype = request.accept_mimetypes.best_match([JSON_MIMETYPE, *COLUMN_ENCODERS], default=JSON_MIMETYPE)
+    if mimetype in COLUMN_ENCODERS:
+        return Response(COLUMN_ENCODERS[mimetype]([columns], names), 200, mimetype=mimetype)
+    return jsonify([dict(zip(names, row)) for row in zip(*(column.tolist() for column in columns))]), 200
+
+
+def next_page_headers(cursor):
+    """The headers pointing a paged GET to the page after a cursor."""
+    next_args = request.args.to_dict()
+    next_args['after'] = cursor
+    return {'X-Next-Cursor': cursor, 'Link': '<{}?{}>; rel="next"'.format(request.base_url, urlencode(next_args))}
+
+
+def merge_compacted(cur, device_uuid, sensor_type, start_time, end_time, after, compacted):
+    """
+    Iterate the readings of a device in the db and in segments together.
+
+    compacted is the scan of the segments over the window. Rows are merged
+    in (date_created, rowid) order and carry their rowid as a fifth column.
+    """
+    dates, values, types, rowids = compacted
+    if after is not None:
+        keep = (dates > after[0]) | ((dates == after[0]) & (rowids > after[1]))
+        dates, values, types, rowids = dates[keep], values[keep], types[keep], rowids[keep]
+    query, params = request_page_query(device_uuid, sensor_type, start_time, end_time, after,
+                                       READING_COLUMNS + ['rowid'])
+    cur.execute(query, params)
+    compacted_rows = zip(itertools.repeat(device_uuid), types.tolist(), values.tolist(), dates.tolist(),
+                         rowids.tolist())
+    return heapq.merge(compacted_rows, map(tuple, cur), key=lambda row: (row[3], row[4]))
 
 
 @app.route('/devices/<string:device_uuid>/readings/', methods=['POST', 'GET'])
+@conditional_get(readings_args)
 def request_device_readings(device_uuid):
     """
     This endpoint allows clients to POST or GET data specific sensor types.
@@ -53,61 +321,129 @@ def request_device_readings(device_uuid):
     * date_created -> The epoch date of the sensor reading.
         If none provided, we set to now.
 
+    POST also accepts a batch of readings, either as a JSON array of the
+    objects above or as an NDJSON body (Content-Type: application/x-ndjson).
+    The batch is inserted in one transaction and the response lists the
+    accept/reject result of every item.
+
+    With WRITE_BEHIND enabled, readings are group committed by a background
+    writer. The response is 202 when durability is 'enqueue' and 429 when
+    the write queue is full.
+
     Optional Query Parameters:
     * start -> The epoch start time for a sensor being created
     * end -> The epoch end time for a sensor being created
     * type -> The type of sensor value a client is looking for
+    * limit -> The max number of readings to return
+    * after -> The cursor of the last reading of the previous page
+    * max_points -> Downsample a type to at most this many readings, at
+        least 3, with Largest-Triangle-Three-Buckets. Not with paging.
+
+    GET readings are ordered by date_created and streamed as they are read,
+    as a JSON array or as NDJSON with Accept: application/x-ndjson. The
+    columnar formats application/vnd.sensor.columns+json, text/csv and the
+    binary application/vnd.sensor.columns are encoded from arrays. When
+    more readings follow a limited page, the X-Next-Cursor and Link headers
+    carry the cursor of the next page.
     """
     try:
-        # Set the db that we want and open the connection
-        if app.config['TESTING']:
-            conn = sqlite3.connect('test_database.db')
-        else:
-            conn = sqlite3.connect('database.db')
-            conn.row_factory = sqlite3.Row
-            cur = conn.cursor()
+        # Get a pooled connection to the shard of the device
+        conn = get_db(device_uuid)
+        cur = conn.cursor()
 
         if request.method == 'POST':
-            # Grab the post parameters
-            post_data = json.loads(request.data)
-            sensor_type = post_data.get('type')
-            value = post_data.get('value')
+            # Grab the post parameters, a single reading or a batch of them
+            readings, is_batch = parse_readings_body(request.get_data(as_text=True), request.mimetype)
 
-            # Added Field validation
-            if sensor_type is None or sensor_type not in ['temperature', 'humidity']:
-                return 'Bad Request', 400
-            if value is None or value < 0 or value > 100:
+            # Added Field validation, done for the whole batch at once
+            rows, errors = validate_readings(readings, int(time.time()))
+            if not is_batch and errors[0] is not None:
                 return 'Bad Request', 400
 
-            date_created = post_data.get('date_created', int(time.time()))
-
-            # Insert data into db
-            cur.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
-                    (device_uuid, sensor_type, value, date_created))
-
-            conn.commit()
+            insert_rows = [(device_uuid, sensor_type, value, date_created)
+                           for _, sensor_type, value, date_created in rows]
+            status = 201
+            if app.config['WRITE_BEHIND']:
+                # Hand the rows to the write-behind writer for a group commit
+                durable = app.config['WRITE_BEHIND_DURABILITY'] == 'commit'
+                try:
+                    if insert_rows:
+                        get_writer(app, readings_committed, database_path(app, device_uuid)).submit(
+                            insert_rows, wait=durable)
+                except queue.Full:
+                    return 'Too Many Requests', 429
+                if not durable:
+                    status = 202
+            else:
+                # Insert data into db in a single transaction
+                cur.executemany(INSERT_READING, insert_rows)
+                conn.commit()
+                readings_committed(cur, insert_rows)
 
             # Return success
-            return 'success', 201
+            if not is_batch:
+                return 'success', status
+            results = batch_results(errors)
+            return jsonify(results), status if results['accepted'] else 400
         else:
             # Get optional query parameters
-            start_time = request.args.get('start')
-            end_time = request.args.get('end')
-            sensor_type = request.args.get('type')
+            try:
+                sensor_type, start_time, end_time, limit, after, max_points = readings_args()
+            except ValueError:
+                return 'Bad Request', 400
 
-        # Generate query
-        query = request_query(device_uuid, sensor_type, start_time, end_time)
-        # Execute the query
-        cur.execute(query)
-        rows = cur.fetchall()
-
-        # Return the JSON
-        return jsonify([dict(zip(['device_uuid', 'type', 'value', 'date_created'], row)) for row in rows]), 200
-    except Exception:
-        return 'Server Error', 500
+        # Serve unpaged windows that the hot tier holds from memory
+        mimetype = request.accept_mimetypes.best_match(STREAM_ENCODERS, default=JSON_MIMETYPE)
+        window = hot_window(device_uuid, sensor_type, start_time, end_time) if limit is None and after is None else None
+        if window is not None:
+            dates, values = window
+            if max_points is not None:
+                keep = lttb(dates, values, max_points)
+                dates, values = dates[keep], values[keep]
+            return window_response(device_uuid, sensor_type, dates, values, mimetype)
+
+        # Merge in the readings compacted into segments, if the window has any
+        compacted = scan(cur, device_uuid, sensor_type, start_time, end_time)
+
+        # Downsample the whole window, read into arrays in one pass
+        if max_points is not None:
+            dates, values = window_arrays(cur, device_uuid, sensor_type, start_time, end_time, compacted)
+            keep = lttb(dates, values, max_points)
+            return window_response(device_uuid, sensor_type, dates[keep], values[keep], mimetype)
+
+        if len(compacted[0]):
+            rows = merge_compacted(cur, device_uuid, sensor_type, start_time, end_time, after, compacted)
+            headers = {}
+            if limit is not None:
+                rows = list(itertools.islice(rows, limit + 1))
+                if len(rows) > limit:
+                    headers = next_page_headers(format_cursor(*rows[limit - 1][3:]))
+                rows = rows[:limit]
+            body = STREAM_ENCODERS[mimetype](iter_row_batches(rows), READING_COLUMNS)
+            return Response(stream_with_context(body), 200, headers=headers, mimetype=mimetype)
+
+        if limit is not None:
+            # Read the page and the reading after it in one statement, so the cursor comes from the same snapshot
+            query, params = request_page_query(device_uuid, sensor_type, start_time, end_time, after,
+                                               READING_COLUMNS + ['rowid'])
+            cur.execute(query + ' limit ?', params + [limit + 1])
+            rows = cur.fetchall()
+            headers = next_page_headers(format_cursor(*rows[limit - 1][3:])) if len(rows) > limit else {}
+            body = STREAM_ENCODERS[mimetype](iter_row_batches(rows[:limit]), READING_COLUMNS)
+            return Response(stream_with_context(body), 200, headers=headers, mimetype=mimetype)
+
+        # Execute the query and stream the rows as they are read
+        query, params = request_page_query(device_uuid, sensor_type, start_time, end_time, after)
+        cur.execute(query, params)
+        body = STREAM_ENCODERS[mimetype](iter_batches(cur), READING_COLUMNS)
+        return Response(stream_with_context(body), 200, mimetype=mimetype)
+    except Exception as e:
+        return server_error(e)
 
 
 @app.route('/devices/<string:device_uuid>/readings/max/', methods=['GET'])
+@conditional_get(metric_args)
+@cached_result
 def request_device_readings_max(device_uuid):
     """
     This endpoint allows clients to GET the max sensor reading for a device.
@@ -118,42 +454,63 @@ def request_device_readings_max(device_uuid):
     Optional Query Parameters
     * start -> The epoch start time for a sensor being created
     * end -> The epoch end time for a sensor being created
+
+    When both start and end are given, the whole minutes, hours and days of
+    the window are answered from the rollups and only the edges from raw rows.
     """
 
     try:
-        # Set the db that we want and open the connection
-        if app.config['TESTING']:
-            conn = sqlite3.connect('test_database.db')
-        else:
-            conn = sqlite3.connect('database.db')
-            conn.row_factory = sqlite3.Row
-            cur = conn.cursor()
+        # Get a pooled connection to the shard of the device
+        conn = get_db(device_uuid)
+        cur = conn.cursor()
 
         # Get query parameters
-        sensor_type = request.args.get('type')
-        if sensor_type is None:
+        try:
+            sensor_type, start_time, end_time = metric_args()
+        except ValueError:
             return 'Bad Request', 400
 
-        start_time = request.args.get('start')
-        end_time = request.args.get('end')
-
-        # Generate query
-        query = request_query(device_uuid, sensor_type, start_time, end_time)
-        # Get max value from db
-        query += ' order by value desc limit 1'
+        # Serve windows that the hot tier holds from memory
+        window = hot_window(device_uuid, sensor_type, start_time, end_time)
+        if window is not None:
+            dates, values = window
+            if len(values) == 0:
+                return jsonify([]), 200
+            i = int(np.argmax(values))
+            return jsonify([dict(zip(READING_COLUMNS, (device_uuid, sensor_type, int(values[i]), int(dates[i]))))]), 200
+
+        # Answer bucket aligned windows from the rollups
+        plan = rollup_plan(start_time, end_time)
+        if plan is not None:
+            aggregate = window_aggregate(cur, device_uuid, sensor_type, plan)
+            row = None
+            if aggregate is not None:
+                row = find_reading(cur, device_uuid, sensor_type, plan, aggregate['max'], 'value_max')
+            return jsonify([dict(zip(READING_COLUMNS, row))] if row is not None else []), 200
+
+        # Get the reading with the max value straight from the db
+        query, params = request_query(device_uuid, sensor_type, start_time, end_time, MAX_READING_COLUMNS)
 
         # Execute the query
-        cur.execute(query)
-        rows = cur.fetchall()
+        cur.execute(query, params)
+        rows = [tuple(row) for row in cur.fetchall() if row['value'] is not None]
 
+        # And compare it with the readings compacted into segments
+        dates, values, types, _ = scan(cur, device_uuid, sensor_type, start_time, end_time)
+        if len(values):
+            i = int(np.argmax(values))
+            if not rows or values[i] > rows[0][2]:
+                rows = [(device_uuid, str(types[i]), int(values[i]), int(dates[i]))]
 
         # Return the JSON
-        return jsonify([dict(zip(['device_uuid', 'type', 'value', 'date_created'], row)) for row in rows]), 200
-    except Exception:
-        return 'Server Error', 500
+        return jsonify([dict(zip(READING_COLUMNS, row)) for row in rows]), 200
+    except Exception as e:
+        return server_error(e)
 
 
 @app.route('/devices/<string:device_uuid>/readings/median/', methods=['GET'])
+@conditional_get(metric_args)
+@cached_result
 def request_device_readings_median(device_uuid):
     """
     This endpoint allows clients to GET the median sensor reading for a device.
@@ -167,47 +524,58 @@ def request_device_readings_median(device_uuid):
     """
 
     try:
-        # Set the db that we want and open the connection
-        if app.config['TESTING']:
-            conn = sqlite3.connect('test_database.db')
-        else:
-            conn = sqlite3.connect('database.db')
-        conn.row_factory = sqlite3.Row
+        # Get a pooled connection to the shard of the device
+        conn = get_db(device_uuid)
         cur = conn.cursor()
 
         # Get query parameters
-        sensor_type = request.args.get('type')
-        if sensor_type is None:
+        try:
+            sensor_type, start_time, end_time = metric_args()
+        except ValueError:
             return 'Bad Request', 400
 
-        start_time = request.args.get('start')
-        end_time = request.args.get('end')
-
-        # Generate query
-        query = request_query(device_uuid, sensor_type, start_time, end_time)
-
-        # Execute the query
-        cur.execute(query)
-        rows = cur.fetchall()
-
-        if len(rows) == 0:
+        # Serve windows that the hot tier holds from memory
+        window = hot_window(device_uuid, sensor_type, start_time, end_time)
+        if window is not None:
+            dates, values = window
+            if len(values) == 0:
+                return 'No records found', 200
+            return jsonify({"date_created": np.quantile(dates, .5).item(), "device_uuid": device_uuid,
+                            "type": sensor_type, "value": np.quantile(values, .5).item()}), 200
+
+        # Merge the value histograms of the window
+        counts = window_histogram(cur, device_uuid, sensor_type, start_time, end_time)
+        total = int(counts.sum())
+        if total == 0:
             return 'No records found', 200
 
-        # Calculate the median
-        values = [row['value'] for row in rows]
-        numpy_array = np.array(values)
-        median_value = np.quantile(numpy_array, .5) # return 50th percentile, i.e. median.
-
-        values = [row['date_created'] for row in rows]
-        numpy_array = np.array(values)
-        median_date = np.quantile(numpy_array, .5) # return 50th percentile, i.e. median.
+        # Calculate the median value from the histogram
+        median_value = histogram_quantile(counts, .5).item()
+
+        # And the median date from the middle of the date index
+        middle = (total - 1) / 2
+        compacted_dates = scan(cur, device_uuid, sensor_type, start_time, end_time)[0]
+        if len(compacted_dates):
+            # Segments hold the cold history, the db only the recent dates left to merge in
+            query, params = request_query(device_uuid, sensor_type, start_time, end_time, ['date_created'])
+            cur.execute(query, params)
+            all_dates = np.concatenate([compacted_dates, np.fromiter((row[0] for row in cur), dtype=np.int64)])
+            dates = np.sort(all_dates)[int(middle):int(middle) + 2].tolist()
+        else:
+            query, params = request_page_query(device_uuid, sensor_type, start_time, end_time, None,
+                                               ['date_created'])
+            cur.execute(query + ' limit 2 offset ?', params + [int(middle)])
+            dates = [row[0] for row in cur.fetchall()]
+        median_date = dates[0] + (dates[-1] - dates[0]) * (middle - int(middle))
 
         return jsonify({"date_created": median_date, "device_uuid": device_uuid, "type": sensor_type, "value": median_value}), 200
-    except Exception:
-        return 'Server Error', 500
+    except Exception as e:
+        return server_error(e)
 
 
 @app.route('/devices/<string:device_uuid>/readings/mean/', methods=['GET'])
+@conditional_get(metric_args)
+@cached_result
 def request_device_readings_mean(device_uuid):
     """
     This endpoint allows clients to GET the mean sensor readings for a device.
@@ -218,48 +586,60 @@ def request_device_readings_mean(device_uuid):
     Optional Query Parameters
     * start -> The epoch start time for a sensor being created
     * end -> The epoch end time for a sensor being created
+
+    When both start and end are given, the whole minutes, hours and days of
+    the window are answered from the rollups and only the edges from raw rows.
     """
 
     try:
-        # Set the db that we want and open the connection
-        if app.config['TESTING']:
-            conn = sqlite3.connect('test_database.db')
-        else:
-            conn = sqlite3.connect('database.db')
-        conn.row_factory = sqlite3.Row
+        # Get a pooled connection to the shard of the device
+        conn = get_db(device_uuid)
         cur = conn.cursor()
 
         # Get query parameters
-        sensor_type = request.args.get('type')
-        if sensor_type is None:
+        try:
+            sensor_type, start_time, end_time = metric_args()
+        except ValueError:
             return 'Bad Request', 400
 
-        start_time = request.args.get('start')
-        end_time = request.args.get('end')
+        # Serve windows that the hot tier holds from memory
+        window = hot_window(device_uuid, sensor_type, start_time, end_time)
+        if window is not None:
+            dates, values = window
+            if len(values) == 0:
+                return 'No records found', 200
+            return jsonify({"value": values.mean().item()}), 200
+
+        # Answer bucket aligned windows from the rollups
+        plan = rollup_plan(start_time, end_time)
+        if plan is not None:
+            aggregate = window_aggregate(cur, device_uuid, sensor_type, plan)
+            if aggregate is None:
+                return 'No records found', 200
+            return jsonify({"value": aggregate['sum'] / aggregate['count']}), 200
 
         # Generate query
-        query = request_query(device_uuid, sensor_type, start_time, end_time)
-
-        # Execute the query
-        cur.execute(query)
-        rows = cur.fetchall()
-        if len(rows) == 0:
+        query, params = request_query(device_uuid, sensor_type, start_time, end_time, ['count(*)', 'sum(value)'])
+
+        # Sum the readings in the db and in segments
+        cur.execute(query, params)
+        count, total = cur.fetchone()
+        values = scan(cur, device_uuid, sensor_type, start_time, end_time)[1]
+        count += len(values)
+        total = (total or 0) + int(values.sum())
+        if count == 0:
             return 'No records found', 200
 
-        # Calculate the mean
-        sum = 0
-        for row in rows:
-            sum += row[2]
-        mean = sum/len(rows)
-
         # Return the JSON
-        return jsonify({"value": mean}), 200
-    except Exception:
-        return 'Server Error', 500
+        return jsonify({"value": total / count}), 200
+    except Exception as e:
+        return server_error(e)
 
 
 
 @app.route('/devices/<string:device_uuid>/readings/quartiles/', methods=['GET'])
+@conditional_get(quartiles_args)
+@cached_result
 def request_device_readings_quartiles(device_uuid):
     """
     This endpoint allows clients to GET the 1st and 3rd quartile
@@ -272,44 +652,128 @@ def request_device_readings_quartiles(device_uuid):
     """
 
     try:
-        # Set the db that we want and open the connection
-        if app.config['TESTING']:
-            conn = sqlite3.connect('test_database.db')
-        else:
-            conn = sqlite3.connect('database.db')
-        conn.row_factory = sqlite3.Row
+        # Get a pooled connection to the shard of the device
+        conn = get_db(device_uuid)
         cur = conn.cursor()
 
         # Get query parameters
-        sensor_type = request.args.get('type')
-        if sensor_type is None:
+        try:
+            sensor_type, start_time, end_time = quartiles_args()
+        except ValueError:
             return 'Bad Request', 400
-        start_time = request.args.get('start')
-        if start_time is None:
+
+        # Merge the value histograms of the window
+        counts = window_histogram(cur, device_uuid, sensor_type, start_time, end_time)
+        if counts.sum() == 0:
+            return 'No records found', 200
+
+        # Calculate quartiles from the histogram
+        quartile_1 = histogram_quantile(counts, .25).item()
+        quartile_3 = histogram_quantile(counts, .75).item()
+
+        # Return the JSON
+        return jsonify({"quartile_1": quartile_1, "quartile_3": quartile_3}), 200
+    except Exception as e:
+        return server_error(e)
+
+
+@app.route('/devices/<string:device_uuid>/readings/stats/', methods=['GET'])
+@conditional_get(stats_args)
+@cached_result
+def request_device_readings_stats(device_uuid):
+    """
+    This endpoint allows clients to GET several metrics of a device at once.
+
+    Mandatory Query Parameters:
+    * type -> The type of sensor value a client is looking for
+
+    Optional Query Parameters
+    * start -> The epoch start time for a sensor being created
+    * end -> The epoch end time for a sensor being created
+    * metrics -> Comma separated metrics out of max, min, mean, median,
+        q1, q3, mode, count and stddev. All of them by default.
+
+    The window is read once into a value histogram and every metric is
+    computed from it. Metrics of an empty window are null, with count 0.
+    """
+
+    try:
+        # Get query parameters
+        try:
+            sensor_type, start_time, end_time, metrics = stats_args()
+        except ValueError:
             return 'Bad Request', 400
-        end_time = request.args.get('end')
-        if end_time is None:
+
+        # Count the values of the window, from the hot tier if it holds it
+        window = hot_window(device_uuid, sensor_type, start_time, end_time)
+        if window is not None:
+            counts = np.bincount(window[1], minlength=HISTOGRAM_BINS)
+        else:
+            # Get a pooled connection to the shard of the device
+            conn = get_db(device_uuid)
+            counts = window_histogram(conn.cursor(), device_uuid, sensor_type, start_time, end_time)
+
+        # Compute every metric from the histogram
+        return jsonify(histogram_stats(counts, metrics)), 200
+    except Exception as e:
+        return server_error(e)
+
+
+@app.route('/devices/<string:device_uuid>/readings/series/', methods=['GET'])
+@conditional_get(series_args)
+@cached_result
+def request_device_readings_series(device_uuid):
+    """
+    This endpoint allows clients to GET the readings of a device reduced to time buckets.
+
+    Mandatory Query Parameters:
+    * type -> The type of sensor value a client is looking for
+    * interval -> The length of a bucket in seconds
+
+    Optional Query Parameters
+    * start -> The epoch start time for a sensor being created
+    * end -> The epoch end time for a sensor being created
+    * agg -> Comma separated aggregates out of mean, min, max and count.
+        All of them by default.
+
+    Buckets start at multiples of interval and there is one point per
+    bucket holding readings, so the response grows with window / interval
+    rather than with the number of readings. Points are a JSON array by
+    default, or in the columnar formats of GET readings.
+    """
+
+    try:
+        # Get query parameters
+        try:
+            sensor_type, start_time, end_time, aggregates, interval = series_args()
+        except ValueError:
             return 'Bad Request', 400
+        names = ['date_created'] + list(aggregates)
 
-        # Generate query
-        query = request_query(device_uuid, sensor_type, start_time, end_time)
+        # Bucket windows that the hot tier holds in memory
+        window = hot_window(device_uuid, sensor_type, start_time, end_time)
+        if window is not None:
+            return columns_response(bucket_series(*window, interval, aggregates), names)
 
-        # Execute the query
-        cur.execute(query)
-        rows = cur.fetchall()
+        # Get a pooled connection to the shard of the device
+        conn = get_db(device_uuid)
+        cur = conn.cursor()
 
-        if len(rows) == 0:
-            return 'No records found', 200
-        # Calculate quartiles
-        values = [row['value'] for row in rows]
-        numpy_array = np.array(values)
-        print(numpy_array)
-        quartiles = np.quantile(numpy_array, [.25, .75]) # return 1st and 3rd quartiles
+        # Bucket the raw rows along with the readings compacted into segments, if the window has any
+        compacted = scan(cur, device_uuid, sensor_type, start_time, end_time)
+        if len(compacted[0]):
+            dates, values = window_arrays(cur, device_uuid, sensor_type, start_time, end_time, compacted)
+            return columns_response(bucket_series(dates, values, interval, aggregates), names)
 
-        # Return the JSON
-        return jsonify({"quartile_1": quartiles[0], "quartile_3": quartiles[1]}), 200
-    except Exception:
-        return 'Server Error', 500
+        # Otherwise group the buckets in SQL
+        query, params = request_series_query(device_uuid, sensor_type, start_time, end_time, interval, aggregates)
+        cur.execute(query, params)
+        rows = cur.fetchall()
+        if not rows:
+            return columns_response(bucket_series([], [], interval, aggregates), names)
+        return columns_response([np.asarray(column) for column in zip(*rows)], names)
+    except Exception as e:
+        return server_error(e)
 
 
 @app.route('/devices/summary/', methods=['GET'])
@@ -322,54 +786,91 @@ def request_readings_summary():
     * type -> The type of sensor value a client is looking for
     * start -> The epoch start time for a sensor being created
     * end -> The epoch end time for a sensor being created
+
+    With SHARDS set above 1, every shard is summarized in parallel and the
+    per-device histograms are merged before the summary is computed. With
+    SUMMARY_PROCESSES set, the devices are split over worker processes.
+
+    The summary is a JSON array by default. The columnar formats of GET
+    readings are served by Accept, encoded straight from the summary arrays.
     """
 
     try:
-        # Set the db that we want and open the connection
-        if app.config['TESTING']:
-            conn = sqlite3.connect('test_database.db')
-        else:
-            conn = sqlite3.connect('database.db')
-        conn.row_factory = sqlite3.Row
-        cur = conn.cursor()
-
         # Get query parameters
         sensor_type = request.args.get('type')
-        start_time = request.args.get('start')
-        end_time = request.args.get('end')
+        try:
+            start_time, end_time = request_window()
+        except ValueError:
+            return 'Bad Request', 400
 
-        # Generate query
-        query = request_readings_summary(sensor_type, start_time, end_time)
+        # Merge the value histograms of every device, shard by shard in parallel
+        if app.config['SUMMARY_PROCESSES']:
+            device_uuids, histograms = parallel_fleet_histograms(database_paths(app), app.config['SUMMARY_PROCESSES'],
+                                                                 sensor_type, start_time, end_time)
+        else:
+            partials = fan_out(database_paths(app),
+                               lambda cur: fleet_histograms(cur, sensor_type, start_time, end_time))
+            device_uuids, histograms = merge_fleet_histograms(partials)
 
-        # Execute the query
-        cur.execute(query)
-        rows = cur.fetchall()
+        # And generate the summary, in the format the client accepts
+        return columns_response(summary_columns(device_uuids, histograms), SUMMARY_COLUMNS)
+    except Exception as e:
+        return server_error(e)
+
+@app.route('/devices/fleet/', methods=['GET'])
+def request_fleet_top():
+    """
+    This endpoint allows clients to GET the devices ranking highest on a metric.
+
+    Mandatory Query Parameters:
+    * type -> The type of sensor value a client is looking for
+
+    Optional Query Parameters
+    * start -> The epoch start time for a sensor being created
+    * end -> The epoch end time for a sensor being created
+    * by -> The metric devices are ranked by, max, mean or count. max by default.
+    * k -> The number of devices to return, 50 by default unless above is set
+    * above -> Only return devices whose metric is above this threshold
+
+    Devices are ranked from a streamed GROUP BY through a heap bounded to
+    k, every shard in parallel. Ties are ordered by device_uuid.
+    """
+
+    try:
+        # Get query parameters
+        sensor_type = request.args.get('type')
+        metric = request.args.get('by', 'max')
+        if sensor_type is None or metric not in FLEET_METRICS:
+            return 'Bad Request', 400
 
-        device_values_dict = {}
-        for row in rows:
-            if row[0] not in device_values_dict:
-                device_values_dict[row[0]] = []
-            device_values_dict[row[0]].append(row[1])
-
-        # Generate the summary
-        summary_list = []
-        for device_id in device_values_dict:
-            summary_dict = {}
-            numpy_array = np.array(device_values_dict[device_id])
-            summary_dict['device_uuid'] = device_id
-            summary_dict['number_of_readings'] = len(device_values_dict[device_id])
-            summary_dict['max_reading_value'] = max(device_values_dict[device_id])
-            summary_dict['median_reading_value'] = np.quantile(numpy_array, .5)
-            summary_dict['mean_reading_value'] = statistics.mean(device_values_dict[device_id])
-            summary_dict['quartile_1_value'] = np.quantile(numpy_array, .25)
-            summary_dict['quartile_3_value'] = np.quantile(numpy_array, .75)
-            summary_list.append(summary_dict)
-        summary_list = sorted(summary_list, key=lambda k: k['number_of_readings'], reverse=True)
-        return jsonify(summary_list), 200
-    except Exception:
-        return 'Server Error', 500
+        try:
+            start_time, end_time = request_window()
+        except ValueError:
+            return 'Bad Request', 400
+        k = request.args.get('k')
+        above = request.args.get('above')
+        try:
+            k = int(k) if k is not None else None
+            above = float(above) if above is not None else None
+        except ValueError:
+            return 'Bad Request', 400
+        if k is not None and k < 1:
+            return 'Bad Request', 400
+        if k is None and above is None:
+            k = FLEET_DEFAULT_K
+
+        # Rank the devices of every shard in parallel, then merge the rankings
+        partials = fan_out(database_paths(app),
+                           lambda cur: fleet_top(cur, sensor_type, start_time, end_time, metric, k, above))
+        ranked = merge_fleet_top(partials, k)
+        values, device_uuids = zip(*ranked) if ranked else ((), ())
+        return columns_response([np.array(device_uuids, dtype=str), np.array(values)], ['device_uuid', metric])
+    except Exception as e:
+        return server_error(e)
 
 @app.route('/devices/<string:device_uuid>/readings/min/', methods = ['GET'])
+@conditional_get(metric_args)
+@cached_result
 def request_device_readings_min(device_uuid):
     """
     This endpoint allows clients to GET the min sensor reading for a device.
@@ -378,40 +879,61 @@ def request_device_readings_min(device_uuid):
     Optional Query Parameters
     * start -> The epoch start time for a sensor being created
     * end -> The epoch end time for a sensor being created
+
+    When both start and end are given, the whole minutes, hours and days of
+    the window are answered from the rollups and only the edges from raw rows.
     """
     try:
-        # Set the db that we want and open the connection
-        if app.config['TESTING']:
-            conn = sqlite3.connect('test_database.db')
-        else:
-            conn = sqlite3.connect('database.db')
-        conn.row_factory = sqlite3.Row
+        # Get a pooled connection to the shard of the device
+        conn = get_db(device_uuid)
         cur = conn.cursor()
 
         # Get query parameters
-        sensor_type = request.args.get('type')
-        if sensor_type is None:
+        try:
+            sensor_type, start_time, end_time = metric_args()
+        except ValueError:
             return 'Bad Request', 400
 
-        start_time = request.args.get('start')
-        end_time = request.args.get('end')
-
-        # Generate query
-        query = request_query(device_uuid, sensor_type, start_time, end_time)
-        # Get min value from db
-        query += ' order by value asc limit 1'
+        # Serve windows that the hot tier holds from memory
+        window = hot_window(device_uuid, sensor_type, start_time, end_time)
+        if window is not None:
+            dates, values = window
+            if len(values) == 0:
+                return jsonify([]), 200
+            i = int(np.argmin(values))
+            return jsonify([dict(zip(READING_COLUMNS, (device_uuid, sensor_type, int(values[i]), int(dates[i]))))]), 200
+
+        # Answer bucket aligned windows from the rollups
+        plan = rollup_plan(start_time, end_time)
+        if plan is not None:
+            aggregate = window_aggregate(cur, device_uuid, sensor_type, plan)
+            row = None
+            if aggregate is not None:
+                row = find_reading(cur, device_uuid, sensor_type, plan, aggregate['min'], 'value_min')
+            return jsonify([dict(zip(READING_COLUMNS, row))] if row is not None else []), 200
+
+        # Get the reading with the min value straight from the db
+        query, params = request_query(device_uuid, sensor_type, start_time, end_time, MIN_READING_COLUMNS)
 
         # Execute the query
-        cur.execute(query)
-        rows = cur.fetchall()
+        cur.execute(query, params)
+        rows = [tuple(row) for row in cur.fetchall() if row['value'] is not None]
 
+        # And compare it with the readings compacted into segments
+        dates, values, types, _ = scan(cur, device_uuid, sensor_type, start_time, end_time)
+        if len(values):
+            i = int(np.argmin(values))
+            if not rows or values[i] < rows[0][2]:
+                rows = [(device_uuid, str(types[i]), int(values[i]), int(dates[i]))]
 
         # Return the JSON
-        return jsonify([dict(zip(['device_uuid', 'type', 'value', 'date_created'], row)) for row in rows]), 200
-    except Exception:
-        return 'Server Error', 500
+        return jsonify([dict(zip(READING_COLUMNS, row)) for row in rows]), 200
+    except Exception as e:
+        return server_error(e)
 
 @app.route('/devices/<string:device_uuid>/readings/mode/', methods = ['GET'])
+@conditional_get(metric_args)
+@cached_result
 def request_device_readings_mode(device_uuid):
     """
     This endpoint allows clients to GET the mode sensor readings for a device.
@@ -420,46 +942,211 @@ def request_device_readings_mode(device_uuid):
     Optional Query Parameters
     * start -> The epoch start time for a sensor being created
     * end -> The epoch end time for a sensor being created
+    Ties go to the smallest of the most common values.
     """
 
     try:
-        # Set the db that we want and open the connection
-        if app.config['TESTING']:
-            conn = sqlite3.connect('test_database.db')
-        else:
-            conn = sqlite3.connect('database.db')
-        conn.row_factory = sqlite3.Row
+        # Get a pooled connection to the shard of the device
+        conn = get_db(device_uuid)
         cur = conn.cursor()
 
         # Get query parameters
-        sensor_type = request.args.get('type')
-        if sensor_type is None:
+        try:
+            sensor_type, start_time, end_time = metric_args()
+        except ValueError:
             return 'Bad Request', 400
 
-        start_time = request.args.get('start')
-        end_time = request.args.get('end')
-
-        # Generate query
-        query = request_query(device_uuid, sensor_type, start_time, end_time)
-
-        # Execute the query
-        cur.execute(query)
-        rows = cur.fetchall()
-        if len(rows) == 0:
+        # Serve windows that the hot tier holds from memory
+        window = hot_window(device_uuid, sensor_type, start_time, end_time)
+        if window is not None:
+            dates, values = window
+            if len(values) == 0:
+                return 'No records found', 200
+            return jsonify({"value": int(histogram_mode(np.bincount(values, minlength=HISTOGRAM_BINS)))}), 200
+
+        # Merge the value histograms of the window
+        counts = window_histogram(cur, device_uuid, sensor_type, start_time, end_time)
+        if counts.sum() == 0:
             return 'No records found', 200
 
-        # Calculate the mode
-        mode_list = []
-        for row in rows:
-            mode_list.append(row[2])
-        print(mode_list)
-        mode = statistics.mode(mode_list)
-        print(mode)
+        # Calculate the mode from the histogram
+        mode = int(histogram_mode(counts))
 
         # Return the JSON
         return jsonify({"value": mode}), 200
-    except:
-        return 'Server Error', 500
+    except Exception as e:
+        return server_error(e)
+
+
+@app.route('/readings/bulk', methods=['POST'])
+def request_bulk_readings():
+    """
+    This endpoint allows gateways to POST readings for many devices at once.
+
+    The body is NDJSON, one reading per line, each with its own device_uuid:
+    * device_uuid -> The device the reading belongs to
+    * type -> The type of sensor (temperature or humidity)
+    * value -> The integer value of the sensor reading
+    * date_created -> The epoch date of the sensor reading.
+        If none provided, we set to now.
+
+    The body is parsed while it streams in and inserted in chunks, each
+    chunk committed on its own. The response reports the accepted and
+    rejected counts, the first rejected lines and the ingest throughput.
+    The lines of a chunk that fails to insert are rolled back and rejected
+    with 'insert failed', while the chunks around it are still committed.
+    """
+
+    try:
+        started = time.perf_counter()
+        accepted = 0
+        rejected = 0
+        errors = []
+        for chunk in iter_ndjson_chunks(request.stream, BULK_CHUNK_SIZE):
+            line_numbers = [line_number for line_number, _ in chunk]
+            rows, chunk_errors = validate_bulk_readings([reading for _, reading in chunk], int(time.time()))
+
+            # Insert the chunk, shard by shard, and commit it before reading any further
+            shard_rows = {}
+            for row in rows:
+                shard_rows.setdefault(database_path(app, row[1]), []).append(row)
+            for path, path_rows in shard_rows.items():
+                conn = get_shard_db(path)
+                cur = conn.cursor()
+                insert_rows = [row[1:] for row in path_rows]
+                try:
+                    cur.executemany(INSERT_READING, insert_rows)
+                    conn.commit()
+                except Exception as e:
+                    conn.rollback()
+                    app.logger.exception('Bulk chunk of %d readings failed', len(insert_rows))
+                    record_error(e)
+                    for row in path_rows:
+                        chunk_errors[row[0]] = 'insert failed'
+                    continue
+                readings_committed(cur, insert_rows)
+                accepted += len(insert_rows)
+
+            rejected += sum(1 for error in chunk_errors if error is not None)
+            for line_number, error in zip(line_numbers, chunk_errors):
+                if error is not None and len(errors) < BULK_MAX_ERRORS:
+                    errors.append({'line': line_number, 'error': error})
+        elapsed = time.perf_counter() - started
+
+        # Return the JSON
+        return jsonify({
+            'accepted': accepted,
+            'rejected': rejected,
+            'errors': errors,
+            'elapsed_seconds': elapsed,
+            'readings_per_second': accepted / elapsed if elapsed > 0 else 0.0
+        }), 201 if accepted else 400
+    except Exception as e:
+        return server_error(e)
+
+
+# Devices one multi-device read may ask for
+QUERY_MAX_DEVICES = 10000
+
+
+def parse_devices_query(body):
+    """
+    Validate the decoded JSON body of a multi-device read.
+
+    The body holds device_uuids, a list of at most QUERY_MAX_DEVICES
+    strings, and optionally type, start, end, stats (true or a list out of
+    STATS_METRICS) and readings (false to leave them out). Returns a tuple of
+    (device_uuids, type, start, end, metrics, readings) with the devices
+    deduplicated in order and metrics None when no stats are asked for.
+    Raises ValueError when the body is malformed.
+    """
+    if not isinstance(body, dict):
+        raise ValueError('the body must be a JSON object')
+    device_uuids = body.get('device_uuids')
+    if (not isinstance(device_uuids, list) or not 0 < len(device_uuids) <= QUERY_MAX_DEVICES
+            or not all(isinstance(d, str) and d != '' for d in device_uuids)):
+        raise ValueError('invalid device_uuids')
+    sensor_type = body.get('type')
+    if sensor_type is not None and sensor_type not in VALID_TYPES:
+        raise ValueError('invalid type')
+    window = [body.get(field) for field in ('start', 'end')]
+    if not all(bound is None or isinstance(bound, int) and not isinstance(bound, bool) for bound in window):
+        raise ValueError('invalid start or end')
+    metrics = body.get('stats', False)
+    if metrics is True:
+        metrics = list(STATS_METRICS)
+    elif metrics is False:
+        metrics = None
+    elif not isinstance(metrics, list) or not metrics or any(metric not in STATS_METRICS for metric in metrics):
+        raise ValueError('invalid stats')
+    readings = body.get('readings', True)
+    if not isinstance(readings, bool):
+        raise ValueError('invalid readings')
+    return list(dict.fromkeys(device_uuids)), sensor_type, window[0], window[1], metrics, readings
+
+
+@app.route('/devices/readings/query', methods=['POST'])
+def request_devices_readings():
+    """
+    This endpoint allows clients to read the same window for many devices at once.
+
+    The body is a JSON object:
+    * device_uuids -> The list of devices to read
+    * type -> The type of sensor value a client is looking for, optional
+    * start -> The epoch start time for a sensor being created, optional
+    * end -> The epoch end time for a sensor being created, optional
+    * stats -> true, or a list of the metrics of the stats endpoint, to add
+        the metrics of every device
+    * readings -> false to leave the readings out, true by default
+
+    The response maps every device to its readings, ordered by
+    date_created, and its stats. The devices of a shard are read with one
+    statement per DEVICES_CHUNK_SIZE of them.
+    """
+
+    try:
+        try:
+            device_uuids, sensor_type, start_time, end_time, metrics, include_readings = parse_devices_query(
+                request.get_json(force=True, silent=True))
+        except ValueError:
+            return 'Bad Request', 400
+
+        # Group the devices by shard
+        shard_devices = {}
+        for device_uuid in device_uuids:
+            shard_devices.setdefault(database_path(app, device_uuid), []).append(device_uuid)
+
+        # Read the devices of each shard in chunks, grouping the rows by device as they come
+        results = dict.fromkeys(device_uuids, ())
+        for path, devices in shard_devices.items():
+            cur = get_shard_db(path).cursor()
+            compacted = scan_devices(cur, devices, sensor_type, start_time, end_time)
+            for start in range(0, len(devices), DEVICES_CHUNK_SIZE):
+                query, params = request_devices_query(devices[start:start + DEVICES_CHUNK_SIZE], sensor_type,
+                                                      start_time, end_time, READING_COLUMNS + ['rowid'])
+                cur.execute(query, params)
+                for device_uuid, rows in itertools.groupby(map(tuple, cur), key=lambda row: row[0]):
+                    results[device_uuid] = list(rows)
+
+            # Merge in the readings compacted into segments
+            for device_uuid, (dates, values, types, rowids) in compacted.items():
+                compacted_rows = zip(itertools.repeat(device_uuid), types.tolist(), values.tolist(), dates.tolist(),
+                                     rowids.tolist())
+                results[device_uuid] = list(heapq.merge(compacted_rows, results[device_uuid],
+                                                        key=lambda row: (row[3], row[4])))
+
+        # Return the readings and stats of every device
+        devices = {}
+        for device_uuid, rows in results.items():
+            device = devices[device_uuid] = {}
+            if include_readings:
+                device['readings'] = [dict(zip(READING_COLUMNS, row)) for row in rows]
+            if metrics is not None:
+                values = np.fromiter((row[2] for row in rows), dtype=np.int64, count=len(rows))
+                device['stats'] = histogram_stats(np.bincount(values, minlength=HISTOGRAM_BINS), metrics)
+        return jsonify(devices), 200
+    except Exception as e:
+        return server_error(e)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,201 @@
+"""
+Asyncio serving mode for the API.
+
+The Flask routes run unchanged on bounded thread pools behind an ASGI
+adapter, with one pool for ingest and one for analytics so slow summary
+and quartile scans cannot hold up POSTs. Serve it with any ASGI server:
+
+    uvicorn asgi:application
+"""
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from app import app
+
+# Methods dispatched to the ingest pool, every other request is analytics
+INGEST_METHODS = ('POST', 'PUT')
+
+# Paths read with a POST body, dispatched to the analytics pool
+ANALYTICS_PATHS = ('/devices/readings/query',)
+
+app.config.from_mapping(
+    ASGI_INGEST_WORKERS=4,
+    ASGI_ANALYTICS_WORKERS=4,
+    # Requests waiting for a busy pool before new ones get a 503
+    ASGI_QUEUE_SIZE=64
+)
+
+
+class ReceiveStream(io.RawIOBase):
+    """
+    The body of an ASGI request as the wsgi.input of a WSGI app.
+
+    The app reads it on its own thread, and every read pulls the next chunk
+    from receive on the event loop. The body is never held whole in memory,
+    so NDJSON bulk posts are still parsed as they arrive.
+    """
+
+    def __init__(self, receive, loop):
+        self.receive = receive
+        self.loop = loop
+        self.pending = b''
+        self.done = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending and not self.done:
+            message = asyncio.run_coroutine_threadsafe(self.receive(), self.loop).result()
+            if message['type'] == 'http.disconnect':
+                self.done = True
+                break
+            self.pending = message.get('body', b'')
+            self.done = not message.get('more_body', False)
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+
+def build_environ(scope, stream):
+    """The WSGI environ of an ASGI http scope, reading its body from a stream."""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': stream,
+        # The stream ends with the body, whether or not a length was sent
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[name] = value
+        else:
+            key = 'HTTP_' + name
+            environ[key] = environ[key] + ',' + value if key in environ else value
+    return environ
+
+
+def run_wsgi(wsgi_app, scope, receive, send, loop):
+    """
+    Run a WSGI app for an ASGI request on the calling thread.
+
+    The body is read from receive as the app asks for it, and every chunk
+    of the response is sent as soon as the app yields it, waiting for the
+    event loop to take it. Streamed bodies keep their constant memory, and
+    the database work behind them stays on this thread. Returns the status.
+    """
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = headers
+
+    def forward(message):
+        asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+    def start():
+        forward({'type': 'http.response.start', 'status': response['status'],
+                 'headers': [(name.encode('latin-1'), value.encode('latin-1'))
+                             for name, value in response['headers']]})
+
+    chunks = wsgi_app(build_environ(scope, io.BufferedReader(ReceiveStream(receive, loop))), start_response)
+    started = False
+    try:
+        for chunk in chunks:
+            if not chunk:
+                continue
+            if not started:
+                start()
+                started = True
+            forward({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+    if not started:
+        start()
+    forward({'type': 'http.response.body', 'body': b'', 'more_body': False})
+    return response['status']
+
+
+class ThreadPoolASGI:
+    """
+    An ASGI app running a WSGI app on separate bounded thread pools.
+
+    Requests are dispatched to the ingest or analytics pool by method and
+    path, and their bodies are streamed in and out from the pool thread.
+    Once a pool has queue_size requests waiting for a thread, new ones are
+    answered 503 straight away.
+    """
+
+    def __init__(self, wsgi_app, ingest_workers=4, analytics_workers=4, queue_size=64):
+        self.wsgi_app = wsgi_app
+        self.queue_size = queue_size
+        self.workers = {'ingest': ingest_workers, 'analytics': analytics_workers}
+        self.pools = {name: ThreadPoolExecutor(max_workers=workers, thread_name_prefix='asgi-' + name)
+                      for name, workers in self.workers.items()}
+        self.in_flight = {name: 0 for name in self.workers}
+
+    def pool_name(self, scope):
+        """The pool a request runs on."""
+        if scope['method'] in INGEST_METHODS and scope['path'].rstrip('/') not in ANALYTICS_PATHS:
+            return 'ingest'
+        return 'analytics'
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        name = self.pool_name(scope)
+        if self.in_flight[name] >= self.workers[name] + self.queue_size:
+            await self.respond(send, 503, [('Content-Type', 'text/plain')], b'Service Unavailable')
+            return
+        self.in_flight[name] += 1
+        try:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self.pools[name], run_wsgi, self.wsgi_app, scope, receive, send, loop)
+        finally:
+            self.in_flight[name] -= 1
+
+    async def respond(self, send, status, headers, body):
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(name.encode('latin-1'), value.encode('latin-1')) for name, value in headers]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def close(self):
+        """Wait for the requests running on the pools and stop their threads."""
+        for pool in self.pools.values():
+            pool.shutdown()
+
+
+application = ThreadPoolASGI(app, app.config['ASGI_INGEST_WORKERS'], app.config['ASGI_ANALYTICS_WORKERS'],
+                             app.config['ASGI_QUEUE_SIZE'])
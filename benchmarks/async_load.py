@@ -0,0 +1,129 @@
+"""
+p99 POST latency under concurrent summary load, threaded and asyncio modes.
+
+Summary clients keep every analytics thread busy while POST clients post
+small batches. In the threaded mode all requests share one pool of
+threads, like a threaded WSGI server; in the asyncio mode they run on the
+separate ingest and analytics pools of the ASGI adapter. Requests are
+driven in-process, so no server is needed. Run from the repo root:
+
+    python benchmarks/async_load.py
+"""
+import argparse
+import asyncio
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app  # noqa: E402
+from asgi import ThreadPoolASGI, run_wsgi  # noqa: E402
+from db import migrate  # noqa: E402
+
+
+def seed(path, devices, readings_per_device):
+    rng = np.random.default_rng(16)
+    conn = sqlite3.connect(path)
+    migrate(conn)
+    conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                     ((('device-{}'.format(device), 'temperature', int(value), 1635292800 + int(date))
+                       for device in range(devices)
+                       for value, date in zip(rng.integers(0, 101, readings_per_device),
+                                              rng.integers(0, 30 * 86400, readings_per_device)))))
+    conn.commit()
+    conn.close()
+
+
+def scope(method, path, query=b''):
+    return {'type': 'http', 'method': method, 'path': path, 'query_string': query, 'headers': [],
+            'http_version': '1.1'}
+
+
+def channel(body):
+    # An ASGI receive and send for one request, with the statuses sent
+    statuses = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            statuses.append(message['status'])
+
+    return receive, send, statuses
+
+
+async def threaded_request(pool, method, path, body=b'', query=b''):
+    loop = asyncio.get_running_loop()
+    receive, send, _ = channel(body)
+    return await loop.run_in_executor(pool, run_wsgi, app, scope(method, path, query), receive, send, loop)
+
+
+async def asgi_request(asgi_app, method, path, body=b'', query=b''):
+    receive, send, statuses = channel(body)
+    await asgi_app(scope(method, path, query), receive, send)
+    return statuses[0]
+
+
+async def load(request, summary_clients, post_clients, duration):
+    latencies = []
+    deadline = time.perf_counter() + duration
+
+    async def summaries():
+        while time.perf_counter() < deadline:
+            await request('GET', '/devices/summary/', query=b'start=1635300000&end=1637000000')
+
+    async def posts(client):
+        body = json.dumps([{'type': 'temperature', 'value': 20, 'date_created': 1635292800 + i}
+                           for i in range(10)]).encode()
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            status = await request('POST', '/devices/posting-{}/readings/'.format(client), body)
+            latencies.append(time.perf_counter() - started)
+            assert status == 201, status
+            await asyncio.sleep(0.005)
+
+    await asyncio.gather(*[summaries() for _ in range(summary_clients)],
+                         *[posts(client) for client in range(post_clients)])
+    latencies = np.array(latencies) * 1000
+    return {'posts': len(latencies), 'p50_ms': round(float(np.percentile(latencies, 50)), 2),
+            'p99_ms': round(float(np.percentile(latencies, 99)), 2)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--devices', type=int, default=2000)
+    parser.add_argument('--readings', type=int, default=100, help='readings per device')
+    parser.add_argument('--threads', type=int, default=8, help='threads of the threaded mode')
+    parser.add_argument('--summary-clients', type=int, default=8)
+    parser.add_argument('--post-clients', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per mode')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        app.config.update(TESTING=False, DATABASE=os.path.join(directory, 'load.db'))
+        seed(app.config['DATABASE'], args.devices, args.readings)
+
+        pool = ThreadPoolExecutor(max_workers=args.threads)
+        result = asyncio.run(load(lambda *a, **k: threaded_request(pool, *a, **k), args.summary_clients,
+                                  args.post_clients, args.duration))
+        pool.shutdown()
+        print(json.dumps(dict(mode='threaded', threads=args.threads, **result)))
+
+        asgi_app = ThreadPoolASGI(app, ingest_workers=args.threads // 2, analytics_workers=args.threads // 2)
+        result = asyncio.run(load(lambda *a, **k: asgi_request(asgi_app, *a, **k), args.summary_clients,
+                                  args.post_clients, args.duration))
+        asgi_app.close()
+        print(json.dumps(dict(mode='asyncio', ingest_workers=args.threads // 2,
+                              analytics_workers=args.threads // 2, **result)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+Cost on batched ingest of the triggers maintaining the derived tables.
+
+Readings are inserted with executemany in batches, one commit per batch,
+into a fresh database with no triggers, then with each trigger alone and
+with all of them, as every insert path runs. Run from the repo root:
+
+    python benchmarks/ingest_triggers.py
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db import INSERT_READING, PRAGMAS, migrate  # noqa: E402
+
+TRIGGERS = ('readings_rollups_insert', 'readings_histograms_insert', 'readings_watermarks_insert')
+
+
+def run(path, rows, batch_size, triggers):
+    conn = sqlite3.connect(path)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    migrate(conn)
+    for trigger in TRIGGERS:
+        if trigger not in triggers:
+            conn.execute('DROP TRIGGER ' + trigger)
+    conn.commit()
+    started = time.perf_counter()
+    for i in range(0, len(rows), batch_size):
+        conn.executemany(INSERT_READING, rows[i:i + batch_size])
+        conn.commit()
+    elapsed = time.perf_counter() - started
+    conn.close()
+    return {'triggers': list(triggers), 'readings': len(rows), 'elapsed_seconds': round(elapsed, 3),
+            'readings_per_second': round(len(rows) / elapsed)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--readings', type=int, default=200000)
+    parser.add_argument('--devices', type=int, default=1000)
+    parser.add_argument('--batch-size', type=int, default=5000)
+    args = parser.parse_args(argv)
+    rng = np.random.default_rng(7)
+    rows = list(zip(('device-{}'.format(device) for device in rng.integers(0, args.devices, args.readings)),
+                    ['temperature'] * args.readings, rng.integers(0, 101, args.readings).tolist(),
+                    (1635292800 + np.sort(rng.integers(0, 30 * 86400, args.readings))).tolist()))
+    cases = [()] + [(trigger,) for trigger in TRIGGERS] + [TRIGGERS]
+    with tempfile.TemporaryDirectory() as directory:
+        for i, triggers in enumerate(cases):
+            print(json.dumps(run(os.path.join(directory, 'ingest-{}.db'.format(i)), rows, args.batch_size,
+                                 triggers)))
+
+
+if __name__ == '__main__':
+    main()
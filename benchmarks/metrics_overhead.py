@@ -0,0 +1,58 @@
+"""
+Overhead of the request metrics on the POST path.
+
+Posts single readings through the Flask test client with METRICS on and
+off, in alternating rounds so both see the same database growth. Run from
+the repo root:
+
+    python benchmarks/metrics_overhead.py
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app  # noqa: E402
+
+
+def post_round(client, requests, offset):
+    started = time.perf_counter()
+    for i in range(requests):
+        response = client.post('/devices/device-{}/readings/'.format(i % 100), data=json.dumps(
+            {'type': 'temperature', 'value': i % 101, 'date_created': 1635292800 + offset + i}))
+        assert response.status_code == 201, response.status_code
+    return time.perf_counter() - started
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--requests', type=int, default=2000, help='posts per round')
+    parser.add_argument('--rounds', type=int, default=5, help='rounds per setting')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        app.config.update(TESTING=False, DATABASE=os.path.join(directory, 'overhead.db'))
+        client = app.test_client()
+        post_round(client, 200, 0)
+        elapsed = {True: [], False: []}
+        for i in range(args.rounds * 2):
+            enabled = i % 2 == 0
+            app.config['METRICS'] = enabled
+            elapsed[enabled].append(post_round(client, args.requests, (i + 1) * args.requests))
+
+    # The best round of each setting is the one least disturbed by the machine
+    best = {enabled: min(times) for enabled, times in elapsed.items()}
+    print(json.dumps({
+        'posts_per_round': args.requests,
+        'metrics_off_per_second': round(args.requests / best[False]),
+        'metrics_on_per_second': round(args.requests / best[True]),
+        'overhead_percent': round((best[True] / best[False] - 1) * 100, 2),
+    }))
+
+
+if __name__ == '__main__':
+    main()
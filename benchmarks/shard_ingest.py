@@ -0,0 +1,74 @@
+"""
+Ingest throughput of the batch POST endpoint by number of shards.
+
+Concurrent clients post batches of readings for random devices through
+the app, each shard taking its own write lock. Run from the repo root:
+
+    python benchmarks/shard_ingest.py --shards 1 2 4 8
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app  # noqa: E402
+from db import get_pool, shard_paths  # noqa: E402
+
+
+def run(shards, clients, requests_per_client, batch_size, directory):
+    app.config.update(TESTING=False, DATABASE=os.path.join(directory, 'bench-{}.db'.format(shards)), SHARDS=shards)
+    rng = np.random.default_rng(shards)
+    bodies = []
+    for _ in range(clients):
+        client_bodies = []
+        for _ in range(requests_per_client):
+            device_uuid = 'device-{}'.format(rng.integers(0, 100000))
+            readings = [{'type': 'temperature', 'value': int(value), 'date_created': 1635292800 + int(date)}
+                        for value, date in zip(rng.integers(0, 101, batch_size), rng.integers(0, 86400, batch_size))]
+            client_bodies.append((device_uuid, json.dumps(readings)))
+        bodies.append(client_bodies)
+
+    def post(client_bodies):
+        client = app.test_client()
+        for device_uuid, body in client_bodies:
+            response = client.post('/devices/{}/readings/'.format(device_uuid), data=body)
+            assert response.status_code == 201, response.status_code
+
+    # Open and migrate every shard before the clock starts
+    for path in shard_paths(app.config['DATABASE'], shards):
+        pool = get_pool(path)
+        pool.release(pool.acquire())
+
+    threads = [threading.Thread(target=post, args=(client_bodies,)) for client_bodies in bodies]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    readings = clients * requests_per_client * batch_size
+    return {'shards': shards, 'readings': readings, 'elapsed_seconds': round(elapsed, 3),
+            'readings_per_second': round(readings / elapsed)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=100, help='requests per client')
+    parser.add_argument('--batch-size', type=int, default=50)
+    args = parser.parse_args(argv)
+    with tempfile.TemporaryDirectory() as directory:
+        for shards in args.shards:
+            print(json.dumps(run(shards, args.clients, args.requests, args.batch_size, directory)))
+
+
+if __name__ == '__main__':
+    main()
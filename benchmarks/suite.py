@@ -0,0 +1,239 @@
+"""
+Benchmark every route against a generated fleet.
+
+A deterministic generator fills a SQLite database with the readings of
+many devices, then each route is driven through the Flask test client.
+Every route runs in a process of its own on a fresh copy of the database,
+so writes of one case never change the data of the next and the peak RSS
+is that of the case alone. Throughput, p50/p95/p99 latency and peak RSS
+are written per route to a JSON report, sorted and indented so two runs
+diff cleanly.
+Run from the repo root:
+
+    python benchmarks/suite.py --devices 1000 --readings 1000 --output bench_report.json
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app  # noqa: E402
+from db import INSERT_READING, migrate  # noqa: E402
+
+# Readings inserted per transaction while populating
+GENERATE_CHUNK_SIZE = 50000
+
+# First date of the generated readings
+EPOCH = 1609459200
+
+
+def device_uuid(device):
+    return 'device-{:06d}'.format(device)
+
+
+def generate_readings(seed, devices, readings_per_device, span, humidity_share):
+    """
+    Yield the same generated readings for the same arguments, in chunks.
+
+    Every device gets readings_per_device readings spread at random over
+    span seconds, a humidity_share of them humidity and the rest
+    temperature, with values following a per-device random walk.
+    """
+    rng = np.random.default_rng(seed)
+    chunk = []
+    for device in range(devices):
+        dates = EPOCH + np.sort(rng.integers(0, span, readings_per_device))
+        humidity = rng.random(readings_per_device) < humidity_share
+        values = np.clip(np.cumsum(rng.integers(-3, 4, readings_per_device)) + rng.integers(20, 80), 0, 100)
+        uuid = device_uuid(device)
+        chunk += [(uuid, 'humidity' if is_humidity else 'temperature', value, date)
+                  for is_humidity, value, date in zip(humidity.tolist(), values.tolist(), dates.tolist())]
+        if len(chunk) >= GENERATE_CHUNK_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def populate(path, **generator):
+    """Fill a new database with generated readings, returns the number of readings."""
+    conn = sqlite3.connect(path)
+    migrate(conn)
+    count = 0
+    for chunk in generate_readings(**generator):
+        conn.executemany(INSERT_READING, chunk)
+        conn.commit()
+        count += len(chunk)
+    conn.close()
+    return count
+
+
+def peak_rss_mib():
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def routes(rng, devices, span):
+    """
+    The requests of every route, as name -> function returning (method, url, body).
+
+    Windows are a random tenth of the span, the way dashboards ask.
+    """
+    def device():
+        return device_uuid(int(rng.integers(0, devices)))
+
+    def window():
+        start = EPOCH + int(rng.integers(0, span * 9 // 10))
+        return 'start={}&end={}'.format(start, start + span // 10)
+
+    def metric(name):
+        return lambda: ('GET', '/devices/{}/readings/{}/?type=temperature&{}'.format(device(), name, window()), None)
+
+    def post():
+        readings = [{'type': 'temperature', 'value': int(value), 'date_created': EPOCH + span + int(offset)}
+                    for value, offset in zip(rng.integers(0, 101, 10), rng.integers(0, 3600, 10))]
+        return 'POST', '/devices/{}/readings/'.format(device()), json.dumps(readings)
+
+    def query():
+        devices = sorted({device() for _ in range(100)})
+        start = EPOCH + int(rng.integers(0, span * 9 // 10))
+        return 'POST', '/devices/readings/query', json.dumps(
+            {'device_uuids': devices, 'type': 'temperature', 'start': start, 'end': start + span // 10, 'stats': True})
+
+    requests = {
+        'post_readings': post,
+        'readings_query': query,
+        'get_readings': lambda: ('GET', '/devices/{}/readings/'.format(device()), None),
+        'get_readings_filtered': lambda: ('GET', '/devices/{}/readings/?type=humidity&{}'.format(device(), window()),
+                                          None),
+        'get_readings_downsampled': lambda: ('GET', '/devices/{}/readings/?type=temperature&max_points=100'.format(
+            device()), None),
+        'get_readings_page': lambda: ('GET', '/devices/{}/readings/?limit=100'.format(device()), None),
+        'stats': metric('stats'),
+        'series': lambda: ('GET', '/devices/{}/readings/series/?type=temperature&interval=3600&{}'.format(
+            device(), window()), None),
+        'fleet_top': lambda: ('GET', '/devices/fleet/?type=temperature&k=50&' + window(), None),
+        'summary': lambda: ('GET', '/devices/summary/?type=temperature&' + window(), None),
+    }
+    for name in ('max', 'min', 'mean', 'median', 'mode', 'quartiles'):
+        requests[name] = metric(name)
+    return requests
+
+
+def run_route(client, request, iterations):
+    """Time a route over a number of requests and summarize the latencies."""
+    latencies = []
+    errors = 0
+    started = time.perf_counter()
+    for _ in range(iterations):
+        method, url, body = request()
+        begun = time.perf_counter()
+        response = client.open(url, method=method, data=body)
+        response.get_data()
+        latencies.append(time.perf_counter() - begun)
+        errors += response.status_code >= 400
+    elapsed = time.perf_counter() - started
+    latencies = np.array(latencies) * 1000
+    return {
+        'requests': iterations,
+        'errors': errors,
+        'throughput_per_second': round(iterations / elapsed, 1),
+        'p50_ms': round(float(np.percentile(latencies, 50)), 3),
+        'p95_ms': round(float(np.percentile(latencies, 95)), 3),
+        'p99_ms': round(float(np.percentile(latencies, 99)), 3),
+        'peak_rss_mib': peak_rss_mib(),
+    }
+
+
+def run_case(name, path, args):
+    """
+    Run one route against the database at path in a new process.
+
+    Returns the summary of run_route, with the peak RSS of that process.
+    """
+    command = [sys.executable, os.path.abspath(__file__), '--case', name, '--database', path,
+               '--devices', str(args.devices), '--span', str(args.span), '--seed', str(args.seed),
+               '--iterations', str(args.iterations)]
+    return json.loads(subprocess.run(command, capture_output=True, text=True, check=True).stdout)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--devices', type=int, default=1000)
+    parser.add_argument('--readings', type=int, default=1000, help='readings per device')
+    parser.add_argument('--span', type=int, default=30 * 86400, help='seconds the readings are spread over')
+    parser.add_argument('--humidity-share', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=18)
+    parser.add_argument('--iterations', type=int, default=200, help='requests per route')
+    parser.add_argument('--routes', nargs='+', help='only run these routes')
+    parser.add_argument('--database', help='reuse a database generated with the same arguments, it is only copied')
+    parser.add_argument('--output', default='bench_report.json')
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.case:
+        # Run one route on a copy made for it and print its summary
+        app.config.update(TESTING=False, DATABASE=args.database)
+        # Requests of a route are the same whichever other routes run
+        rng = np.random.default_rng([args.seed, zlib.crc32(args.case.encode())])
+        print(json.dumps(run_route(app.test_client(), routes(rng, args.devices, args.span)[args.case],
+                                   args.iterations)))
+        return
+
+    generator = {'seed': args.seed, 'devices': args.devices, 'readings_per_device': args.readings,
+                 'span': args.span, 'humidity_share': args.humidity_share}
+    with tempfile.TemporaryDirectory() as directory:
+        path = args.database or os.path.join(directory, 'bench.db')
+        started = time.perf_counter()
+        readings = populate(path, **generator) if not os.path.exists(path) else None
+        populate_seconds = round(time.perf_counter() - started, 1)
+
+        results = {}
+        for name in sorted(routes(None, args.devices, args.span)):
+            if args.routes and name not in args.routes:
+                continue
+            case_directory = os.path.join(directory, name)
+            os.mkdir(case_directory)
+            case_path = os.path.join(case_directory, 'bench.db')
+            shutil.copyfile(path, case_path)
+            results[name] = run_case(name, case_path, args)
+            shutil.rmtree(case_directory)
+            print(name, json.dumps(results[name]), file=sys.stderr)
+
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'generator': generator,
+        'readings': readings,
+        'populate_seconds': populate_seconds,
+        'iterations': args.iterations,
+        'routes': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+if __name__ == '__main__':
+    main()
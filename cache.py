@@ -0,0 +1,324 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from db import connection, database_path, database_paths
+from metrics import Counter
+from segments import has_readings
+
+# Bytes held per buffered reading, an int64 date and an int16 value
+BYTES_PER_READING = 10
+
+
+class RingBuffer:
+    """
+    The most recent readings of one device and type, in date order.
+
+    Dates and values live in two fixed size arrays used as a ring. The
+    buffer holds every reading dated since `since`; readings older than
+    that are dropped once they fall out of the ring or out of the horizon.
+    """
+
+    def __init__(self, capacity, horizon):
+        self.capacity = capacity
+        self.horizon = horizon
+        self.dates = np.zeros(capacity, dtype=np.int64)
+        self.values = np.zeros(capacity, dtype=np.int16)
+        self.start = 0
+        self.size = 0
+        self.since = -math.inf
+
+    def arrays(self):
+        """Copies of the buffered dates and values, oldest first."""
+        order = (self.start + np.arange(self.size)) % self.capacity
+        return self.dates[order], self.values[order]
+
+    def load(self, dates, values, complete):
+        """
+        Replace the contents with readings sorted by date.
+
+        complete tells whether these are all the readings there are; if
+        not, the buffer only vouches for dates after the oldest one.
+        """
+        dates = np.asarray(dates, dtype=np.int64)[-self.capacity:]
+        values = np.asarray(values, dtype=np.int16)[-self.capacity:]
+        self.size = len(dates)
+        self.start = 0
+        self.dates[:self.size] = dates
+        self.values[:self.size] = values
+        self.since = -math.inf if complete else (int(dates[0]) + 1 if self.size else math.inf)
+        self._trim()
+
+    def append(self, date_created, value):
+        """Add a reading, keeping the buffer in date order."""
+        if date_created < self.since:
+            return
+        newest = self.dates[(self.start + self.size - 1) % self.capacity] if self.size else None
+        if newest is None or date_created >= newest:
+            if self.size == self.capacity:
+                self.since = max(self.since, int(self.dates[self.start]) + 1)
+                self.start = (self.start + 1) % self.capacity
+                self.size -= 1
+            end = (self.start + self.size) % self.capacity
+            self.dates[end] = date_created
+            self.values[end] = value
+            self.size += 1
+        else:
+            # Out of order, rare enough to rebuild the ring around it
+            dates, values = self.arrays()
+            index = np.searchsorted(dates, date_created, side='right')
+            dates = np.insert(dates, index, date_created)
+            values = np.insert(values, index, value)
+            since = self.since
+            if len(dates) > self.capacity:
+                since = max(since, int(dates[0]) + 1)
+            self.load(dates, values, True)
+            # load may have trimmed readings behind the horizon, keep the later start
+            self.since = max(since, self.since)
+        self._trim()
+
+    def _trim(self):
+        # Drop readings that are older than the horizon behind the newest one
+        if not self.size:
+            return
+        dates, values = self.arrays()
+        cutoff = int(dates[-1]) - self.horizon
+        if dates[0] >= cutoff:
+            return
+        keep = np.searchsorted(dates, cutoff, side='left')
+        since = max(self.since, cutoff)
+        self.load(dates[keep:], values[keep:], True)
+        self.since = since
+
+    def window(self, start_time, end_time):
+        """
+        The dates and values in [start_time, end_time], either end open.
+
+        Returns None if the buffer cannot vouch for the whole window.
+        """
+        if (start_time is None and self.since != -math.inf) or (start_time is not None and start_time < self.since):
+            return None
+        dates, values = self.arrays()
+        low = 0 if start_time is None else np.searchsorted(dates, start_time, side='left')
+        high = len(dates) if end_time is None else np.searchsorted(dates, end_time, side='right')
+        return dates[low:high], values[low:high]
+
+
+class HotTier:
+    """
+    Ring buffers of the recent readings of the most active devices.
+
+    Buffers are kept per (device_uuid, type) within a global memory
+    budget, evicting the least recently used one when it is exceeded.
+    The tier only sees readings committed by this process, so it should
+    only be enabled where one process owns all writes.
+    """
+
+    def __init__(self, capacity=1024, horizon=3600, budget=64 * 1024 * 1024):
+        self.capacity = capacity
+        self.horizon = horizon
+        self.max_buffers = max(1, budget // (capacity * BYTES_PER_READING))
+        self._buffers = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _load(self, cur, device_uuid, sensor_type):
+        # Read the latest readings of a device and type into a new buffer
+        cur.execute('select date_created, value from readings where device_uuid = ? and type = ? '
+                    'order by date_created desc, rowid desc limit ?', (device_uuid, sensor_type, self.capacity))
+        rows = cur.fetchall()[::-1]
+        buffer = RingBuffer(self.capacity, self.horizon)
+        complete = len(rows) < self.capacity and not has_readings(cur, device_uuid, sensor_type)
+        buffer.load([row[0] for row in rows], [row[1] for row in rows], complete)
+        return buffer
+
+    def _put(self, key, buffer):
+        self._buffers[key] = buffer
+        self._buffers.move_to_end(key)
+        while len(self._buffers) > self.max_buffers:
+            self._buffers.popitem(last=False)
+
+    def warm(self, cur):
+        """Load the buffers of the most recently active devices."""
+        cur.execute('select device_uuid, type from readings group by device_uuid, type '
+                    'order by max(date_created) desc limit ?', (self.max_buffers,))
+        keys = [tuple(row) for row in cur.fetchall()]
+        for device_uuid, sensor_type in reversed(keys):
+            buffer = self._load(cur, device_uuid, sensor_type)
+            with self._lock:
+                self._put((device_uuid, sensor_type), buffer)
+
+    def add(self, cur, rows):
+        """
+        Add rows of (device_uuid, type, value, date_created) just committed.
+
+        Devices without a buffer are loaded from the db, which already
+        holds the new rows.
+        """
+        missing = set()
+        with self._lock:
+            for device_uuid, sensor_type, value, date_created in rows:
+                buffer = self._buffers.get((device_uuid, sensor_type))
+                if buffer is None:
+                    missing.add((device_uuid, sensor_type))
+                else:
+                    buffer.append(date_created, value)
+                    self._buffers.move_to_end((device_uuid, sensor_type))
+        for device_uuid, sensor_type in missing:
+            buffer = self._load(cur, device_uuid, sensor_type)
+            with self._lock:
+                self._put((device_uuid, sensor_type), buffer)
+
+    def window(self, device_uuid, sensor_type, start_time, end_time):
+        """
+        The dates and values of a device over a window, from its buffer.
+
+        Returns None if the device is not buffered or the window reaches
+        further back than its buffer.
+        """
+        with self._lock:
+            buffer = self._buffers.get((device_uuid, sensor_type))
+            if buffer is None:
+                return None
+            self._buffers.move_to_end((device_uuid, sensor_type))
+            return buffer.window(None if start_time is None else int(start_time),
+                                 None if end_time is None else int(end_time))
+
+
+class ResultCache:
+    """
+    A bounded LRU cache of endpoint results with a time to live.
+
+    Results are keyed on (endpoint, device_uuid, type, start, end) and
+    dropped as soon as a reading of that device and type is committed
+    inside their window. Writes from other processes are not seen, the
+    ttl bounds how stale a result can get.
+    """
+
+    def __init__(self, size=1024, ttl=60):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._series = {}
+        self._generations = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _drop(self, key):
+        self._entries.pop(key, None)
+        keys = self._series.get(key[1:3])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._series[key[1:3]]
+
+    def get(self, key):
+        """The cached result of a key, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self._drop(key)
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def generation(self, device_uuid, sensor_type):
+        """A token that changes whenever results of a device and type are invalidated."""
+        with self._lock:
+            return self._generations.get((device_uuid, sensor_type), 0)
+
+    def put(self, key, result, generation):
+        """
+        Cache a result computed when the series was at the given generation.
+
+        Results that were invalidated while being computed are not cached.
+        """
+        with self._lock:
+            if self._generations.get(key[1:3], 0) != generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, result)
+            self._entries.move_to_end(key)
+            self._series.setdefault(key[1:3], set()).add(key)
+            while len(self._entries) > self.size:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, rows):
+        """Drop the results whose window holds any of the rows of (device_uuid, type, value, date_created)."""
+        with self._lock:
+            for device_uuid, sensor_type, _, date_created in rows:
+                series = (device_uuid, sensor_type)
+                self._generations[series] = self._generations.get(series, 0) + 1
+                for key in list(self._series.get(series, ())):
+                    start_time, end_time = key[3:]
+                    if (start_time is None or start_time <= date_created) and \
+                            (end_time is None or date_created <= end_time):
+                        self._drop(key)
+                        self.invalidations += 1
+
+    def stats(self):
+        """The hit, miss, eviction and invalidation counters and the current size."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'invalidations': self.invalidations, 'size': len(self._entries)}
+
+
+_tiers_lock = threading.Lock()
+
+
+def get_hot_tier(app, create=True):
+    """
+    Return the hot tier of an app's database.
+
+    The tier is created and warmed from the db on first use, unless create
+    is False in which case None is returned.
+    """
+    path = database_path(app)
+    tiers = app.extensions.setdefault('hot_tier', {})
+    with _tiers_lock:
+        tier = tiers.get(path)
+        if tier is None and create:
+            tier = HotTier(app.config['HOT_TIER_CAPACITY'], app.config['HOT_TIER_HORIZON'],
+                           app.config['HOT_TIER_BUDGET'])
+            for shard_path in database_paths(app):
+                with connection(shard_path) as conn:
+                    tier.warm(conn.cursor())
+            tiers[path] = tier
+    return tier
+
+
+def result_cache_metrics(app):
+    """The counters of the result caches of an app as Prometheus lines."""
+    counters = {
+        'hits': Counter('sensor_result_cache_hits_total', 'Results served from the result cache.', ['database']),
+        'misses': Counter('sensor_result_cache_misses_total', 'Results not found in the result cache.', ['database']),
+        'evictions': Counter('sensor_result_cache_evictions_total', 'Results evicted by size or age.', ['database']),
+        'invalidations': Counter('sensor_result_cache_invalidations_total',
+                                 'Results dropped by a write inside their window.', ['database']),
+    }
+    for path, cache in list(app.extensions.get('result_cache', {}).items()):
+        stats = cache.stats()
+        for name, counter in counters.items():
+            counter.inc(path, amount=stats[name])
+    return [line for counter in counters.values() for line in counter.expose()]
+
+
+def get_result_cache(app):
+    """Return the result cache of an app's database, creating it on first use."""
+    path = database_path(app)
+    caches = app.extensions.setdefault('result_cache', {})
+    with _tiers_lock:
+        cache = caches.get(path)
+        if cache is None:
+            cache = caches[path] = ResultCache(app.config['RESULT_CACHE_SIZE'], app.config['RESULT_CACHE_TTL'])
+    return cache
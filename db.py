@@ -0,0 +1,512 @@
+import os
+import queue
+import sqlite3
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from flask import current_app, g
+
+from metrics import record_phase, record_sql
+
+# Columns of a reading, in the order they are returned to clients
+READING_COLUMNS = ['device_uuid', 'type', 'value', 'date_created']
+
+# Statement inserting one reading, used with executemany for batches
+INSERT_READING = 'insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)'
+
+# Start of the bucket of width {1} holding the date {0}. SQLite's % truncates
+# toward zero, so take the floor modulo to bucket dates before the epoch the
+# way the read paths do with Python's //
+BUCKET = '({0} - (({0} % {1}) + {1}) % {1})'
+
+# Histogram bin of a reading value. Values are integers from 0 to 100, older
+# databases may hold readings from before they were validated, so round and clamp
+HISTOGRAM_BIN = 'max(0, min(100, CAST(round({}) AS INTEGER)))'
+
+# Schema statements, each safe to run again on an up to date database
+MIGRATIONS = [
+    'CREATE TABLE IF NOT EXISTS readings (device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)',
+    # Per-device reads filter on device, then type, then a date range
+    'CREATE INDEX IF NOT EXISTS readings_device_type_date_idx ON readings (device_uuid, type, date_created)',
+    # Covering variant so reads and aggregates over value never touch the table
+    'CREATE INDEX IF NOT EXISTS readings_device_type_date_value_idx '
+    'ON readings (device_uuid, type, date_created, value)',
+    # Fleet queries filter on type and a date range, then rank or threshold on value
+    'CREATE INDEX IF NOT EXISTS readings_type_date_value_idx ON readings (type, date_created, value, device_uuid)',
+    # Count, sum, min and max per device, type and minute/hour/day bucket
+    'CREATE TABLE IF NOT EXISTS readings_rollups (device_uuid TEXT, type TEXT, granularity INTEGER, '
+    'bucket INTEGER, value_count INTEGER, value_sum INTEGER, value_min INTEGER, value_max INTEGER, '
+    'PRIMARY KEY (device_uuid, type, granularity, bucket)) WITHOUT ROWID',
+    # Keep the rollups up to date with every insert, whichever path it comes from
+    'CREATE TRIGGER IF NOT EXISTS readings_rollups_insert AFTER INSERT ON readings BEGIN '
+    'INSERT INTO readings_rollups (device_uuid, type, granularity, bucket, value_count, value_sum, value_min, '
+    'value_max) SELECT NEW.device_uuid, NEW.type, column1, ' + BUCKET.format('NEW.date_created', 'column1') + ', 1, '
+    'NEW.value, NEW.value, NEW.value FROM (VALUES (60), (3600), (86400)) WHERE true '
+    'ON CONFLICT (device_uuid, type, granularity, bucket) DO UPDATE SET value_count = value_count + 1, '
+    'value_sum = value_sum + excluded.value_sum, value_min = min(value_min, excluded.value_min), '
+    'value_max = max(value_max, excluded.value_max); END',
+    # Count of each value per device, type and hour bucket
+    'CREATE TABLE IF NOT EXISTS readings_histograms (device_uuid TEXT, type TEXT, bucket INTEGER, '
+    'value INTEGER, value_count INTEGER, PRIMARY KEY (device_uuid, type, bucket, value)) WITHOUT ROWID',
+    'CREATE TRIGGER IF NOT EXISTS readings_histograms_insert AFTER INSERT ON readings BEGIN '
+    'INSERT INTO readings_histograms (device_uuid, type, bucket, value, value_count) '
+    'VALUES (NEW.device_uuid, NEW.type, ' + BUCKET.format('NEW.date_created', 3600) + ', '
+    + HISTOGRAM_BIN.format('NEW.value') + ', 1) '
+    'ON CONFLICT (device_uuid, type, bucket, value) DO UPDATE SET value_count = value_count + 1; END',
+    # Write watermark per device and type: readings inserted, last rowid and when
+    'CREATE TABLE IF NOT EXISTS readings_watermarks (device_uuid TEXT, type TEXT, writes INTEGER, '
+    'last_rowid INTEGER, modified_at INTEGER, PRIMARY KEY (device_uuid, type)) WITHOUT ROWID',
+    'CREATE TRIGGER IF NOT EXISTS readings_watermarks_insert AFTER INSERT ON readings BEGIN '
+    'INSERT INTO readings_watermarks (device_uuid, type, writes, last_rowid, modified_at) '
+    "VALUES (NEW.device_uuid, NEW.type, 1, NEW.rowid, CAST(strftime('%s', 'now') AS INTEGER)) "
+    'ON CONFLICT (device_uuid, type) DO UPDATE SET writes = writes + 1, last_rowid = excluded.last_rowid, '
+    'modified_at = excluded.modified_at; END',
+    # Columnar segments of compacted readings, with the zone map of each
+    'CREATE TABLE IF NOT EXISTS readings_segments (name TEXT PRIMARY KEY, partition INTEGER, row_count INTEGER, '
+    'date_min INTEGER, date_max INTEGER, value_min INTEGER, value_max INTEGER)',
+]
+
+# Statements filling a derived table from readings when it is first created
+BACKFILLS = [
+    ('readings_rollups',
+     'INSERT INTO readings_rollups (device_uuid, type, granularity, bucket, value_count, value_sum, value_min, '
+     'value_max) SELECT device_uuid, type, column1, ' + BUCKET.format('date_created', 'column1') + ', count(*), '
+     'sum(value), min(value), max(value) FROM readings, (VALUES (60), (3600), (86400)) '
+     'GROUP BY 1, 2, 3, 4'),
+    ('readings_histograms',
+     'INSERT INTO readings_histograms (device_uuid, type, bucket, value, value_count) '
+     'SELECT device_uuid, type, ' + BUCKET.format('date_created', 3600) + ', ' + HISTOGRAM_BIN.format('value')
+     + ', count(*) FROM readings GROUP BY 1, 2, 3, 4'),
+    ('readings_watermarks',
+     'INSERT INTO readings_watermarks (device_uuid, type, writes, last_rowid, modified_at) '
+     "SELECT device_uuid, type, count(*), max(rowid), CAST(strftime('%s', 'now') AS INTEGER) FROM readings "
+     'GROUP BY device_uuid, type'),
+]
+
+
+# Settings applied to every pooled connection when it is opened
+PRAGMAS = [
+    # Readers keep going while a writer commits
+    'PRAGMA journal_mode=WAL',
+    # WAL is still crash safe with fewer fsyncs
+    'PRAGMA synchronous=NORMAL',
+    # 64 MiB page cache per connection
+    'PRAGMA cache_size=-65536',
+    # Map up to 256 MiB of the database file
+    'PRAGMA mmap_size=268435456',
+    # Wait for the write lock instead of failing straight away
+    'PRAGMA busy_timeout=5000',
+]
+
+# Idle connections kept open per database file
+POOL_SIZE = 8
+
+# Threads querying shards in parallel for fleet wide reads
+FAN_OUT_WORKERS = 8
+
+
+# Histogram rows written before values were binned, moved to their bin on migration
+NORMALIZE_HISTOGRAMS = [
+    'CREATE TEMP TABLE legacy_histograms AS SELECT * FROM readings_histograms '
+    "WHERE typeof(value) != 'integer' OR value NOT BETWEEN 0 AND 100",
+    "DELETE FROM readings_histograms WHERE typeof(value) != 'integer' OR value NOT BETWEEN 0 AND 100",
+    'INSERT INTO readings_histograms (device_uuid, type, bucket, value, value_count) '
+    'SELECT device_uuid, type, bucket, ' + HISTOGRAM_BIN.format('value') + ', sum(value_count) '
+    'FROM legacy_histograms WHERE true GROUP BY device_uuid, type, bucket, ' + HISTOGRAM_BIN.format('value') + ' '
+    'ON CONFLICT (device_uuid, type, bucket, value) DO UPDATE SET value_count = value_count + excluded.value_count',
+    'DROP TABLE legacy_histograms',
+]
+
+
+# Rollup buckets from before dates were floor bucketed. Readings dated before
+# the epoch were counted in the bucket after theirs, so every bucket up to the
+# epoch is rebuilt from the readings
+REBUCKET_ROLLUPS = [
+    'DELETE FROM readings_rollups WHERE bucket <= 0',
+    'INSERT INTO readings_rollups (device_uuid, type, granularity, bucket, value_count, value_sum, value_min, '
+    'value_max) SELECT device_uuid, type, column1, ' + BUCKET.format('date_created', 'column1') + ', count(*), '
+    'sum(value), min(value), max(value) FROM readings, (VALUES (60), (3600), (86400)) '
+    'WHERE date_created < column1 GROUP BY 1, 2, 3, 4',
+]
+
+# Histogram buckets from before dates were floor bucketed, rebuilt like the rollups
+REBUCKET_HISTOGRAMS = [
+    'DELETE FROM readings_histograms WHERE bucket <= 0',
+    'INSERT INTO readings_histograms (device_uuid, type, bucket, value, value_count) '
+    'SELECT device_uuid, type, ' + BUCKET.format('date_created', 3600) + ', ' + HISTOGRAM_BIN.format('value')
+    + ', count(*) FROM readings WHERE date_created < 3600 GROUP BY 1, 2, 3, 4',
+]
+
+# Fixes to run on the derived table of a trigger when an older version of it is replaced
+TRIGGER_UPGRADES = {
+    'readings_rollups_insert': REBUCKET_ROLLUPS,
+    'readings_histograms_insert': NORMALIZE_HISTOGRAMS + REBUCKET_HISTOGRAMS,
+}
+
+
+def migrate(conn):
+    """Bring the schema of an open connection up to date."""
+    tables = {row[0] for row in conn.execute("select name from sqlite_master where type = 'table'")}
+    triggers = dict(conn.execute("select name, sql from sqlite_master where type = 'trigger'").fetchall())
+    for statement in MIGRATIONS:
+        if statement.startswith('CREATE TRIGGER IF NOT EXISTS '):
+            name = statement.split()[5]
+            if name in triggers and triggers[name] != statement.replace(' IF NOT EXISTS', '', 1):
+                # The trigger changed since this database was migrated, replace it
+                conn.execute('DROP TRIGGER ' + name)
+                for fix in TRIGGER_UPGRADES.get(name, []):
+                    conn.execute(fix)
+        conn.execute(statement)
+    for table, statement in BACKFILLS:
+        if table not in tables:
+            conn.execute(statement)
+    conn.commit()
+
+
+def drop_tables(conn):
+    """Drop readings, its segment catalog and every table derived from it."""
+    conn.execute('DROP TABLE IF EXISTS readings')
+    conn.execute('DROP TABLE IF EXISTS readings_segments')
+    for table, _ in BACKFILLS:
+        conn.execute('DROP TABLE IF EXISTS ' + table)
+    conn.commit()
+
+
+# Rows fetched at a time when an instrumented cursor is iterated
+CURSOR_ITER_ROWS = 1000
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """
+    A cursor adding its SQL time, statements and fetched rows to the request metrics.
+
+    Iterating it fetches CURSOR_ITER_ROWS rows at a time, so rows read by
+    iteration are counted without timing every row.
+    """
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_sql(time.perf_counter() - started, statements=1)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record_sql(time.perf_counter() - started, statements=1)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        record_sql(time.perf_counter() - started, rows=row is not None)
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        record_sql(time.perf_counter() - started, rows=len(rows))
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        record_sql(time.perf_counter() - started, rows=len(rows))
+        return rows
+
+    def __iter__(self):
+        while True:
+            rows = self.fetchmany(CURSOR_ITER_ROWS)
+            if not rows:
+                return
+            yield from rows
+
+    def __next__(self):
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration
+        return row
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """A connection whose cursors, including those of execute shortcuts, are instrumented."""
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+class ConnectionPool:
+    """
+    A pool of long-lived connections to one database file.
+
+    Connections are opened, configured and migrated once, then handed out
+    to one thread at a time and returned to the pool when released.
+    """
+
+    def __init__(self, path, size=POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue()
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, factory=InstrumentedConnection)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        migrate(conn)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def acquire(self):
+        """Take an idle connection, opening a new one if there is none."""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._open()
+
+    def release(self, conn):
+        """Return a connection, closing it if the pool is already full."""
+        if conn.in_transaction:
+            conn.rollback()
+        if self._idle.qsize() < self.size:
+            self._idle.put(conn)
+        else:
+            conn.close()
+
+    def close(self):
+        """Close every idle connection."""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+_pools = {}
+
+
+def get_pool(path):
+    """Return the connection pool for a database file."""
+    pool = _pools.get(path)
+    if pool is None:
+        pool = _pools.setdefault(path, ConnectionPool(path))
+    return pool
+
+
+@contextmanager
+def connection(path):
+    """Borrow a pooled connection outside of a request."""
+    pool = get_pool(path)
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+
+def shard_index(device_uuid, shards):
+    """The shard holding the readings of a device, stable across processes."""
+    return zlib.crc32(device_uuid.encode('utf-8')) % shards
+
+
+def shard_paths(path, shards):
+    """The files of a database split into a number of shards."""
+    if shards == 1:
+        return [path]
+    root, ext = os.path.splitext(path)
+    return ['{}.shard-{}-of-{}{}'.format(root, i, shards, ext) for i in range(shards)]
+
+
+def database_paths(app):
+    """Every database file an app is configured to use, one per shard."""
+    path = app.config['TEST_DATABASE'] if app.config['TESTING'] else app.config['DATABASE']
+    return shard_paths(path, app.config['SHARDS'])
+
+
+def database_path(app, device_uuid=None):
+    """
+    The database file an app is configured to use.
+
+    With more than one shard, this is the shard of device_uuid; without a
+    device it is the unsharded path, only good as a key for the database.
+    """
+    path = app.config['TEST_DATABASE'] if app.config['TESTING'] else app.config['DATABASE']
+    shards = app.config['SHARDS']
+    if device_uuid is None or shards == 1:
+        return path
+    return shard_paths(path, shards)[shard_index(device_uuid, shards)]
+
+
+def get_shard_db(path):
+    """Return the pooled connection to a database file for the current app context."""
+    dbs = g.setdefault('dbs', {})
+    conn = dbs.get(path)
+    if conn is None:
+        started = time.perf_counter()
+        conn = dbs[path] = get_pool(path).acquire()
+        record_phase('connect', time.perf_counter() - started)
+    return conn
+
+
+def get_db(device_uuid=None):
+    """Return the pooled connection of the current app context to the shard of a device."""
+    return get_shard_db(database_path(current_app, device_uuid))
+
+
+def release_db(exception=None):
+    """Give the connections of the current app context back to their pools."""
+    for path, conn in g.pop('dbs', {}).items():
+        get_pool(path).release(conn)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def fan_out(paths, query):
+    """
+    Run query(cursor) against every database file in parallel threads.
+
+    Each thread borrows a pooled connection of its own. Returns the
+    results in the order of paths.
+    """
+    global _executor
+    if len(paths) == 1:
+        with connection(paths[0]) as conn:
+            return [query(conn.cursor())]
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=FAN_OUT_WORKERS, thread_name_prefix='fan-out')
+
+    def run(path):
+        with connection(path) as conn:
+            return query(conn.cursor())
+    return list(_executor.map(run, paths))
+
+
+def init_app(app):
+    """Register the database settings and teardown on an app."""
+    app.config.setdefault('DATABASE', 'database.db')
+    app.config.setdefault('TEST_DATABASE', 'test_database.db')
+    app.config.setdefault('SHARDS', 1)
+    app.teardown_appcontext(release_db)
+
+
+# Devices matched per statement by a multi-device read, within SQLite's variable limit
+DEVICES_CHUNK_SIZE = 500
+
+
+def _window_filters(query, params, sensor_type, start_time, end_time):
+    # Add the type and date filters that are set to a query on readings
+    if sensor_type is not None:
+        query += ' and type = ?'
+        params.append(sensor_type)
+    if start_time is not None:
+        query += ' and date_created >= ?'
+        params.append(int(start_time))
+    if end_time is not None:
+        query += ' and date_created <= ?'
+        params.append(int(end_time))
+    return query, params
+
+
+def request_query(device_uuid, sensor_type, start_time, end_time, columns=READING_COLUMNS):
+    """
+    Build the query for the readings of one device.
+
+    Returns a tuple of (query, params). Only the filters that are set are
+    added, so there are few distinct query texts and sqlite3 can reuse its
+    cached statements. Columns can be swapped for aggregate expressions.
+    """
+    return _window_filters('select ' + ', '.join(columns) + ' from readings where device_uuid = ?', [device_uuid],
+                           sensor_type, start_time, end_time)
+
+
+def request_devices_query(device_uuids, sensor_type, start_time, end_time, columns=READING_COLUMNS):
+    """
+    Build the query for the readings of many devices, by device then date.
+
+    The devices are matched with an IN list, which SQLite resolves with a
+    lookup of the device index per device. Keep the list within
+    DEVICES_CHUNK_SIZE. Returns a tuple of (query, params).
+    """
+    query, params = _window_filters('select ' + ', '.join(columns) + ' from readings where device_uuid in ('
+                                    + ', '.join('?' * len(device_uuids)) + ')', list(device_uuids),
+                                    sensor_type, start_time, end_time)
+    return query + ' order by device_uuid, date_created, rowid', params
+
+
+def request_page_query(device_uuid, sensor_type, start_time, end_time, after=None, columns=READING_COLUMNS):
+    """
+    Build the keyset ordered query for the readings of one device.
+
+    Readings are ordered by (date_created, rowid). after is the key of the
+    last reading already seen, as parsed by parse_cursor, and the query
+    starts right after it. Returns a tuple of (query, params).
+    """
+    query, params = request_query(device_uuid, sensor_type, start_time, end_time, columns)
+    if after is not None:
+        query += ' and (date_created, rowid) > (?, ?)'
+        params.extend(after)
+    return query + ' order by date_created, rowid', params
+
+
+# SQL of every aggregate of a bucketed series
+SERIES_COLUMNS = {'mean': 'avg(value)', 'min': 'min(value)', 'max': 'max(value)', 'count': 'count(*)'}
+
+
+def request_series_query(device_uuid, sensor_type, start_time, end_time, interval, aggregates):
+    """
+    Build the query reducing the readings of one device to fixed time buckets.
+
+    Rows are the start of a bucket followed by the aggregates, in order,
+    one row per non-empty bucket in date order. Returns a tuple of
+    (query, params).
+    """
+    columns = [BUCKET.format('date_created', '?')] + [SERIES_COLUMNS[aggregate] for aggregate in aggregates]
+    query, params = request_query(device_uuid, sensor_type, start_time, end_time, columns)
+    return query + ' group by 1 order by 1', [interval] * 3 + params
+
+
+def write_watermark(cur, device_uuid, sensor_type):
+    """
+    The write watermark of a device and type, or of all its types.
+
+    Returns a tuple of (writes, last_rowid, modified_at), all 0 when the
+    device has no readings. writes only grows, so it changes with every
+    insert. Read from readings_watermarks alone, never from readings.
+    """
+    query = 'select sum(writes), max(last_rowid), max(modified_at) from readings_watermarks where device_uuid = ?'
+    params = [device_uuid]
+    if sensor_type is not None:
+        query += ' and type = ?'
+        params.append(sensor_type)
+    cur.execute(query, params)
+    return tuple(value or 0 for value in cur.fetchone())
+
+
+def format_cursor(date_created, rowid):
+    """Encode the key of a reading as a pagination cursor."""
+    return '{}:{}'.format(date_created, rowid)
+
+
+def parse_cursor(cursor):
+    """Decode a pagination cursor, raising ValueError if it is malformed."""
+    date_created, rowid = cursor.split(':')
+    return int(date_created), int(rowid)
+
+
+# Columns for the reading with the max or min value. SQLite fills the bare
+# columns from the row the aggregate picked.
+MAX_READING_COLUMNS = ['device_uuid', 'type', 'max(value) as value', 'date_created']
+MIN_READING_COLUMNS = ['device_uuid', 'type', 'min(value) as value', 'date_created']
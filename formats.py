@@ -0,0 +1,141 @@
+import csv
+import io
+import itertools
+import json
+import struct
+
+import numpy as np
+
+# Rows read from the db per chunk of a streamed response
+FETCH_SIZE = 500
+
+JSON_MIMETYPE = 'application/json'
+NDJSON_MIMETYPE = 'application/x-ndjson'
+COLUMNS_MIMETYPE = 'application/vnd.sensor.columns+json'
+CSV_MIMETYPE = 'text/csv'
+BINARY_MIMETYPE = 'application/vnd.sensor.columns'
+
+# First bytes of the binary format, followed by its version
+BINARY_MAGIC = b'SNSR'
+BINARY_VERSION = 1
+
+
+def iter_batches(cur, size=FETCH_SIZE):
+    """Yield the remaining rows of a cursor in lists of at most size rows."""
+    while True:
+        rows = cur.fetchmany(size)
+        if not rows:
+            return
+        yield rows
+
+
+def iter_row_batches(rows, size=FETCH_SIZE):
+    """Yield the rows of an iterable in lists of at most size rows."""
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def stream_json_array(batches, columns):
+    """Stream batches of rows as a JSON array of objects, batch by batch."""
+    yield '['
+    separator = ''
+    for rows in batches:
+        yield separator + ','.join(json.dumps(dict(zip(columns, row))) for row in rows)
+        separator = ','
+    yield ']'
+
+
+def stream_ndjson(batches, columns):
+    """Stream batches of rows as NDJSON, one object per line."""
+    for rows in batches:
+        yield ''.join(json.dumps(dict(zip(columns, row))) + '\n' for row in rows)
+
+
+def iter_columns(batches):
+    """Turn batches of rows into batches of column arrays, one array per column."""
+    for rows in batches:
+        if rows:
+            yield [np.asarray(column) for column in zip(*rows)]
+
+
+def stream_columns_json(column_batches, columns):
+    """
+    Encode column batches as one JSON object of a list per column.
+
+    The lists are only complete once every batch is read, so the object
+    is written at the end, but no per-row objects are ever built.
+    """
+    parts = [[] for _ in columns]
+    for batch in column_batches:
+        for part, column in zip(parts, batch):
+            part.append(column)
+    yield '{' + ','.join('{}:{}'.format(json.dumps(name), json.dumps(np.concatenate(part).tolist() if part else []))
+                         for name, part in zip(columns, parts)) + '}'
+
+
+def stream_csv(column_batches, columns):
+    """Stream column batches as CSV with a header line, batch by batch."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(columns)
+    for batch in column_batches:
+        writer.writerows(zip(*(column.tolist() for column in batch[:len(columns)])))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _binary_strings(strings):
+    # uint32 count, then a uint16 length and the UTF-8 bytes of every string
+    encoded = [string.encode('utf-8') for string in strings]
+    return struct.pack('<I', len(encoded)) + b''.join(struct.pack('<H', len(e)) + e for e in encoded)
+
+
+def stream_binary(column_batches, columns):
+    """
+    Stream column batches in a compact little-endian binary layout.
+
+    The header is BINARY_MAGIC, a uint8 version and the column names as
+    counted strings. Every batch is then a frame of a uint32 row count and
+    one block per column: a tag byte, then for b'i' an int64 array, for
+    b'f' a float64 array and for b's' a dictionary of counted strings
+    followed by a uint32 array of codes. A frame of 0 rows ends the stream.
+    Counted strings are a uint32 count of uint16 length-prefixed UTF-8 strings.
+    """
+    yield BINARY_MAGIC + struct.pack('<B', BINARY_VERSION) + _binary_strings(columns)
+    for batch in column_batches:
+        if len(batch[0]) == 0:
+            # Only the last frame may be empty
+            continue
+        blocks = [struct.pack('<I', len(batch[0]))]
+        for column in batch[:len(columns)]:
+            if column.dtype.kind in 'iub':
+                blocks += [b'i', column.astype('<i8').tobytes()]
+            elif column.dtype.kind == 'f':
+                blocks += [b'f', column.astype('<f8').tobytes()]
+            else:
+                dictionary, codes = np.unique(column.astype(str), return_inverse=True)
+                blocks += [b's', _binary_strings(dictionary.tolist()), codes.astype('<u4').tobytes()]
+        yield b''.join(blocks)
+    yield struct.pack('<I', 0)
+
+
+# Encoders of column batches by response mimetype
+COLUMN_ENCODERS = {
+    COLUMNS_MIMETYPE: stream_columns_json,
+    CSV_MIMETYPE: stream_csv,
+    BINARY_MIMETYPE: stream_binary,
+}
+
+# Streaming encoders of row batches by response mimetype, the first one is the default
+STREAM_ENCODERS = {
+    JSON_MIMETYPE: stream_json_array,
+    NDJSON_MIMETYPE: stream_ndjson,
+}
+for _mimetype, _encoder in COLUMN_ENCODERS.items():
+    STREAM_ENCODERS[_mimetype] = lambda batches, columns, encoder=_encoder: encoder(iter_columns(batches), columns)
@@ -0,0 +1,313 @@
+import atexit
+import json
+import logging
+import numbers
+import queue
+import threading
+import time
+
+import numpy as np
+
+from db import INSERT_READING, connection, database_path
+
+logger = logging.getLogger(__name__)
+
+# Sensor types and value range accepted by the API
+VALID_TYPES = ('temperature', 'humidity')
+MIN_VALUE = 0
+MAX_VALUE = 100
+# Epoch dates accepted by the API, non-negative and within SQLite's int64
+MIN_DATE = 0
+MAX_DATE = 2 ** 63 - 1
+
+# Content types that carry one JSON reading per line
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonl')
+
+# Readings inserted and committed together by the bulk endpoint
+BULK_CHUNK_SIZE = 1000
+# Rejected lines reported back by the bulk endpoint
+BULK_MAX_ERRORS = 100
+
+def parse_readings_body(data, mimetype):
+    """
+    Decode a POST body into a list of readings.
+
+    Returns a tuple of (readings, is_batch). A plain JSON object is a
+    single reading, a JSON array or an NDJSON body is a batch. NDJSON
+    lines that cannot be decoded are kept as None so they are rejected
+    per item instead of failing the whole batch.
+    """
+    if mimetype in NDJSON_MIMETYPES:
+        readings = []
+        for line in data.splitlines():
+            if not line.strip():
+                continue
+            try:
+                readings.append(json.loads(line))
+            except ValueError:
+                readings.append(None)
+        return readings, True
+
+    post_data = json.loads(data)
+    if isinstance(post_data, list):
+        return post_data, True
+    return [post_data], False
+
+
+def _is_integer(value):
+    return isinstance(value, numbers.Integral) and not isinstance(value, bool)
+
+
+def _column(readings, field, default):
+    # Object array of one field across the batch, None for non-object items
+    return np.fromiter((r.get(field, default) if isinstance(r, dict) else None for r in readings),
+                       dtype=object, count=len(readings))
+
+
+def validate_readings(readings, default_date):
+    """
+    Validate a batch of readings in one pass.
+
+    The fields of every reading are pulled into column arrays and checked
+    with vectorized masks. Returns a tuple of (rows, errors) where rows
+    is a list of (index, type, value, date_created) tuples for the valid
+    readings and errors is a list of None or a rejection reason per item.
+    """
+    n = len(readings)
+    is_object = np.fromiter((isinstance(r, dict) for r in readings), dtype=bool, count=n)
+    types = _column(readings, 'type', None)
+    values = _column(readings, 'value', None)
+    dates = _column(readings, 'date_created', default_date)
+    values[~np.fromiter((_is_integer(v) for v in values), dtype=bool, count=n)] = MIN_VALUE - 1
+
+    type_ok = is_object & np.isin(types, VALID_TYPES)
+    value_ok = is_object & (values >= MIN_VALUE) & (values <= MAX_VALUE)
+    date_ok = is_object & np.fromiter((_is_integer(d) and MIN_DATE <= d <= MAX_DATE for d in dates), dtype=bool,
+                                      count=n)
+    valid = type_ok & value_ok & date_ok
+
+    errors = np.full(n, None, dtype=object)
+    errors[~date_ok] = 'invalid date_created'
+    errors[~value_ok] = 'invalid value'
+    errors[~type_ok] = 'invalid type'
+    errors[~is_object] = 'invalid reading'
+
+    indexes = np.flatnonzero(valid)
+    rows = list(zip(indexes.tolist(), types[indexes].tolist(), values[indexes].tolist(),
+                    dates[indexes].tolist()))
+    return rows, errors.tolist()
+
+
+def batch_results(errors):
+    """Build the per-item accept/reject response body for a batch."""
+    results = []
+    for index, error in enumerate(errors):
+        if error is None:
+            results.append({'index': index, 'status': 'accepted'})
+        else:
+            results.append({'index': index, 'status': 'rejected', 'error': error})
+    accepted = sum(1 for error in errors if error is None)
+    return {'accepted': accepted, 'rejected': len(errors) - accepted, 'results': results}
+
+
+def iter_ndjson_chunks(stream, chunk_size):
+    """
+    Incrementally parse an NDJSON stream into chunks of readings.
+
+    Only one line is held in memory at a time besides the current chunk.
+    Yields lists of (line_number, reading) tuples of at most chunk_size
+    items; lines that cannot be decoded are yielded as None readings.
+    """
+    chunk = []
+    for line_number, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            reading = json.loads(line)
+        except ValueError:
+            reading = None
+        chunk.append((line_number, reading))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def validate_bulk_readings(readings, default_date):
+    """
+    Validate a batch of readings that each carry their own device_uuid.
+
+    Returns a tuple of (rows, errors) like validate_readings, with rows
+    holding (index, device_uuid, type, value, date_created) tuples.
+    """
+    rows, errors = validate_readings(readings, default_date)
+    devices = _column(readings, 'device_uuid', None)
+    device_ok = np.fromiter((isinstance(d, str) and d != '' for d in devices), dtype=bool,
+                            count=len(readings))
+    for index in np.flatnonzero(~device_ok).tolist():
+        if errors[index] is None:
+            errors[index] = 'invalid device_uuid'
+    rows = [(index, devices[index], sensor_type, value, date_created)
+            for index, sensor_type, value, date_created in rows if device_ok[index]]
+    return rows, errors
+
+
+class _Pending:
+    # Rows waiting for the writer thread and the outcome of their commit
+    __slots__ = ('rows', 'flush', 'done', 'error')
+
+    def __init__(self, rows, flush=False):
+        self.rows = rows
+        self.flush = flush
+        self.done = threading.Event()
+        self.error = None
+
+
+_STOP = object()
+
+
+class WriteBehindWriter:
+    """
+    Group commit of readings by a single background writer thread.
+
+    Handlers submit validated rows to a queue bounded to queue_size rows.
+    The writer takes everything queued until max_rows rows are waiting or
+    flush_interval seconds have passed since the first of them, and inserts
+    it with one executemany in one transaction. When that fails, every
+    submission of the group is retried in a transaction of its own, so only
+    the failing ones get the error. on_commit, if given, is called with a
+    cursor and the committed rows after every commit.
+    """
+
+    def __init__(self, path, max_rows=5000, flush_interval=0.05, queue_size=10000, on_commit=None):
+        self.path = path
+        self.max_rows = max_rows
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        self.on_commit = on_commit
+        self._queue = queue.Queue()
+        self._queued_rows = 0
+        self._queued_lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """Start the writer thread."""
+        self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self._thread.start()
+
+    def submit(self, rows, wait=False):
+        """
+        Queue rows of (device_uuid, type, value, date_created) for insertion.
+
+        Raises queue.Full straight away when the rows would take the queue
+        past queue_size rows, unless it is empty. With wait, blocks until the
+        rows are committed and re-raises any write error.
+        """
+        pending = _Pending(rows)
+        with self._queued_lock:
+            if self._queued_rows and self._queued_rows + len(rows) > self.queue_size:
+                raise queue.Full
+            self._queued_rows += len(rows)
+        self._queue.put_nowait(pending)
+        if wait:
+            pending.done.wait()
+            if pending.error is not None:
+                raise pending.error
+
+    def flush(self):
+        """Block until everything submitted so far is committed."""
+        pending = _Pending([], flush=True)
+        self._queue.put(pending)
+        pending.done.wait()
+
+    def close(self):
+        """Commit everything still queued and stop the writer thread."""
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            rows = len(item.rows)
+            deadline = time.monotonic() + self.flush_interval
+            while rows < self.max_rows and not item.flush:
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+                rows += len(item.rows)
+            self._write(batch)
+
+    def _write(self, batch):
+        rows = [row for pending in batch for row in pending.rows]
+        with self._queued_lock:
+            self._queued_rows -= len(rows)
+        try:
+            with connection(self.path) as conn:
+                try:
+                    self._insert(conn, rows)
+                except Exception as e:
+                    conn.rollback()
+                    if len(batch) == 1:
+                        raise
+                    logger.warning('Write-behind batch of %d submissions failed, retrying them one by one: %r',
+                                   len(batch), e)
+                    for pending in batch:
+                        try:
+                            self._insert(conn, pending.rows)
+                        except Exception as error:
+                            conn.rollback()
+                            logger.exception('Write-behind submission of %d rows failed', len(pending.rows))
+                            pending.error = error
+        except Exception as e:
+            logger.exception('Write-behind batch of %d submissions failed', len(batch))
+            for pending in batch:
+                pending.error = e
+        for pending in batch:
+            pending.done.set()
+
+    def _insert(self, conn, rows):
+        # Insert and commit rows in one transaction, then hand them to on_commit
+        conn.executemany(INSERT_READING, rows)
+        conn.commit()
+        if self.on_commit is not None and rows:
+            try:
+                self.on_commit(conn.cursor(), rows)
+            except Exception:
+                logger.exception('Write-behind commit callback failed')
+
+
+_writers_lock = threading.Lock()
+
+
+def get_writer(app, on_commit=None, path=None):
+    """
+    Return the write-behind writer of a database file of an app.
+
+    path defaults to the app's database, pass the shard path when sharded.
+    The writer is started on first use and flushed when the process exits.
+    """
+    path = path or database_path(app)
+    writers = app.extensions.setdefault('write_behind', {})
+    with _writers_lock:
+        writer = writers.get(path)
+        if writer is None:
+            writer = WriteBehindWriter(path, app.config['WRITE_BEHIND_MAX_ROWS'],
+                                       app.config['WRITE_BEHIND_FLUSH_INTERVAL'], app.config['WRITE_BEHIND_QUEUE_SIZE'],
+                                       on_commit)
+            writer.start()
+            atexit.register(writer.close)
+            writers[path] = writer
+    return writer
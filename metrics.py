@@ -0,0 +1,205 @@
+import bisect
+import threading
+import time
+
+from flask import Response, g, has_app_context, request
+from flask.json.provider import DefaultJSONProvider
+
+# Latency buckets in seconds, finer than the Prometheus defaults at the low end
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Phases a request's time is split into, compute being whatever is left
+PHASES = ('connect', 'sql', 'compute', 'serialize')
+
+PROMETHEUS_MIMETYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in pairs) + '}'
+
+
+class Counter:
+    """A Prometheus counter with labels."""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def expose(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} counter'.format(self.name)]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append('{}{} {}'.format(self.name, _labels(self.labelnames, labels), value))
+        return lines
+
+
+class Histogram:
+    """A Prometheus histogram with labels and fixed buckets."""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def count(self, *labels):
+        series = self._series.get(labels)
+        return sum(series[0]) if series else 0
+
+    def expose(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            for labels, (counts, total) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(self.name, _labels(self.labelnames, labels, [('le', bound)]),
+                                                         cumulative))
+                lines.append('{}_sum{} {}'.format(self.name, _labels(self.labelnames, labels), total))
+                lines.append('{}_count{} {}'.format(self.name, _labels(self.labelnames, labels), cumulative))
+        return lines
+
+
+REQUEST_SECONDS = Histogram('sensor_request_duration_seconds', 'Time to the first byte of a response.',
+                            ['route', 'method', 'status'])
+PHASE_SECONDS = Histogram('sensor_request_phase_seconds', 'Time a request spent in each phase.',
+                          ['route', 'phase'])
+SQL_STATEMENTS = Counter('sensor_sql_statements_total', 'SQL statements executed.', ['route'])
+SQL_ROWS = Counter('sensor_sql_rows_total', 'Rows fetched from SQL statements.', ['route'])
+ERRORS = Counter('sensor_errors_total', 'Requests that failed, by exception type.', ['route', 'type'])
+
+METRICS = (REQUEST_SECONDS, PHASE_SECONDS, SQL_STATEMENTS, SQL_ROWS, ERRORS)
+
+# Functions returning the lines of metrics kept elsewhere, read at every scrape
+COLLECTORS = []
+
+
+def _timings():
+    # The phase timings of the current request, or None when it is not timed
+    if not has_app_context():
+        return None
+    return g.get('metrics_timings')
+
+
+def record_phase(phase, seconds):
+    """Add time spent in a phase to the current request."""
+    timings = _timings()
+    if timings is not None:
+        timings[phase] += seconds
+
+
+def record_sql(seconds, statements=0, rows=0):
+    """Add SQL time, statements run and rows fetched to the current request."""
+    timings = _timings()
+    if timings is not None:
+        timings['sql'] += seconds
+        timings['statements'] += statements
+        timings['rows'] += rows
+
+
+def route_label():
+    """The route pattern of the current request, so labels stay few."""
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+def record_error(error):
+    """Count an exception a handler turned into a 500."""
+    ERRORS.inc(route_label(), type(error).__name__)
+
+
+def register_collector(collect):
+    """Add a function returning more exposition lines to every scrape."""
+    COLLECTORS.append(collect)
+
+
+def expose():
+    """Every metric in the Prometheus text format."""
+    lines = [line for metric in METRICS for line in metric.expose()]
+    for collect in COLLECTORS:
+        lines += collect()
+    return '\n'.join(lines) + '\n'
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """The default JSON provider, timing jsonify as the serialize phase."""
+
+    def response(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().response(*args, **kwargs)
+        finally:
+            record_phase('serialize', time.perf_counter() - started)
+
+
+def _start_timing():
+    g.metrics_timings = dict.fromkeys(PHASES + ('statements', 'rows'), 0)
+    g.metrics_started = time.perf_counter()
+
+
+def _stop_timing(response):
+    timings = g.pop('metrics_timings', None)
+    if timings is None:
+        return response
+    elapsed = time.perf_counter() - g.pop('metrics_started')
+    route = route_label()
+    REQUEST_SECONDS.observe(elapsed, route, request.method, str(response.status_code))
+    timings['compute'] = max(elapsed - timings['connect'] - timings['sql'] - timings['serialize'], 0.0)
+    for phase in PHASES:
+        PHASE_SECONDS.observe(timings[phase], route, phase)
+    if timings['statements']:
+        SQL_STATEMENTS.inc(route, amount=timings['statements'])
+    if timings['rows']:
+        SQL_ROWS.inc(route, amount=timings['rows'])
+    return response
+
+
+def instrument_app(app):
+    """
+    Time every request of an app and serve the metrics at /metrics.
+
+    Requests are timed to the first byte; the rows of a streamed body are
+    fetched after the response is recorded. Set METRICS to False to stop
+    timing requests.
+    """
+    app.config.setdefault('METRICS', True)
+    app.json = TimedJSONProvider(app)
+
+    @app.before_request
+    def start_timing():
+        if app.config['METRICS']:
+            _start_timing()
+
+    app.after_request(_stop_timing)
+
+    @app.route('/metrics', methods=['GET'])
+    def request_metrics():
+        """This endpoint allows Prometheus to scrape the metrics of this process."""
+        return Response(expose(), 200, content_type=PROMETHEUS_MIMETYPE)
@@ -0,0 +1,76 @@
+import multiprocessing
+import sqlite3
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from rollups import fleet_histograms, merge_fleet_histograms
+
+_executor = None
+_executor_workers = 0
+_executor_lock = threading.Lock()
+
+
+def get_process_pool(workers):
+    """
+    Return the shared process pool, started on first use.
+
+    Workers are spawned rather than forked, so they never inherit the
+    threads and open connections of the server process.
+    """
+    global _executor, _executor_workers
+    with _executor_lock:
+        if _executor is None or _executor_workers != workers:
+            if _executor is not None:
+                _executor.shutdown()
+            _executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+            _executor_workers = workers
+        return _executor
+
+
+def device_ranges(cur, partitions):
+    """
+    Split the devices of a database into ranges of about as many devices.
+
+    Returns a list of (low, high) device_uuid ranges for fleet_histograms,
+    covering every device_uuid with the first low and last high open.
+    """
+    cur.execute('select distinct device_uuid from readings_histograms order by device_uuid')
+    uuids = [row[0] for row in cur.fetchall()]
+    step = max(1, -(-len(uuids) // partitions))
+    bounds = [None] + uuids[step::step] + [None]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _connect(path):
+    # A read-only connection, workers never write
+    return sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+
+
+def partial_histograms(path, devices, sensor_type, start_time, end_time):
+    """The fleet_histograms of a range of devices, on a read-only connection of its own."""
+    conn = _connect(path)
+    try:
+        return fleet_histograms(conn.cursor(), sensor_type, start_time, end_time, devices)
+    finally:
+        conn.close()
+
+
+def parallel_fleet_histograms(paths, workers, sensor_type, start_time, end_time):
+    """
+    The fleet_histograms of many database files computed by a process pool.
+
+    Every file is split into workers ranges of devices. The partial
+    histograms are added up in this process, which keeps every statistic
+    of the summary exact.
+    """
+    tasks = []
+    for path in paths:
+        conn = _connect(path)
+        try:
+            tasks += [(path, devices) for devices in device_ranges(conn.cursor(), workers)]
+        finally:
+            conn.close()
+    pool = get_process_pool(workers)
+    futures = [pool.submit(partial_histograms, path, devices, sensor_type, start_time, end_time)
+               for path, devices in tasks]
+    return merge_fleet_histograms([future.result() for future in futures])
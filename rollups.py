@@ -0,0 +1,341 @@
+import heapq
+
+import numpy as np
+
+from db import HISTOGRAM_BIN, READING_COLUMNS, request_query
+from segments import scan, scan_fleet
+from stats import HISTOGRAM_BINS
+
+# Rollup bucket sizes in seconds, largest first
+GRANULARITIES = (86400, 3600, 60)
+
+# Value histogram bucket size in seconds
+HISTOGRAM_GRANULARITY = 3600
+
+# Metrics devices can be ranked by in a fleet query
+FLEET_METRICS = ('max', 'mean', 'count')
+
+# Devices a fleet query returns when it sets neither k nor a threshold
+FLEET_DEFAULT_K = 50
+
+
+def plan_window(start_time, end_time, granularities=GRANULARITIES):
+    """
+    Split the inclusive window [start_time, end_time] into rollup buckets.
+
+    Returns a tuple of (buckets, edges). buckets is a list of
+    (granularity, first_bucket, stop_bucket) ranges that are covered
+    completely, using the largest buckets that fit. edges is a list of
+    inclusive (start, end) ranges left over that must be read raw.
+    """
+    buckets = []
+    edges = []
+
+    def split(start, stop, remaining):
+        # Works on the half-open range [start, stop)
+        if start >= stop:
+            return
+        if not remaining:
+            edges.append((start, stop - 1))
+            return
+        granularity = remaining[0]
+        first = -(-start // granularity) * granularity
+        last = stop // granularity * granularity
+        if first >= last:
+            split(start, stop, remaining[1:])
+            return
+        split(start, first, remaining[1:])
+        buckets.append((granularity, first, last))
+        split(last, stop, remaining[1:])
+
+    split(start_time, end_time + 1, granularities)
+    return buckets, edges
+
+
+def rollup_plan(start_time, end_time):
+    """
+    Plan a window for the rollups, or None if they would not help.
+
+    Rollups are only used when both ends of the window are given and the
+    window covers at least one whole bucket.
+    """
+    if start_time is None or end_time is None:
+        return None
+    buckets, edges = plan_window(int(start_time), int(end_time))
+    if not buckets:
+        return None
+    return buckets, edges
+
+
+def _merge(aggregate, count, total, low, high):
+    if not count:
+        return aggregate
+    if aggregate is None:
+        return {'count': count, 'sum': total, 'min': low, 'max': high}
+    return {
+        'count': aggregate['count'] + count,
+        'sum': aggregate['sum'] + total,
+        'min': min(aggregate['min'], low),
+        'max': max(aggregate['max'], high)
+    }
+
+
+def window_aggregate(cur, device_uuid, sensor_type, plan):
+    """
+    The count, sum, min and max of a device over a planned window.
+
+    Whole buckets are answered from the rollups and only the ragged edges
+    from the raw readings, in the db and in segments. Returns a dict, or
+    None if there are no readings.
+    """
+    buckets, edges = plan
+    aggregate = None
+    for granularity, first, stop in buckets:
+        cur.execute('select sum(value_count), sum(value_sum), min(value_min), max(value_max) '
+                    'from readings_rollups where device_uuid = ? and type = ? and granularity = ? '
+                    'and bucket >= ? and bucket < ?', (device_uuid, sensor_type, granularity, first, stop))
+        aggregate = _merge(aggregate, *cur.fetchone())
+    for start, end in edges:
+        query, params = request_query(device_uuid, sensor_type, start, end,
+                                      ['count(*)', 'sum(value)', 'min(value)', 'max(value)'])
+        cur.execute(query, params)
+        aggregate = _merge(aggregate, *cur.fetchone())
+        values = scan(cur, device_uuid, sensor_type, start, end)[1]
+        if len(values):
+            aggregate = _merge(aggregate, len(values), int(values.sum()), int(values.min()), int(values.max()))
+    return aggregate
+
+
+def find_reading(cur, device_uuid, sensor_type, plan, value, column):
+    """
+    Find a reading in a planned window with the given min or max value.
+
+    column is 'value_min' or 'value_max', the rollup column to match the
+    value against. Only the one bucket that holds the value is read raw.
+    Returns the reading row, or None.
+    """
+    buckets, edges = plan
+    ranges = list(edges)
+    for granularity, first, stop in buckets:
+        cur.execute('select bucket from readings_rollups where device_uuid = ? and type = ? '
+                    'and granularity = ? and bucket >= ? and bucket < ? and ' + column + ' = ? '
+                    'order by bucket limit 1', (device_uuid, sensor_type, granularity, first, stop, value))
+        row = cur.fetchone()
+        if row is not None:
+            ranges.append((row[0], row[0] + granularity - 1))
+    for start, end in sorted(ranges):
+        query, params = request_query(device_uuid, sensor_type, start, end, READING_COLUMNS)
+        cur.execute(query + ' and value = ? limit 1', params + [value])
+        row = cur.fetchone()
+        if row is not None:
+            return row
+        dates, values, types, _ = scan(cur, device_uuid, sensor_type, start, end, value)
+        matches = np.flatnonzero(values == value)
+        if len(matches):
+            i = matches[0]
+            return device_uuid, str(types[i]), int(values[i]), int(dates[i])
+    return None
+
+
+def histogram_window(start_time, end_time):
+    """
+    Split a window, open on either end, into histogram buckets and edges.
+
+    Returns a tuple of (conditions, params, edges). conditions and params
+    select the whole hour buckets of the window from readings_histograms,
+    edges is a list of inclusive (start, end) ranges to read raw.
+    """
+    conditions = []
+    params = []
+    edges = []
+    first = None
+    if start_time is not None:
+        start_time = int(start_time)
+        first = -(-start_time // HISTOGRAM_GRANULARITY) * HISTOGRAM_GRANULARITY
+    last = None
+    if end_time is not None:
+        end_time = int(end_time)
+        last = (end_time + 1) // HISTOGRAM_GRANULARITY * HISTOGRAM_GRANULARITY
+
+    if first is not None and last is not None and first >= last:
+        # No whole bucket, read the window raw and no buckets at all
+        return ['0'], [], [(start_time, end_time)] if start_time <= end_time else []
+
+    if first is not None:
+        conditions.append('bucket >= ?')
+        params.append(first)
+        if start_time < first:
+            edges.append((start_time, first - 1))
+    if last is not None:
+        conditions.append('bucket < ?')
+        params.append(last)
+        if last <= end_time:
+            edges.append((last, end_time))
+    return conditions, params, edges
+
+
+def window_histogram(cur, device_uuid, sensor_type, start_time, end_time):
+    """
+    The exact value histogram of a device over a window.
+
+    Whole hours are merged from readings_histograms and only the ragged
+    edges are read raw, from the db and from segments. Returns an array of
+    HISTOGRAM_BINS counts.
+    """
+    conditions, params, edges = histogram_window(start_time, end_time)
+    counts = np.zeros(HISTOGRAM_BINS, dtype=np.int64)
+    cur.execute('select value, sum(value_count) from readings_histograms where device_uuid = ? and type = ? and '
+                + ' and '.join(conditions or ['1']) + ' group by value', [device_uuid, sensor_type] + params)
+    rows = cur.fetchall()
+    for start, end in edges:
+        query, query_params = request_query(device_uuid, sensor_type, start, end,
+                                            [HISTOGRAM_BIN.format('value'), 'count(*)'])
+        cur.execute(query + ' group by 1', query_params)
+        rows += cur.fetchall()
+        counts += np.bincount(scan(cur, device_uuid, sensor_type, start, end)[1], minlength=HISTOGRAM_BINS)
+    if rows:
+        values, value_counts = zip(*rows)
+        np.add.at(counts, np.array(values), np.array(value_counts))
+    return counts
+
+
+def fleet_histograms(cur, sensor_type, start_time, end_time, devices=None):
+    """
+    The exact value histograms of every device over a window.
+
+    devices, if given, is a (low, high) range of device_uuids to limit the
+    histograms to, low inclusive and high exclusive, either end None.
+    Returns a tuple of (device_uuids, histograms) where histograms is a
+    (devices, HISTOGRAM_BINS) array of counts.
+    """
+    conditions, params, edges = histogram_window(start_time, end_time)
+    if sensor_type is not None:
+        conditions = ['type = ?'] + conditions
+        params = [sensor_type] + params
+    device_conditions = []
+    device_params = []
+    if devices is not None and devices[0] is not None:
+        device_conditions.append('device_uuid >= ?')
+        device_params.append(devices[0])
+    if devices is not None and devices[1] is not None:
+        device_conditions.append('device_uuid < ?')
+        device_params.append(devices[1])
+    conditions = device_conditions + conditions
+    params = device_params + params
+    cur.execute('select device_uuid, value, sum(value_count) from readings_histograms where '
+                + ' and '.join(conditions or ['1']) + ' group by device_uuid, value', params)
+    rows = cur.fetchall()
+    compacted = []
+    for start, end in edges:
+        compacted.append(scan_fleet(cur, sensor_type, start, end))
+        edge_conditions = device_conditions + ['date_created >= ?', 'date_created <= ?']
+        edge_params = device_params + [start, end]
+        if sensor_type is not None:
+            edge_conditions.append('type = ?')
+            edge_params.append(sensor_type)
+        cur.execute('select device_uuid, ' + HISTOGRAM_BIN.format('value') + ', count(*) from readings where '
+                    + ' and '.join(edge_conditions) + ' group by 1, 2', edge_params)
+        rows += cur.fetchall()
+
+    uuids, values, value_counts = (list(column) for column in zip(*rows)) if rows else ([], [], [])
+    for compacted_devices, compacted_values in compacted:
+        if devices is not None:
+            keep = np.ones(len(compacted_devices), dtype=bool)
+            if devices[0] is not None:
+                keep &= compacted_devices >= devices[0]
+            if devices[1] is not None:
+                keep &= compacted_devices < devices[1]
+            compacted_devices, compacted_values = compacted_devices[keep], compacted_values[keep]
+        uuids += compacted_devices.tolist()
+        values += compacted_values.tolist()
+        value_counts += [1] * len(compacted_values)
+    if not uuids:
+        return np.array([], dtype=str), np.zeros((0, HISTOGRAM_BINS), dtype=np.int64)
+    device_uuids, codes = np.unique(np.array(uuids), return_inverse=True)
+    histograms = np.zeros((len(device_uuids), HISTOGRAM_BINS), dtype=np.int64)
+    np.add.at(histograms, (codes, np.array(values)), np.array(value_counts))
+    return device_uuids, histograms
+
+
+def merge_fleet_histograms(partials):
+    """
+    Merge the (device_uuids, histograms) of fleet_histograms over many shards.
+
+    Histograms of a device found in more than one shard are added up.
+    """
+    device_uuids = np.concatenate([devices for devices, _ in partials])
+    histograms = np.concatenate([histograms for _, histograms in partials])
+    if len(partials) == 1:
+        return device_uuids, histograms
+    merged_uuids, codes = np.unique(device_uuids, return_inverse=True)
+    merged = np.zeros((len(merged_uuids), HISTOGRAM_BINS), dtype=np.int64)
+    np.add.at(merged, codes, histograms)
+    return merged_uuids, merged
+
+
+def fleet_aggregates(cur, sensor_type, start_time, end_time):
+    """
+    Yield the (device_uuid, count, sum, max) of every device over a window.
+
+    Raw readings are grouped in SQL on the (type, date_created, value)
+    index and devices are yielded one at a time as the rows are read, with
+    the readings compacted into segments added to their device.
+    """
+    compacted_devices, compacted_values = scan_fleet(cur, sensor_type, start_time, end_time)
+    compacted = {}
+    if len(compacted_devices):
+        uuids, codes = np.unique(compacted_devices, return_inverse=True)
+        maxes = np.full(len(uuids), -1, dtype=np.int64)
+        np.maximum.at(maxes, codes, compacted_values)
+        totals = np.bincount(codes, weights=compacted_values).astype(np.int64)
+        compacted = {device: (count, total, high) for device, count, total, high in zip(
+            uuids.tolist(), np.bincount(codes).tolist(), totals.tolist(), maxes.tolist())}
+
+    conditions = ['type = ?']
+    params = [sensor_type]
+    if start_time is not None:
+        conditions.append('date_created >= ?')
+        params.append(int(start_time))
+    if end_time is not None:
+        conditions.append('date_created <= ?')
+        params.append(int(end_time))
+    cur.execute('select device_uuid, count(*), sum(value), max(value) from readings where '
+                + ' and '.join(conditions) + ' group by device_uuid', params)
+    for device_uuid, count, total, high in cur:
+        if device_uuid in compacted:
+            compacted_count, compacted_total, compacted_high = compacted.pop(device_uuid)
+            count, total, high = count + compacted_count, total + compacted_total, max(high, compacted_high)
+        yield device_uuid, count, total, high
+    for device_uuid, (count, total, high) in compacted.items():
+        yield device_uuid, count, total, high
+
+
+def _fleet_order(item):
+    # Highest metric first, ties by device_uuid
+    return -item[0], item[1]
+
+
+def fleet_top(cur, sensor_type, start_time, end_time, metric='max', k=None, above=None):
+    """
+    The devices ranked highest by one of FLEET_METRICS over a window.
+
+    Devices stream from fleet_aggregates through a heap bounded to k
+    entries, so no summary is kept for the whole fleet. above, if given,
+    keeps only the devices whose metric is above it; without k every one
+    of them is returned. Returns a list of (metric, device_uuid), best first.
+    """
+    ranked = ((high if metric == 'max' else total / count if metric == 'mean' else count, device_uuid)
+              for device_uuid, count, total, high in fleet_aggregates(cur, sensor_type, start_time, end_time))
+    if above is not None:
+        ranked = (item for item in ranked if item[0] > above)
+    if k is None:
+        return sorted(ranked, key=_fleet_order)
+    return heapq.nsmallest(k, ranked, key=_fleet_order)
+
+
+def merge_fleet_top(partials, k=None):
+    """Merge the fleet_top of many shards, which hold disjoint devices."""
+    ranked = (item for partial in partials for item in partial)
+    if k is None:
+        return sorted(ranked, key=_fleet_order)
+    return heapq.nsmallest(k, ranked, key=_fleet_order)
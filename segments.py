@@ -0,0 +1,319 @@
+import argparse
+import os
+import time
+import uuid
+
+import numpy as np
+
+from db import connection, shard_paths
+
+# Segments hold the readings of one day each
+SEGMENT_PARTITION = 86400
+
+# Rows read at a time when compacting a day
+COMPACT_FETCH_ROWS = 10000
+
+# Column files of a segment, one value per reading, sorted by device, type,
+# date_created and rowid
+SEGMENT_COLUMNS = {
+    'dates': np.int64,
+    'values': np.int16,
+    'rowids': np.int64,
+    'devices': np.int32,
+    'types': np.int8,
+}
+
+
+def segments_directory(path):
+    """The directory holding the segments of a database file."""
+    return path + '.segments'
+
+
+def _dictionary_code(dictionary, key):
+    # The code of a key in a sorted dictionary, or None if it is not there
+    i = int(np.searchsorted(dictionary, key))
+    return i if i < len(dictionary) and dictionary[i] == key else None
+
+
+class Segment:
+    """
+    An immutable, memory-mapped columnar segment of compacted readings.
+
+    Every column is a file mapped with numpy.memmap, so scans slice the
+    page cache without copying. device_uuid and type are dictionary
+    encoded; since rows are sorted by device then type, the readings of a
+    device and type are one contiguous slice found by binary search.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.columns = {name: np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+                        for name in SEGMENT_COLUMNS}
+        self.device_dictionary = np.load(os.path.join(directory, 'device_dictionary.npy'))
+        self.type_dictionary = np.load(os.path.join(directory, 'type_dictionary.npy'))
+
+    def bounds(self, device_uuid, sensor_type):
+        """The (low, high) slice of a device, and type if given, or None if it has no readings here."""
+        device_code = _dictionary_code(self.device_dictionary, device_uuid)
+        if device_code is None:
+            return None
+        devices = self.columns['devices']
+        low = int(np.searchsorted(devices, device_code, side='left'))
+        high = int(np.searchsorted(devices, device_code, side='right'))
+        if sensor_type is not None:
+            type_code = _dictionary_code(self.type_dictionary, sensor_type)
+            if type_code is None:
+                return None
+            types = self.columns['types'][low:high]
+            low, high = (low + int(np.searchsorted(types, type_code, side='left')),
+                         low + int(np.searchsorted(types, type_code, side='right')))
+        return (low, high) if low < high else None
+
+
+def write_segment(directory, device_uuids, sensor_types, values, dates, rowids):
+    """
+    Write readings to a new segment directory.
+
+    The readings are dictionary encoded and sorted by device, type,
+    date_created and rowid. Returns the zone map of the segment as a
+    tuple of (date_min, date_max, value_min, value_max).
+    """
+    os.makedirs(directory, exist_ok=True)
+    device_dictionary, devices = np.unique(np.asarray(device_uuids, dtype=str), return_inverse=True)
+    type_dictionary, types = np.unique(np.asarray(sensor_types, dtype=str), return_inverse=True)
+    dates = np.asarray(dates, dtype=np.int64)
+    rowids = np.asarray(rowids, dtype=np.int64)
+    order = np.lexsort((rowids, dates, types, devices))
+    columns = {'dates': dates, 'values': values, 'rowids': rowids, 'devices': devices, 'types': types}
+    for name, dtype in SEGMENT_COLUMNS.items():
+        np.save(os.path.join(directory, name + '.npy'), np.asarray(columns[name], dtype=dtype)[order])
+    np.save(os.path.join(directory, 'device_dictionary.npy'), device_dictionary)
+    np.save(os.path.join(directory, 'type_dictionary.npy'), type_dictionary)
+    values = np.asarray(values)
+    return int(dates.min()), int(dates.max()), int(values.min()), int(values.max())
+
+
+def _database_file(cur):
+    # The file of the main database of a connection or cursor
+    for _, name, path in cur.execute('pragma database_list').fetchall():
+        if name == 'main':
+            return path
+    return ''
+
+
+def compact(conn, before):
+    """
+    Move the readings dated before a time out of the readings table.
+
+    Readings are moved one day at a time, oldest first, each day in its
+    own transaction: the day is read in COMPACT_FETCH_ROWS batches from the
+    (type, date_created) index, written to a new segment and deleted from
+    readings in the transaction that registers the segment. A reader sees
+    every reading exactly once, memory is bounded by one day of readings
+    and ingest only waits for one day at a time. Rollups and histograms
+    keep their counts. Returns the number of readings moved.
+    """
+    path = _database_file(conn)
+    if not path:
+        raise ValueError('segments need a database file')
+    directory = segments_directory(path)
+    before = int(before)
+    sensor_types = [row[0] for row in conn.execute('select distinct type from readings_watermarks').fetchall()]
+    moved = 0
+    while True:
+        # The oldest reading left to move, one index seek per type
+        firsts = [conn.execute('select min(date_created) from readings where type = ? and date_created < ?',
+                               (sensor_type, before)).fetchone()[0] for sensor_type in sensor_types]
+        firsts = [first for first in firsts if first is not None]
+        if not firsts:
+            return moved
+        partition = min(firsts) // SEGMENT_PARTITION * SEGMENT_PARTITION
+        stop = min(partition + SEGMENT_PARTITION, before)
+        moved += _compact_partition(conn, directory, sensor_types, partition, stop)
+
+
+def _compact_partition(conn, directory, sensor_types, partition, stop):
+    # Move the readings dated from partition up to stop into one segment, in one transaction
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        batches = []
+        for sensor_type in sensor_types:
+            cur = conn.execute('select device_uuid, type, value, date_created, rowid from readings '
+                               'where type = ? and date_created >= ? and date_created < ?',
+                               (sensor_type, partition, stop))
+            while True:
+                rows = cur.fetchmany(COMPACT_FETCH_ROWS)
+                if not rows:
+                    break
+                batches.append([np.array(column) for column in zip(*rows)])
+        if not batches:
+            conn.rollback()
+            return 0
+        device_uuids, types, values, dates, rowids = (np.concatenate(column) for column in zip(*batches))
+        # Names are never reused, so a mapped segment is never overwritten
+        name = '{}-{}'.format(partition, uuid.uuid4().hex)
+        zone_map = write_segment(os.path.join(directory, name), device_uuids, types, values, dates, rowids)
+        conn.execute('insert into readings_segments (name, partition, row_count, date_min, date_max, value_min, '
+                     'value_max) VALUES (?, ?, ?, ?, ?, ?, ?)', (name, partition, len(dates)) + zone_map)
+        for sensor_type in sensor_types:
+            conn.execute('delete from readings where type = ? and date_created >= ? and date_created < ?',
+                         (sensor_type, partition, stop))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(dates)
+
+
+_segments = {}
+
+
+def get_segment(directory):
+    """Return the mapped segment stored in a directory."""
+    segment = _segments.get(directory)
+    if segment is None:
+        segment = _segments.setdefault(directory, Segment(directory))
+    return segment
+
+
+def window_segments(cur, start_time, end_time, value=None):
+    """
+    The segments whose zone maps overlap a window, open on either end.
+
+    value, if given, also skips the segments whose value range excludes it.
+    """
+    conditions = []
+    params = []
+    if start_time is not None:
+        conditions.append('date_max >= ?')
+        params.append(int(start_time))
+    if end_time is not None:
+        conditions.append('date_min <= ?')
+        params.append(int(end_time))
+    if value is not None:
+        conditions += ['value_min <= ?', 'value_max >= ?']
+        params += [value, value]
+    cur.execute('select name from readings_segments where ' + ' and '.join(conditions or ['1'])
+                + ' order by partition, name', params)
+    rows = cur.fetchall()
+    if not rows:
+        return []
+    directory = segments_directory(_database_file(cur))
+    return [get_segment(os.path.join(directory, row[0])) for row in rows]
+
+
+def _window_slice(dates, start_time, end_time):
+    low = 0 if start_time is None else int(np.searchsorted(dates, int(start_time), side='left'))
+    high = len(dates) if end_time is None else int(np.searchsorted(dates, int(end_time), side='right'))
+    return low, high
+
+
+def scan(cur, device_uuid, sensor_type, start_time, end_time, value=None):
+    """
+    The compacted readings of one device over a window.
+
+    Returns a tuple of (dates, values, types, rowids) arrays ordered by
+    date_created and rowid. Only the segments whose zone maps overlap the
+    window are read, and only the slice of the device in each of them.
+    """
+    return _scan_segments(window_segments(cur, start_time, end_time, value), device_uuid, sensor_type, start_time,
+                          end_time)
+
+
+def scan_devices(cur, device_uuids, sensor_type, start_time, end_time):
+    """
+    The compacted readings of many devices over a window.
+
+    The segment catalog is read once for all of them. Returns a dict of
+    device_uuid to the arrays of scan, for the devices with any readings.
+    """
+    segments = window_segments(cur, start_time, end_time)
+    if not segments:
+        return {}
+    scans = {}
+    for device_uuid in device_uuids:
+        compacted = _scan_segments(segments, device_uuid, sensor_type, start_time, end_time)
+        if len(compacted[0]):
+            scans[device_uuid] = compacted
+    return scans
+
+
+def _scan_segments(segments, device_uuid, sensor_type, start_time, end_time):
+    parts = []
+    for segment in segments:
+        bounds = segment.bounds(device_uuid, sensor_type)
+        if bounds is None:
+            continue
+        columns = {name: column[bounds[0]:bounds[1]] for name, column in segment.columns.items()}
+        if sensor_type is not None:
+            # One type, the slice is already in date order
+            low, high = _window_slice(columns['dates'], start_time, end_time)
+            columns = {name: column[low:high] for name, column in columns.items()}
+        else:
+            keep = np.ones(len(columns['dates']), dtype=bool)
+            if start_time is not None:
+                keep &= columns['dates'] >= int(start_time)
+            if end_time is not None:
+                keep &= columns['dates'] <= int(end_time)
+            columns = {name: column[keep] for name, column in columns.items()}
+        parts.append((columns['dates'], columns['values'], segment.type_dictionary[columns['types']],
+                      columns['rowids']))
+    if not parts:
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int16), np.zeros(0, dtype=str),
+                np.zeros(0, dtype=np.int64))
+    if len(parts) == 1 and sensor_type is not None:
+        return parts[0]
+    dates, values, types, rowids = (np.concatenate(column) for column in zip(*parts))
+    order = np.lexsort((rowids, dates))
+    return dates[order], values[order], types[order], rowids[order]
+
+
+def has_readings(cur, device_uuid, sensor_type):
+    """Whether any segment holds readings of a device and type."""
+    return any(segment.bounds(device_uuid, sensor_type) is not None
+               for segment in window_segments(cur, None, None))
+
+
+def scan_fleet(cur, sensor_type, start_time, end_time):
+    """
+    The compacted readings of every device over a window.
+
+    Returns a tuple of (device_uuids, values) arrays, in no particular order.
+    """
+    device_parts = []
+    value_parts = []
+    for segment in window_segments(cur, start_time, end_time):
+        columns = segment.columns
+        keep = np.ones(len(columns['dates']), dtype=bool)
+        if sensor_type is not None:
+            type_code = _dictionary_code(segment.type_dictionary, sensor_type)
+            if type_code is None:
+                continue
+            keep &= columns['types'] == type_code
+        if start_time is not None:
+            keep &= columns['dates'] >= int(start_time)
+        if end_time is not None:
+            keep &= columns['dates'] <= int(end_time)
+        device_parts.append(segment.device_dictionary[columns['devices'][keep]])
+        value_parts.append(columns['values'][keep])
+    if not device_parts:
+        return np.zeros(0, dtype=str), np.zeros(0, dtype=np.int16)
+    return np.concatenate(device_parts), np.concatenate(value_parts)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compact old readings into columnar segments.')
+    parser.add_argument('--database', default='database.db')
+    parser.add_argument('--shards', type=int, default=1, help='the SHARDS setting of the app')
+    parser.add_argument('--older-than', type=int, default=30 * 86400,
+                        help='move readings older than this many seconds')
+    args = parser.parse_args(argv)
+    before = time.time() - args.older_than
+    for path in shard_paths(args.database, args.shards):
+        with connection(path) as conn:
+            moved = compact(conn, before)
+        print('Compacted {} readings of {}'.format(moved, path))
+
+
+if __name__ == '__main__':
+    main()
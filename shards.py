@@ -0,0 +1,79 @@
+import argparse
+import os
+
+from db import INSERT_READING, connection, shard_index, shard_paths
+from segments import window_segments
+
+# Readings copied per transaction by the resharding tool
+RESHARD_CHUNK_SIZE = 10000
+
+
+def iter_readings(conn, size=RESHARD_CHUNK_SIZE):
+    """
+    Yield every reading of a database file in lists of at most size rows.
+
+    Rows are (device_uuid, type, value, date_created) tuples, read from the
+    readings table and from the segments compacted out of it.
+    """
+    cur = conn.cursor()
+    cur.execute('select device_uuid, type, value, date_created from readings')
+    while True:
+        rows = cur.fetchmany(size)
+        if not rows:
+            break
+        yield [tuple(row) for row in rows]
+    for segment in window_segments(conn.cursor(), None, None):
+        columns = segment.columns
+        for start in range(0, len(columns['dates']), size):
+            stop = start + size
+            yield list(zip(segment.device_dictionary[columns['devices'][start:stop]].tolist(),
+                           segment.type_dictionary[columns['types'][start:stop]].tolist(),
+                           columns['values'][start:stop].tolist(), columns['dates'][start:stop].tolist()))
+
+
+def reshard(path, old_shards, new_shards):
+    """
+    Copy the readings of a database from one shard count to another.
+
+    The new shard files must not hold any readings yet. Readings are
+    routed by device_uuid and inserted through the triggers, so rollups and
+    histograms are rebuilt. The old files are left untouched; switch the
+    SHARDS setting once the copy is done. Returns the number of readings.
+    """
+    old_paths = shard_paths(path, old_shards)
+    new_paths = shard_paths(path, new_shards)
+    if set(old_paths) & set(new_paths):
+        raise ValueError('the old and new shard files overlap')
+    for new_path in new_paths:
+        if os.path.exists(new_path):
+            with connection(new_path) as conn:
+                if conn.execute('select count(*) from readings').fetchone()[0]:
+                    raise ValueError('{} already holds readings'.format(new_path))
+
+    copied = 0
+    for old_path in old_paths:
+        with connection(old_path) as old_conn:
+            for rows in iter_readings(old_conn):
+                routed = {}
+                for row in rows:
+                    routed.setdefault(new_paths[shard_index(row[0], new_shards)], []).append(row)
+                for new_path, new_rows in routed.items():
+                    with connection(new_path) as conn:
+                        conn.executemany(INSERT_READING, new_rows)
+                        conn.commit()
+                copied += len(rows)
+    return copied
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Copy readings to a new number of shards.')
+    parser.add_argument('--database', default='database.db')
+    parser.add_argument('--from-shards', type=int, default=1)
+    parser.add_argument('--to-shards', type=int, required=True)
+    args = parser.parse_args(argv)
+    copied = reshard(args.database, args.from_shards, args.to_shards)
+    print('Copied {} readings to {}'.format(copied, ', '.join(shard_paths(args.database, args.to_shards))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+import numpy as np
+
+# Readings are integers from 0 to 100, one histogram bin per value
+HISTOGRAM_BINS = 101
+
+
+def _value_at_rank(cumulative, rank):
+    # The value of the reading at a 0-based rank in sorted order
+    return (cumulative <= np.asarray(rank)[..., None]).sum(axis=-1)
+
+
+def histogram_quantile(counts, q):
+    """
+    The q-th quantile of the values counted in a value histogram.
+
+    counts holds one bin per value along its last axis and may stack the
+    histograms of many devices. Uses linear interpolation, the same as
+    np.quantile over the raw values. Histograms must not be empty.
+    """
+    cumulative = np.cumsum(counts, axis=-1)
+    total = cumulative[..., -1]
+    position = q * (total - 1)
+    lower = np.floor(position)
+    upper = np.minimum(lower + 1, total - 1)
+    low_values = _value_at_rank(cumulative, lower)
+    return low_values + (_value_at_rank(cumulative, upper) - low_values) * (position - lower)
+
+
+def histogram_mode(counts):
+    """The most common value of a value histogram, the smallest one on ties."""
+    return np.argmax(counts, axis=-1)
+
+
+# Metrics of the combined stats endpoint, in response order
+STATS_METRICS = ('max', 'min', 'mean', 'median', 'q1', 'q3', 'mode', 'count', 'stddev')
+
+
+def histogram_stats(counts, metrics=STATS_METRICS):
+    """
+    Compute any of STATS_METRICS from one value histogram in one pass over its bins.
+
+    The quantiles use linear interpolation and stddev is the population
+    standard deviation, the same as NumPy over the raw values. Every metric
+    but count is None when the histogram is empty.
+    """
+    counts = np.asarray(counts)
+    total = int(counts.sum())
+    if total == 0:
+        return {metric: 0 if metric == 'count' else None for metric in metrics}
+    bins = np.arange(len(counts))
+    present = np.flatnonzero(counts)
+    mean = counts @ bins / total
+    quartile_1, median, quartile_3 = histogram_quantile(counts, np.array([.25, .5, .75])).tolist()
+    values = {
+        'max': int(present[-1]),
+        'min': int(present[0]),
+        'mean': mean.item(),
+        'median': median,
+        'q1': quartile_1,
+        'q3': quartile_3,
+        'mode': int(histogram_mode(counts)),
+        'count': total,
+        'stddev': np.sqrt(counts @ (bins - mean) ** 2 / total).item(),
+    }
+    return {metric: values[metric] for metric in metrics}
+
+
+# Aggregates of a bucketed series
+SERIES_AGGREGATES = ('mean', 'min', 'max', 'count')
+
+
+def bucket_series(dates, values, interval, aggregates=SERIES_AGGREGATES):
+    """
+    Reduce readings to one point per fixed time bucket.
+
+    dates must be sorted. Buckets start at the multiples of interval
+    seconds, and every non-empty one is reduced with ufunc.reduceat over
+    its slice. Returns the bucket starts followed by one array per
+    aggregate, in order.
+    """
+    dates = np.asarray(dates, dtype=np.int64)
+    values = np.asarray(values, dtype=np.int64)
+    if len(dates) == 0:
+        return [dates] + [np.zeros(0, dtype=np.float64 if aggregate == 'mean' else np.int64)
+                          for aggregate in aggregates]
+    buckets = dates // interval
+    starts = np.flatnonzero(np.concatenate(([True], buckets[1:] != buckets[:-1])))
+    counts = np.diff(np.append(starts, len(dates)))
+    reductions = {
+        'mean': lambda: np.add.reduceat(values, starts) / counts,
+        'min': lambda: np.minimum.reduceat(values, starts),
+        'max': lambda: np.maximum.reduceat(values, starts),
+        'count': lambda: counts,
+    }
+    return [buckets[starts] * interval] + [reductions[aggregate]() for aggregate in aggregates]
+
+
+def lttb(dates, values, max_points):
+    """
+    Downsample a series with Largest-Triangle-Three-Buckets.
+
+    The first and last readings are kept and the rest are split into
+    max_points - 2 buckets of about as many readings. From every bucket
+    the reading forming the largest triangle with the reading kept from
+    the previous bucket and the mean of the next bucket is kept. The bucket
+    means come from one reduceat and each bucket is a single array
+    operation, so the work is O(readings) with max_points Python steps.
+    Returns the indices of the kept readings, in order.
+    """
+    count = len(dates)
+    if count <= max_points:
+        return np.arange(count)
+    # Dates relative to the first one keep the triangle areas precise
+    x = np.asarray(dates, dtype=np.float64) - float(dates[0])
+    y = np.asarray(values, dtype=np.float64)
+    edges = (np.arange(max_points - 1) * ((count - 2) / (max_points - 2))).astype(np.int64) + 1
+    edges[-1] = count - 1
+    sizes = np.diff(edges)
+    mean_x = np.append(np.add.reduceat(x[:-1], edges[:-1]) / sizes, x[-1])
+    mean_y = np.append(np.add.reduceat(y[:-1], edges[:-1]) / sizes, y[-1])
+
+    kept = np.empty(max_points, dtype=np.int64)
+    kept[0], kept[-1] = 0, count - 1
+    for bucket in range(max_points - 2):
+        a = kept[bucket]
+        low, high = edges[bucket], edges[bucket + 1]
+        areas = np.abs((x[a] - mean_x[bucket + 1]) * (y[low:high] - y[a])
+                       - (x[a] - x[low:high]) * (mean_y[bucket + 1] - y[a]))
+        kept[bucket + 1] = low + np.argmax(areas)
+    return kept
+
+
+# Fields of a device summary, in order
+SUMMARY_COLUMNS = ['device_uuid', 'number_of_readings', 'max_reading_value', 'median_reading_value',
+                   'mean_reading_value', 'quartile_1_value', 'quartile_3_value']
+
+
+def summary_columns(device_uuids, histograms):
+    """
+    Summarize every device from its value histogram in a few array operations.
+
+    histograms is a (devices, HISTOGRAM_BINS) array of counts, one row per
+    entry of device_uuids. The count, max, mean, median and quartiles of
+    all devices are computed together, in O(devices x bins).
+    Returns one array per entry of SUMMARY_COLUMNS, sorted by number of
+    readings, most first.
+    """
+    histograms = np.asarray(histograms)
+    bins = np.arange(histograms.shape[-1])
+    counts = histograms.sum(axis=-1)
+    keep = counts > 0
+    device_uuids = np.asarray(device_uuids, dtype=str)[keep]
+    histograms = histograms[keep]
+    counts = counts[keep]
+    if len(counts) == 0:
+        return [device_uuids, counts, counts, *([np.zeros(0)] * 4)]
+
+    maxes = histograms.shape[-1] - 1 - np.argmax(histograms[:, ::-1] > 0, axis=-1)
+    means = histograms @ bins / counts
+    quartile_1 = histogram_quantile(histograms, .25)
+    medians = histogram_quantile(histograms, .5)
+    quartile_3 = histogram_quantile(histograms, .75)
+
+    order = np.argsort(-counts, kind='stable')
+    return [column[order] for column in (device_uuids, counts, maxes, medians, means, quartile_1, quartile_3)]
@@ -0,0 +1,102 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import unittest
+
+from app import app
+from asgi import ThreadPoolASGI
+from db import drop_tables, migrate
+
+
+def exchange(asgi_app, method, path, body=b'', query=b'', content_type=b'application/json'):
+    # Run one request through an ASGI app, sending a list body in parts, and return the messages sent
+    messages = []
+    parts = list(body) if isinstance(body, list) else [body]
+
+    async def receive():
+        return {'type': 'http.request', 'body': parts.pop(0), 'more_body': bool(parts)}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query,
+             'headers': [(b'content-type', content_type)], 'http_version': '1.1'}
+    asyncio.run(asgi_app(scope, receive, send))
+    return messages
+
+
+def call(asgi_app, method, path, body=b'', query=b''):
+    # Run one request through an ASGI app and return its status and body
+    messages = exchange(asgi_app, method, path, body, query)
+    return messages[0]['status'], b''.join(message.get('body', b'') for message in messages[1:])
+
+
+class ThreadPoolASGITestCases(unittest.TestCase):
+
+    def setUp(self):
+        conn = sqlite3.connect('test_database.db')
+        drop_tables(conn)
+        migrate(conn)
+        conn.close()
+        app.config['TESTING'] = True
+        self.asgi_app = ThreadPoolASGI(app, ingest_workers=1, analytics_workers=1, queue_size=0)
+
+    def tearDown(self):
+        self.asgi_app.close()
+
+    def test_routes_run_on_their_pools(self):
+        # When a reading is posted and read back through the adapter
+        status, _ = call(self.asgi_app, 'POST', '/devices/asgi_device/readings/',
+                         json.dumps({'type': 'temperature', 'value': 42, 'date_created': 1635335102}).encode())
+        self.assertEqual(status, 201)
+        status, body = call(self.asgi_app, 'GET', '/devices/asgi_device/readings/', query=b'type=temperature')
+
+        # Then the Flask routes should answer as they do under WSGI
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body), [{'device_uuid': 'asgi_device', 'type': 'temperature', 'value': 42,
+                                             'date_created': 1635335102}])
+
+    def test_bodies_are_streamed(self):
+        # Given an NDJSON body that arrives in several parts, split mid-line
+        lines = b''.join(json.dumps({'device_uuid': 'asgi_device', 'type': 'temperature', 'value': value,
+                                     'date_created': 1635335102 + value}).encode() + b'\n'
+                         for value in range(100))
+        parts = [lines[offset:offset + 1000] for offset in range(0, len(lines), 1000)]
+
+        # When it is posted to the bulk endpoint through the adapter
+        messages = exchange(self.asgi_app, 'POST', '/readings/bulk', parts, content_type=b'application/x-ndjson')
+
+        # Then every line should be read
+        self.assertEqual(messages[0]['status'], 201)
+        self.assertEqual(json.loads(b''.join(message['body'] for message in messages[1:]))['accepted'], 100)
+
+        # And a streamed read should come back in several body messages
+        messages = exchange(self.asgi_app, 'GET', '/devices/asgi_device/readings/',
+                            query=b'type=temperature')
+        self.assertEqual(messages[0]['status'], 200)
+        self.assertGreater(len(messages), 3)
+        self.assertTrue(all(message['more_body'] for message in messages[1:-1]))
+        self.assertFalse(messages[-1]['more_body'])
+        self.assertEqual(len(json.loads(b''.join(message['body'] for message in messages[1:]))), 100)
+
+    def test_busy_analytics_pool_does_not_block_ingest(self):
+        # Given an analytics pool whose only thread is busy
+        release = threading.Event()
+        self.asgi_app.pools['analytics'].submit(release.wait)
+        self.asgi_app.in_flight['analytics'] = 1
+
+        # Then new reads should be turned away straight away
+        status, _ = call(self.asgi_app, 'GET', '/devices/summary/')
+        self.assertEqual(status, 503)
+
+        # Including reads posted with a query body
+        status, _ = call(self.asgi_app, 'POST', '/devices/readings/query',
+                         json.dumps({'device_uuids': ['asgi_device']}).encode())
+        self.assertEqual(status, 503)
+
+        # And posts should still go through on the ingest pool
+        status, _ = call(self.asgi_app, 'POST', '/devices/asgi_device/readings/',
+                         json.dumps({'type': 'humidity', 'value': 42}).encode())
+        self.assertEqual(status, 201)
+        release.set()
@@ -0,0 +1,229 @@
+import json
+import sqlite3
+import unittest
+
+from app import app
+from cache import HotTier, ResultCache, RingBuffer
+from db import drop_tables, migrate
+
+
+class RingBufferTestCases(unittest.TestCase):
+
+    def test_ring_keeps_latest_readings(self):
+        # Given a buffer of four readings that has seen six
+        buffer = RingBuffer(4, 3600)
+        buffer.load([], [], True)
+        for date_created in range(100, 106):
+            buffer.append(date_created, date_created - 100)
+
+        # Then it should hold the four latest in date order
+        dates, values = buffer.arrays()
+        self.assertEqual(dates.tolist(), [102, 103, 104, 105])
+        self.assertEqual(values.tolist(), [2, 3, 4, 5])
+
+        # And only vouch for windows starting after the evicted readings
+        self.assertIsNone(buffer.window(101, None))
+        self.assertIsNone(buffer.window(None, None))
+        self.assertEqual(buffer.window(102, 104)[1].tolist(), [2, 3, 4])
+
+    def test_out_of_order_and_horizon(self):
+        # Given a buffer with a short horizon
+        buffer = RingBuffer(10, 50)
+        buffer.load([100, 110, 130], [1, 2, 3], True)
+
+        # When a reading arrives out of order
+        buffer.append(120, 9)
+
+        # Then it should be slotted in by date
+        self.assertEqual(buffer.window(None, None)[1].tolist(), [1, 2, 9, 3])
+
+        # When a reading moves the horizon past the oldest ones
+        buffer.append(165, 4)
+
+        # Then they should be dropped and the window start moved up
+        self.assertEqual(buffer.arrays()[0].tolist(), [120, 130, 165])
+        self.assertIsNone(buffer.window(114, None))
+        self.assertEqual(buffer.window(115, None)[1].tolist(), [9, 3, 4])
+
+        # And readings older than the window start should be ignored
+        buffer.append(101, 7)
+        self.assertEqual(buffer.arrays()[0].tolist(), [120, 130, 165])
+
+    def test_out_of_order_behind_horizon(self):
+        # Given a complete buffer with a short horizon
+        buffer = RingBuffer(10, 50)
+        buffer.load([100, 110, 130], [1, 2, 3], True)
+
+        # When an out of order reading arrives from behind the horizon
+        buffer.append(70, 9)
+
+        # Then it should be dropped and the buffer no longer vouch for the whole history
+        self.assertEqual(buffer.arrays()[0].tolist(), [100, 110, 130])
+        self.assertIsNone(buffer.window(None, None))
+        self.assertIsNone(buffer.window(70, None))
+
+    def test_incomplete_load(self):
+        # Given a buffer loaded with only the latest part of a history
+        buffer = RingBuffer(3, 3600)
+        buffer.load([100, 100, 105], [1, 2, 3], False)
+
+        # Then it should not serve windows that could include older readings
+        self.assertIsNone(buffer.window(100, None))
+        self.assertEqual(buffer.window(101, None)[1].tolist(), [3])
+
+
+class HotTierTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        migrate(self.conn)
+        self.conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                              [('device_{}'.format(i % 3), 'temperature', i, 1635335102 + i) for i in range(30)])
+
+    def test_warm_and_lru_budget(self):
+        # Given a tier with room for two buffers
+        tier = HotTier(capacity=100, horizon=3600, budget=2 * 100 * 10)
+        tier.warm(self.conn.cursor())
+
+        # Then the two most recently active devices should be warmed
+        self.assertIsNone(tier.window('device_0', 'temperature', None, None))
+        self.assertEqual(tier.window('device_2', 'temperature', None, None)[1].tolist(), list(range(2, 30, 3)))
+
+        # When a reading for the cold device is committed
+        self.conn.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                          ('device_0', 'temperature', 99, 1635335200))
+        tier.add(self.conn.cursor(), [('device_0', 'temperature', 99, 1635335200)])
+
+        # Then it should be loaded from the db and the least recently used device evicted
+        self.assertEqual(tier.window('device_0', 'temperature', None, None)[1].tolist(), list(range(0, 30, 3)) + [99])
+        self.assertIsNone(tier.window('device_1', 'temperature', None, None))
+        self.assertIsNotNone(tier.window('device_2', 'temperature', None, None))
+
+
+class HotTierRouteTestCases(unittest.TestCase):
+
+    def setUp(self):
+        conn = sqlite3.connect('test_database.db')
+        drop_tables(conn)
+        migrate(conn)
+        conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                         [('hot_device', 'temperature', value, 1635335100 + i) for i, value in enumerate([30, 10, 20])])
+        conn.commit()
+        conn.close()
+        app.config['TESTING'] = True
+        app.config['HOT_TIER'] = True
+        app.extensions.pop('hot_tier', None)
+        self.client = app.test_client
+
+    def tearDown(self):
+        app.config['HOT_TIER'] = False
+        app.extensions.pop('hot_tier', None)
+
+    def test_metrics_served_from_memory(self):
+        # Given a warmed tier and a reading posted through the API
+        request = self.client().post('/devices/hot_device/readings/', data=json.dumps(
+            {'type': 'temperature', 'value': 20, 'date_created': 1635335110}))
+        self.assertEqual(request.status_code, 201)
+
+        # When the db no longer has the readings
+        conn = sqlite3.connect('test_database.db')
+        conn.execute('delete from readings')
+        conn.commit()
+        conn.close()
+
+        # Then every metric should still be answered from the buffer
+        def get(metric):
+            return json.loads(self.client().get('/devices/hot_device/readings/{}?type=temperature'.format(metric)).data)
+
+        self.assertEqual([reading['value'] for reading in get('')], [30, 10, 20, 20])
+        self.assertEqual(get('max/'), [{'device_uuid': 'hot_device', 'type': 'temperature', 'value': 30,
+                                        'date_created': 1635335100}])
+        self.assertEqual(get('min/')[0]['value'], 10)
+        self.assertEqual(get('mean/')['value'], 20)
+        self.assertEqual(get('median/')['value'], 20)
+        self.assertEqual(get('mode/')['value'], 20)
+
+
+class ResultCacheTestCases(unittest.TestCase):
+
+    def test_lru_and_ttl(self):
+        # Given a cache with room for two results
+        cache = ResultCache(size=2, ttl=60)
+        for end in (1, 2, 3):
+            cache.put(('max', 'device', 'temperature', None, end), end, cache.generation('device', 'temperature'))
+
+        # Then the oldest should have been evicted
+        self.assertIsNone(cache.get(('max', 'device', 'temperature', None, 1)))
+        self.assertEqual(cache.get(('max', 'device', 'temperature', None, 3)), 3)
+
+        # And expired results should not be served
+        cache.ttl = -1
+        cache.put(('min', 'device', 'temperature', None, None), 0, cache.generation('device', 'temperature'))
+        self.assertIsNone(cache.get(('min', 'device', 'temperature', None, None)))
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 2, 'evictions': 3, 'invalidations': 0, 'size': 1})
+
+    def test_invalidate_window(self):
+        # Given results over two windows of one device
+        cache = ResultCache()
+        generation = cache.generation('device', 'temperature')
+        cache.put(('max', 'device', 'temperature', 100, 200), 1, generation)
+        cache.put(('max', 'device', 'temperature', 300, None), 2, generation)
+
+        # When a reading is committed inside the first one
+        cache.invalidate([('device', 'temperature', 50, 150)])
+
+        # Then only the first one should be dropped
+        self.assertIsNone(cache.get(('max', 'device', 'temperature', 100, 200)))
+        self.assertEqual(cache.get(('max', 'device', 'temperature', 300, None)), 2)
+
+        # And results computed before the commit should not be cached
+        cache.put(('max', 'device', 'temperature', 100, 200), 1, generation)
+        self.assertIsNone(cache.get(('max', 'device', 'temperature', 100, 200)))
+
+
+class ResultCacheRouteTestCases(unittest.TestCase):
+
+    def setUp(self):
+        conn = sqlite3.connect('test_database.db')
+        drop_tables(conn)
+        migrate(conn)
+        conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                         [('cached_device', 'temperature', value, 1635335100 + i) for i, value in enumerate([30, 10])])
+        conn.commit()
+        conn.close()
+        app.config['TESTING'] = True
+        app.config['RESULT_CACHE_SIZE'] = 16
+        app.extensions.pop('result_cache', None)
+        self.client = app.test_client
+
+    def tearDown(self):
+        app.config['RESULT_CACHE_SIZE'] = 0
+        app.extensions.pop('result_cache', None)
+
+    def test_cached_until_write_in_window(self):
+        url = '/devices/cached_device/readings/max/?type=temperature&start=1635335000&end=1635335200'
+
+        # Given a result computed once
+        request = self.client().get(url)
+        self.assertEqual(request.headers['X-Cache'], 'MISS')
+
+        # When the db changes behind the API's back
+        conn = sqlite3.connect('test_database.db')
+        conn.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                     ('cached_device', 'temperature', 90, 1635335120))
+        conn.commit()
+        conn.close()
+
+        # Then the cached result should be served
+        request = self.client().get(url)
+        self.assertEqual(request.headers['X-Cache'], 'HIT')
+        self.assertEqual(json.loads(request.data)[0]['value'], 30)
+
+        # When a reading inside the window is posted
+        self.client().post('/devices/cached_device/readings/', data=json.dumps(
+            {'type': 'temperature', 'value': 20, 'date_created': 1635335150}))
+
+        # Then the result should be computed again
+        request = self.client().get(url)
+        self.assertEqual(request.headers['X-Cache'], 'MISS')
+        self.assertEqual(json.loads(request.data)[0]['value'], 90)
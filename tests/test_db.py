@@ -0,0 +1,150 @@
+import sqlite3
+import unittest
+
+from db import (MAX_READING_COLUMNS, MIN_READING_COLUMNS, ConnectionPool, migrate, request_query, request_series_query,
+                write_watermark)
+from stats import bucket_series
+
+
+class QueryBuilderTestCases(unittest.TestCase):
+
+    def setUp(self):
+        # Setup a migrated in-memory DB with some sensor data
+        self.conn = sqlite3.connect(':memory:')
+        migrate(self.conn)
+        self.conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                              [('device_{}'.format(i % 10), 'temperature' if i % 2 else 'humidity', i % 101,
+                                1635335102 + i) for i in range(1000)])
+        self.conn.execute('ANALYZE')
+
+    def query_plan(self, query, params):
+        rows = self.conn.execute('EXPLAIN QUERY PLAN ' + query, params).fetchall()
+        return ' '.join(row[-1] for row in rows)
+
+    def test_request_query_params(self):
+        # Given all the filters
+        query, params = request_query('device_1', 'temperature', '1635335102', '1635335200')
+
+        # Then the values should be bound rather than part of the SQL text
+        self.assertNotIn('device_1', query)
+        self.assertEqual(params, ['device_1', 'temperature', 1635335102, 1635335200])
+
+        # And the same filters should always give the same SQL text
+        self.assertEqual(query, request_query('device_2', 'humidity', '1', '2')[0])
+
+    def test_device_queries_use_index(self):
+        # Given the filter combinations used by the per-device endpoints
+        filters = [
+            (None, None, None),
+            ('temperature', None, None),
+            ('temperature', '1635335102', None),
+            ('temperature', '1635335102', '1635335200'),
+            (None, '1635335102', '1635335200'),
+        ]
+        for sensor_type, start_time, end_time in filters:
+            query, params = request_query('device_1', sensor_type, start_time, end_time)
+
+            # Then the readings and aggregate queries should search an index instead of scanning
+            queries = [
+                (query, params),
+                request_query('device_1', sensor_type, start_time, end_time, MAX_READING_COLUMNS),
+                request_query('device_1', sensor_type, start_time, end_time, MIN_READING_COLUMNS),
+                request_query('device_1', sensor_type, start_time, end_time, ['avg(value)']),
+            ]
+            for query_text, query_params in queries:
+                plan = self.query_plan(query_text, query_params)
+                self.assertIn('USING', plan)
+                self.assertIn('INDEX', plan)
+                self.assertNotIn('SCAN readings', plan)
+
+    def test_write_watermark(self):
+        # Given the watermark of a device and type
+        cur = self.conn.cursor()
+        writes, last_rowid, modified_at = write_watermark(cur, 'device_1', 'temperature')
+        self.assertEqual((writes, last_rowid), (100, 992))
+        self.assertGreater(modified_at, 0)
+
+        # When a reading is inserted
+        cur.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                    ('device_1', 'temperature', 20, 1))
+
+        # Then the watermark should move, even for an older date
+        self.assertEqual(write_watermark(cur, 'device_1', 'temperature')[:2], (101, cur.lastrowid))
+        self.assertEqual(write_watermark(cur, 'device_1', None)[:2], (101, cur.lastrowid))
+
+        # And a device or type without readings should have an empty watermark
+        self.assertEqual(write_watermark(cur, 'device_1', 'humidity'), (0, 0, 0))
+
+    def test_aggregate_queries(self):
+        # Given the max and min queries for one device and type
+        for columns, aggregate in ((MAX_READING_COLUMNS, 'max'), (MIN_READING_COLUMNS, 'min')):
+            expected = self.conn.execute(
+                'select {}(value) from readings where device_uuid = ? and type = ?'.format(aggregate),
+                ('device_1', 'temperature')).fetchone()[0]
+            query, params = request_query('device_1', 'temperature', None, None, columns)
+            row = self.conn.execute(query, params).fetchone()
+
+            # Then a single row should come back holding the matching reading
+            self.assertEqual(row[0], 'device_1')
+            self.assertEqual(row[2], expected)
+            self.assertEqual(self.conn.execute(
+                'select value from readings where device_uuid = ? and date_created = ?', ('device_1', row[3])
+            ).fetchone()[0], expected)
+
+    def test_series_query_matches_bucket_series(self):
+        # Given readings on both sides of the epoch
+        dates = [-7000, -3599, -1, 0, 30, 3700]
+        self.conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                              [('series_device', 'humidity', 10 + i, date) for i, date in enumerate(dates)])
+
+        # When they are bucketed in SQL
+        query, params = request_series_query('series_device', 'humidity', None, None, 3600, ['count', 'min'])
+        rows = self.conn.execute(query, params).fetchall()
+
+        # Then the buckets should match the ones computed in numpy
+        expected = bucket_series(dates, [10 + i for i in range(len(dates))], 3600, ['count', 'min'])
+        self.assertEqual(rows, list(zip(*(column.tolist() for column in expected))))
+
+
+class ConnectionPoolTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ConnectionPool('test_database.db', size=1)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_connections_are_reused(self):
+        # Given a connection that was released back to the pool
+        conn = self.pool.acquire()
+        self.pool.release(conn)
+
+        # Then the next acquire should hand out the same connection
+        self.assertIs(self.pool.acquire(), conn)
+
+    def test_connections_are_configured(self):
+        # Given a pooled connection
+        conn = self.pool.acquire()
+
+        # Then it should use WAL with relaxed syncs and the schema should exist
+        self.assertEqual(conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        self.assertEqual(conn.execute('PRAGMA synchronous').fetchone()[0], 1)
+        self.assertIsNotNone(conn.execute("select name from sqlite_master where name = 'readings'").fetchone())
+        self.pool.release(conn)
+
+    def test_release_rolls_back_and_bounds_pool(self):
+        # Given two connections with an open transaction on one of them
+        first = self.pool.acquire()
+        second = self.pool.acquire()
+        first.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                      ('pool_device', 'temperature', 1, 1))
+
+        # When both are released to a pool of size one
+        self.pool.release(first)
+        self.pool.release(second)
+
+        # Then the transaction should be rolled back and only one kept
+        self.assertFalse(first.in_transaction)
+        self.assertIs(self.pool.acquire(), first)
+        self.assertEqual(first.execute("select count(*) from readings where device_uuid = 'pool_device'")
+                         .fetchone()[0], 0)
@@ -0,0 +1,148 @@
+import json
+import os
+import queue
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from app import app
+from db import drop_tables, get_pool, migrate
+from ingest import WriteBehindWriter, get_writer
+
+
+class WriteBehindWriterTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'write_behind.db')
+
+    def tearDown(self):
+        get_pool(self.path).close()
+        shutil.rmtree(self.directory)
+
+    def count_readings(self):
+        conn = sqlite3.connect(self.path)
+        try:
+            return conn.execute('select count(*) from readings').fetchone()[0]
+        finally:
+            conn.close()
+
+    def test_submit_waits_for_commit(self):
+        # Given a running writer
+        writer = WriteBehindWriter(self.path, max_rows=10, flush_interval=0.01)
+        writer.start()
+
+        # When we submit rows and wait for them
+        writer.submit([('device', 'temperature', value, 1635335102) for value in range(25)], wait=True)
+
+        # Then they should be committed
+        self.assertEqual(self.count_readings(), 25)
+        writer.close()
+
+    def test_close_flushes_queued_rows(self):
+        # Given a writer that batches for a long time
+        writer = WriteBehindWriter(self.path, max_rows=1000, flush_interval=60)
+        writer.start()
+
+        # When we submit rows without waiting and then close it
+        for value in range(5):
+            writer.submit([('device', 'humidity', value, 1635335102)])
+        writer.close()
+
+        # Then every queued row should have been committed
+        self.assertEqual(self.count_readings(), 5)
+
+    def test_full_queue(self):
+        # Given a writer whose queue is full
+        writer = WriteBehindWriter(self.path, queue_size=1)
+        writer.submit([('device', 'humidity', 1, 1635335102)])
+
+        # Then submitting more should fail straight away
+        with self.assertRaises(queue.Full):
+            writer.submit([('device', 'humidity', 2, 1635335102)])
+
+    def test_queue_is_bounded_by_rows(self):
+        # Given a writer queueing at most 10 rows, holding a submission of 8
+        writer = WriteBehindWriter(self.path, queue_size=10)
+        writer.submit([('device', 'humidity', 1, 1635335102)] * 8)
+
+        # Then a submission of 3 more rows should fail straight away
+        with self.assertRaises(queue.Full):
+            writer.submit([('device', 'humidity', 2, 1635335102)] * 3)
+
+        # And one of 2 should still fit
+        writer.submit([('device', 'humidity', 2, 1635335102)] * 2)
+
+    def test_failed_submission_does_not_fail_its_group(self):
+        # Given a writer grouping a valid submission with one that cannot be inserted
+        writer = WriteBehindWriter(self.path, max_rows=1000, flush_interval=0.2)
+        writer.start()
+        writer.submit([('device', 'humidity', 1, 1635335102)])
+
+        # Then only the broken submission should get the error
+        with self.assertRaises(OverflowError):
+            writer.submit([('device', 'humidity', 2, 2 ** 63)], wait=True)
+
+        # And the valid one should still be committed
+        writer.close()
+        self.assertEqual(self.count_readings(), 1)
+
+
+class WriteBehindRouteTestCases(unittest.TestCase):
+
+    def setUp(self):
+        conn = sqlite3.connect('test_database.db')
+        drop_tables(conn)
+        migrate(conn)
+        conn.close()
+        app.config['TESTING'] = True
+        app.config['WRITE_BEHIND'] = True
+        self.client = app.test_client
+
+    def tearDown(self):
+        app.config['WRITE_BEHIND'] = False
+        app.config['WRITE_BEHIND_DURABILITY'] = 'commit'
+
+    def count_readings(self):
+        conn = sqlite3.connect('test_database.db')
+        try:
+            return conn.execute("select count(*) from readings where device_uuid = 'write_behind_device'").fetchone()[0]
+        finally:
+            conn.close()
+
+    def test_post_acked_after_commit(self):
+        # When we post a batch with commit durability
+        request = self.client().post('/devices/write_behind_device/readings/', data=json.dumps(
+            [{'type': 'temperature', 'value': 10}, {'type': 'temperature', 'value': 20}]))
+
+        # Then it should be created and already in the db
+        self.assertEqual(request.status_code, 201)
+        self.assertEqual(self.count_readings(), 2)
+
+    def test_post_acked_after_enqueue(self):
+        # When we post with enqueue durability
+        app.config['WRITE_BEHIND_DURABILITY'] = 'enqueue'
+        request = self.client().post('/devices/write_behind_device/readings/', data=json.dumps(
+            {'type': 'temperature', 'value': 10}))
+
+        # Then it should be accepted and committed by the next flush
+        self.assertEqual(request.status_code, 202)
+        with app.app_context():
+            get_writer(app).flush()
+        self.assertEqual(self.count_readings(), 1)
+
+    def test_post_rejected_when_queue_full(self):
+        # Given a writer whose queue is full
+        with app.app_context():
+            writer = get_writer(app)
+        writer._queued_rows = writer.queue_size
+        try:
+            # When we post a reading
+            request = self.client().post('/devices/write_behind_device/readings/', data=json.dumps(
+                {'type': 'temperature', 'value': 10}))
+
+            # Then we should be told to back off
+            self.assertEqual(request.status_code, 429)
+        finally:
+            writer._queued_rows = 0
@@ -0,0 +1,103 @@
+import json
+import sqlite3
+import unittest
+from unittest import mock
+
+from app import app
+from db import drop_tables, migrate
+from metrics import ERRORS, PHASE_SECONDS, REQUEST_SECONDS, SQL_ROWS, Counter, Histogram
+
+
+class MetricTestCases(unittest.TestCase):
+
+    def test_prometheus_text_format(self):
+        # Given a histogram and a counter with a few observations
+        histogram = Histogram('latency_seconds', 'Latency.', ['route'], buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 5):
+            histogram.observe(value, '/a')
+        counter = Counter('errors_total', 'Errors.', ['type'])
+        counter.inc('Value"Error')
+
+        # Then they should be exposed with cumulative buckets and escaped labels
+        self.assertEqual(histogram.expose(), [
+            '# HELP latency_seconds Latency.',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{route="/a",le="0.1"} 1',
+            'latency_seconds_bucket{route="/a",le="1.0"} 2',
+            'latency_seconds_bucket{route="/a",le="+Inf"} 3',
+            'latency_seconds_sum{route="/a"} 5.55',
+            'latency_seconds_count{route="/a"} 3',
+        ])
+        self.assertEqual(counter.expose()[-1], 'errors_total{type="Value\\"Error"} 1')
+
+
+class MetricsRouteTestCases(unittest.TestCase):
+
+    def setUp(self):
+        conn = sqlite3.connect('test_database.db')
+        drop_tables(conn)
+        migrate(conn)
+        conn.close()
+        app.config['TESTING'] = True
+        self.client = app.test_client
+
+    def test_requests_are_timed_by_phase(self):
+        route = '/devices/<string:device_uuid>/readings/'
+        posts = REQUEST_SECONDS.count(route, 'POST', '201')
+        phases = PHASE_SECONDS.count(route, 'sql')
+        rows = SQL_ROWS.value('/devices/<string:device_uuid>/readings/max/')
+        errors = ERRORS.value(route, 'ValueError')
+
+        # When readings are posted and queried
+        self.client().post('/devices/metrics_device/readings/', data=json.dumps(
+            {'type': 'temperature', 'value': 42, 'date_created': 1635335102}))
+        self.client().get('/devices/metrics_device/readings/max/?type=temperature')
+
+        # And a request fails
+        with mock.patch('app.request_page_query', side_effect=ValueError('broken query')):
+            request = self.client().get('/devices/metrics_device/readings/')
+        self.assertEqual(request.status_code, 500)
+
+        # Then the latency, phases, rows and error should be recorded per route
+        self.assertEqual(REQUEST_SECONDS.count(route, 'POST', '201'), posts + 1)
+        self.assertEqual(PHASE_SECONDS.count(route, 'sql'), phases + 2)
+        # The max reading and the write watermark behind its ETag
+        self.assertEqual(SQL_ROWS.value('/devices/<string:device_uuid>/readings/max/'), rows + 2)
+        self.assertEqual(ERRORS.value(route, 'ValueError'), errors + 1)
+
+        # And be served to Prometheus
+        request = self.client().get('/metrics')
+        self.assertEqual(request.status_code, 200)
+        self.assertTrue(request.content_type.startswith('text/plain; version=0.0.4'))
+        self.assertIn('sensor_request_phase_seconds_count{route="/devices/<string:device_uuid>/readings/",'
+                      'phase="connect"}', request.get_data(as_text=True))
+
+    def test_rows_read_by_iteration_are_counted(self):
+        # Given readings read by iterating the cursor when downsampled
+        self.client().post('/devices/metrics_device/readings/', data=json.dumps(
+            [{'type': 'temperature', 'value': value % 101, 'date_created': 1635335102 + value}
+             for value in range(2000)]))
+        route = '/devices/<string:device_uuid>/readings/'
+        rows = SQL_ROWS.value(route)
+
+        # When they are downsampled
+        request = self.client().get('/devices/metrics_device/readings/?type=temperature&max_points=10')
+        self.assertEqual(request.status_code, 200)
+
+        # Then every row read should be counted, along with the write watermark
+        self.assertEqual(SQL_ROWS.value(route), rows + 2001)
+
+    def test_result_cache_is_exposed(self):
+        # Given a result cache that missed and then hit
+        app.config['RESULT_CACHE_SIZE'] = 16
+        try:
+            for _ in range(2):
+                self.client().get('/devices/metrics_device/readings/stats/?type=temperature')
+
+            # Then its counters should be served to Prometheus
+            text = self.client().get('/metrics').get_data(as_text=True)
+        finally:
+            app.config['RESULT_CACHE_SIZE'] = 0
+        self.assertIn('sensor_result_cache_hits_total{database="test_database.db"}', text)
+        self.assertIn('sensor_result_cache_misses_total{database="test_database.db"}', text)
+        self.assertIn('# TYPE sensor_result_cache_evictions_total counter', text)
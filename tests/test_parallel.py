@@ -0,0 +1,54 @@
+import json
+import sqlite3
+import unittest
+
+import numpy as np
+
+from app import app
+from db import drop_tables, migrate
+from parallel import device_ranges, parallel_fleet_histograms
+from rollups import fleet_histograms
+
+
+class ParallelSummaryTestCases(unittest.TestCase):
+
+    def setUp(self):
+        conn = sqlite3.connect('test_database.db')
+        drop_tables(conn)
+        migrate(conn)
+        rng = np.random.default_rng(17)
+        conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                         [('device_{}'.format(rng.integers(0, 40)), 'temperature', int(rng.integers(0, 101)),
+                           1635292800 + int(rng.integers(0, 86400))) for _ in range(2000)])
+        conn.commit()
+        self.conn = conn
+        app.config['TESTING'] = True
+        self.client = app.test_client
+
+    def tearDown(self):
+        self.conn.close()
+        app.config['SUMMARY_PROCESSES'] = 0
+
+    def test_device_ranges_cover_every_device(self):
+        # When the devices are split in three
+        ranges = device_ranges(self.conn.cursor(), 3)
+
+        # Then the ranges should follow on from each other with open ends
+        self.assertEqual(len(ranges), 3)
+        self.assertEqual((ranges[0][0], ranges[-1][1]), (None, None))
+        self.assertEqual([high for _, high in ranges[:-1]], [low for low, _ in ranges[1:]])
+
+    def test_parallel_histograms_match_serial(self):
+        # When the histograms of a window are computed by two processes
+        window = ('temperature', 1635292800 + 1000, 1635292800 + 50000)
+        device_uuids, histograms = parallel_fleet_histograms(['test_database.db'], 2, *window)
+
+        # Then they should be exactly the serial ones
+        expected_uuids, expected = fleet_histograms(self.conn.cursor(), *window)
+        self.assertEqual(device_uuids.tolist(), expected_uuids.tolist())
+        self.assertTrue(np.array_equal(histograms, expected))
+
+        # And so should the summary route
+        serial = json.loads(self.client().get('/devices/summary/').data)
+        app.config['SUMMARY_PROCESSES'] = 2
+        self.assertEqual(json.loads(self.client().get('/devices/summary/').data), serial)
@@ -0,0 +1,228 @@
+import sqlite3
+import unittest
+
+import numpy as np
+
+from db import migrate
+from rollups import (fleet_histograms, find_reading, histogram_window, plan_window, rollup_plan, window_aggregate,
+                     window_histogram)
+
+
+class RollupTestCases(unittest.TestCase):
+
+    def setUp(self):
+        # Setup a migrated in-memory DB with a few days of readings
+        self.conn = sqlite3.connect(':memory:')
+        migrate(self.conn)
+        rng = np.random.default_rng(3)
+        self.dates = np.sort(rng.integers(1635292800, 1635292800 + 3 * 86400, 5000))
+        self.values = rng.integers(0, 101, 5000)
+        self.conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                              [('device', 'temperature', value, date)
+                               for value, date in zip(self.values.tolist(), self.dates.tolist())])
+
+    def test_plan_window(self):
+        # Given a window from 00:00:30 on day one to 01:02:10 on day three
+        day = 1635292800
+        buckets, edges = plan_window(day + 30, day + 2 * 86400 + 3600 + 130)
+
+        # Then it should use whole days, hours and minutes with raw edges
+        self.assertEqual(buckets, [
+            (60, day + 60, day + 3600),
+            (3600, day + 3600, day + 86400),
+            (86400, day + 86400, day + 2 * 86400),
+            (3600, day + 2 * 86400, day + 2 * 86400 + 3600),
+            (60, day + 2 * 86400 + 3600, day + 2 * 86400 + 3600 + 120),
+        ])
+        self.assertEqual(edges, [(day + 30, day + 59), (day + 2 * 86400 + 3720, day + 2 * 86400 + 3730)])
+
+        # And windows smaller than a minute or without bounds should not use the rollups
+        self.assertIsNone(rollup_plan(day + 1, day + 30))
+        self.assertIsNone(rollup_plan(None, day + 86400))
+
+    def test_rollup_rows_match_readings(self):
+        # Given the rollups maintained by the insert trigger
+        count, total, low, high = self.conn.execute(
+            'select sum(value_count), sum(value_sum), min(value_min), max(value_max) from readings_rollups '
+            'where granularity = 3600').fetchone()
+
+        # Then they should add up to the raw readings
+        self.assertEqual((count, total, low, high),
+                         (5000, int(self.values.sum()), int(self.values.min()), int(self.values.max())))
+
+    def test_window_aggregate_matches_raw(self):
+        cur = self.conn.cursor()
+        for start, end in ((1635292800 + 17, 1635292800 + 2 * 86400 + 4000), (1635292800, 1635292800 + 3599)):
+            # Given a window answered from the rollups
+            plan = rollup_plan(start, end)
+            aggregate = window_aggregate(cur, 'device', 'temperature', plan)
+
+            # Then it should match the raw readings in the window
+            in_window = self.values[(self.dates >= start) & (self.dates <= end)]
+            self.assertEqual(aggregate, {'count': len(in_window), 'sum': int(in_window.sum()),
+                                         'min': int(in_window.min()), 'max': int(in_window.max())})
+
+            # And the max reading should be found in the window
+            row = find_reading(cur, 'device', 'temperature', plan, aggregate['max'], 'value_max')
+            self.assertEqual(row[2], aggregate['max'])
+            self.assertTrue(start <= row[3] <= end)
+
+    def test_backfill_on_first_migration(self):
+        # Given a database created before the rollups existed
+        conn = sqlite3.connect(':memory:')
+        conn.execute('CREATE TABLE readings (device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)')
+        conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                         [('device', 'humidity', value, 1635292800 + value) for value in range(10)])
+
+        # When it is migrated
+        migrate(conn)
+
+        # Then the rollups should be filled from the existing readings
+        self.assertEqual(conn.execute('select value_count, value_sum from readings_rollups where granularity = 86400')
+                         .fetchall(), [(10, 45)])
+
+
+    def test_legacy_float_values_are_binned(self):
+        # Given a database from before values were validated, holding floats
+        conn = sqlite3.connect(':memory:')
+        conn.execute('CREATE TABLE readings (device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)')
+        conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                         [('device', 'humidity', 22.4, 1635292800), ('device', 'humidity', 22.6, 1635292810),
+                          ('device', 'humidity', 100.7, 1635296400)])
+
+        # When it is migrated and another float sneaks in
+        migrate(conn)
+        conn.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                     ('device', 'humidity', 22.5, 1635296410))
+
+        # Then the histograms should only hold integer bins, rounded and clamped
+        self.assertEqual(conn.execute("select count(*) from readings_histograms where typeof(value) != 'integer'")
+                         .fetchone()[0], 0)
+        expected = np.bincount([22, 23, 100, 23], minlength=101).tolist()
+        self.assertEqual(window_histogram(conn.cursor(), 'device', 'humidity', None, None).tolist(), expected)
+        self.assertEqual(window_histogram(conn.cursor(), 'device', 'humidity', 1635292805, 1635296415).tolist(),
+                         np.bincount([23, 100, 23], minlength=101).tolist())
+        self.assertEqual(fleet_histograms(conn.cursor(), 'humidity', None, None)[1].tolist(), [expected])
+
+    def test_dates_before_the_epoch(self):
+        # Given readings dated before the epoch in a database migrated with truncating buckets
+        conn = sqlite3.connect(':memory:')
+        migrate(conn)
+        conn.execute('DROP TRIGGER readings_rollups_insert')
+        conn.execute('CREATE TRIGGER readings_rollups_insert AFTER INSERT ON readings BEGIN '
+                     'INSERT INTO readings_rollups (device_uuid, type, granularity, bucket, value_count, value_sum, '
+                     'value_min, value_max) SELECT NEW.device_uuid, NEW.type, column1, '
+                     'NEW.date_created - NEW.date_created % column1, 1, NEW.value, NEW.value, NEW.value '
+                     'FROM (VALUES (60), (3600), (86400)) WHERE true '
+                     'ON CONFLICT (device_uuid, type, granularity, bucket) DO UPDATE SET value_count = value_count + 1, '
+                     'value_sum = value_sum + excluded.value_sum, value_min = min(value_min, excluded.value_min), '
+                     'value_max = max(value_max, excluded.value_max); END')
+        conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                         [('device', 'humidity', 10, -3599), ('device', 'humidity', 40, 30)])
+
+        # When it is migrated again and another reading comes in
+        migrate(conn)
+        conn.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                     ('device', 'humidity', 20, -7000))
+
+        # Then the rollups should bucket them the way the read paths do
+        aggregate = window_aggregate(conn.cursor(), 'device', 'humidity', rollup_plan(-7200, -1))
+        self.assertEqual((aggregate['count'], aggregate['max']), (2, 20))
+        aggregate = window_aggregate(conn.cursor(), 'device', 'humidity', rollup_plan(0, 3599))
+        self.assertEqual((aggregate['count'], aggregate['max']), (1, 40))
+
+    def test_histograms_rebinned_on_trigger_upgrade(self):
+        # Given a database migrated while the trigger copied raw values
+        conn = sqlite3.connect(':memory:')
+        migrate(conn)
+        conn.execute('DROP TRIGGER readings_histograms_insert')
+        conn.execute('CREATE TRIGGER readings_histograms_insert AFTER INSERT ON readings BEGIN '
+                     'INSERT INTO readings_histograms (device_uuid, type, bucket, value, value_count) '
+                     'VALUES (NEW.device_uuid, NEW.type, NEW.date_created - NEW.date_created % 3600, NEW.value, 1) '
+                     'ON CONFLICT (device_uuid, type, bucket, value) DO UPDATE SET value_count = value_count + 1; END')
+        conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                         [('device', 'humidity', value, 1635292800) for value in (22, 22.4, 101.5)])
+
+        # When it is migrated again
+        migrate(conn)
+
+        # Then the legacy rows should be merged into their bins and new rows binned
+        conn.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                     ('device', 'humidity', 21.9, 1635292800))
+        self.assertEqual(conn.execute('select value, value_count from readings_histograms order by value').fetchall(),
+                         [(22, 3), (100, 1)])
+
+    def test_histograms_of_dates_before_the_epoch(self):
+        # Given readings dated before the epoch in a database migrated with truncating buckets
+        conn = sqlite3.connect(':memory:')
+        migrate(conn)
+        conn.execute('DROP TRIGGER readings_histograms_insert')
+        conn.execute('CREATE TRIGGER readings_histograms_insert AFTER INSERT ON readings BEGIN '
+                     'INSERT INTO readings_histograms (device_uuid, type, bucket, value, value_count) '
+                     'VALUES (NEW.device_uuid, NEW.type, NEW.date_created - NEW.date_created % 3600, '
+                     'max(0, min(100, CAST(round(NEW.value) AS INTEGER))), 1) '
+                     'ON CONFLICT (device_uuid, type, bucket, value) DO UPDATE SET value_count = value_count + 1; END')
+        conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                         [('device', 'humidity', 10, -3599), ('device', 'humidity', 40, 30)])
+
+        # When it is migrated again and another reading comes in
+        migrate(conn)
+        conn.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                     ('device', 'humidity', 20, -7000))
+
+        # Then the histograms should bucket them the way the read paths do
+        self.assertEqual(window_histogram(conn.cursor(), 'device', 'humidity', -7200, -1).sum(), 2)
+        self.assertEqual(window_histogram(conn.cursor(), 'device', 'humidity', 0, 3599).sum(), 1)
+
+
+class HistogramWindowTestCases(unittest.TestCase):
+
+    def setUp(self):
+        # Setup a migrated in-memory DB with two devices over a few days
+        self.conn = sqlite3.connect(':memory:')
+        migrate(self.conn)
+        rng = np.random.default_rng(11)
+        self.devices = np.array(['device_a', 'device_b'])[rng.integers(0, 2, 4000)]
+        self.dates = rng.integers(1635292800, 1635292800 + 3 * 86400, 4000)
+        self.values = rng.integers(0, 101, 4000)
+        self.conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                              [(device, 'humidity', value, date) for device, value, date
+                               in zip(self.devices.tolist(), self.values.tolist(), self.dates.tolist())])
+
+    def test_histogram_window(self):
+        # Given a window with ragged edges on both ends
+        conditions, params, edges = histogram_window(1635292800 + 10, 1635292800 + 7300)
+
+        # Then it should select the whole hour buckets and read the edges raw
+        self.assertEqual(conditions, ['bucket >= ?', 'bucket < ?'])
+        self.assertEqual(params, [1635292800 + 3600, 1635292800 + 7200])
+        self.assertEqual(edges, [(1635292800 + 10, 1635292800 + 3599), (1635292800 + 7200, 1635292800 + 7300)])
+
+        # And a window without bounds should use every bucket
+        self.assertEqual(histogram_window(None, None), ([], [], []))
+
+    def test_window_histogram_matches_raw(self):
+        cur = self.conn.cursor()
+        windows = [(None, None), (1635292800 + 17, None), (None, 1635292800 + 86400 + 5), (1635292800 + 61,
+                   1635292800 + 2 * 86400 + 4000), (1635292800 + 5, 1635292800 + 50)]
+        for start, end in windows:
+            # Given the histogram of a window
+            counts = window_histogram(cur, 'device_a', 'humidity', start, end)
+
+            # Then it should count exactly the raw readings of the window
+            in_window = (self.devices == 'device_a') & (self.dates >= (start or 0)) & (self.dates <= (end or 2 ** 40))
+            self.assertEqual(counts.tolist(), np.bincount(self.values[in_window], minlength=101).tolist())
+
+    def test_fleet_histograms_match_raw(self):
+        # Given the histograms of every device over a window
+        start, end = 1635292800 + 1000, 1635292800 + 86400
+        device_uuids, histograms = fleet_histograms(self.conn.cursor(), 'humidity', start, end)
+
+        # Then each one should count the raw readings of its device
+        self.assertEqual(device_uuids.tolist(), ['device_a', 'device_b'])
+        for device, counts in zip(device_uuids, histograms):
+            in_window = (self.devices == device) & (self.dates >= start) & (self.dates <= end)
+            self.assertEqual(counts.tolist(), np.bincount(self.values[in_window], minlength=101).tolist())
+
+        # And another type should have no devices
+        self.assertEqual(len(fleet_histograms(self.conn.cursor(), 'temperature', None, None)[0]), 0)
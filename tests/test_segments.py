@@ -0,0 +1,117 @@
+import json
+import os
+import shutil
+import sqlite3
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from app import app
+from db import drop_tables, migrate
+from segments import compact, scan, segments_directory, window_segments
+
+DAY = 86400
+
+
+class SegmentTestCases(unittest.TestCase):
+
+    def setUp(self):
+        shutil.rmtree(segments_directory('test_database.db'), ignore_errors=True)
+        self.conn = sqlite3.connect('test_database.db')
+        drop_tables(self.conn)
+        migrate(self.conn)
+        # Three days of readings of two devices, dated off the hour and minute
+        rng = np.random.default_rng(13)
+        self.rows = [(device, sensor_type, int(rng.integers(0, 101)), 1635292800 + int(date))
+                     for device in ('device_a', 'device_b') for sensor_type in ('temperature', 'humidity')
+                     for date in rng.integers(0, 3 * DAY, 50)]
+        self.conn.executemany('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                              self.rows)
+        self.conn.commit()
+        app.config['TESTING'] = True
+        self.client = app.test_client
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(segments_directory('test_database.db'), ignore_errors=True)
+
+    def test_compact_into_segments(self):
+        # When the first two days are compacted
+        moved = compact(self.conn, 1635292800 + 2 * DAY)
+
+        # Then their readings should be moved to one mapped segment per day
+        remaining = self.conn.execute('select count(*) from readings').fetchone()[0]
+        self.assertEqual(moved + remaining, len(self.rows))
+        self.assertEqual(self.conn.execute('select count(*) from readings where date_created < ?',
+                                           (1635292800 + 2 * DAY,)).fetchone()[0], 0)
+        segments = window_segments(self.conn.cursor(), None, None)
+        self.assertEqual(len(segments), 2)
+        self.assertIsInstance(segments[0].columns['dates'], np.memmap)
+        self.assertEqual(len(os.listdir(segments_directory('test_database.db'))), 2)
+
+        # And scans should skip the segments whose zone maps exclude the window
+        self.assertEqual(len(window_segments(self.conn.cursor(), 1635292800 + DAY + DAY // 2, 1635292800 + DAY + DAY // 2 + 10)), 1)
+        dates, values, types, _ = scan(self.conn.cursor(), 'device_a', 'humidity', None, None)
+        expected = sorted((date, value) for device, sensor_type, value, date in self.rows
+                          if device == 'device_a' and sensor_type == 'humidity' and date < 1635292800 + 2 * DAY)
+        self.assertEqual(list(zip(dates.tolist(), values.tolist())), expected)
+        self.assertEqual(set(types.tolist()), {'humidity'})
+
+    def test_compact_a_day_per_transaction(self):
+        # Given a trace of the statements of the connection
+        statements = []
+        self.conn.set_trace_callback(statements.append)
+
+        # When the first two days are compacted, reading a few rows at a time
+        with mock.patch('segments.COMPACT_FETCH_ROWS', 7):
+            moved = compact(self.conn, 1635292800 + 2 * DAY)
+
+        # Then every reading of those days should be moved, one day per transaction
+        self.assertEqual(moved, sum(1 for row in self.rows if row[3] < 1635292800 + 2 * DAY))
+        self.assertEqual(statements.count('BEGIN IMMEDIATE'), 2)
+        segments = window_segments(self.conn.cursor(), None, None)
+        self.assertEqual([segment.columns['dates'].min() // DAY for segment in segments],
+                         [1635292800 // DAY, 1635292800 // DAY + 1])
+
+    def test_routes_union_segments(self):
+        # Given the responses of every route before compaction
+        start = 1635292800 + DAY // 2 + 17
+        end = 1635292800 + 2 * DAY + DAY // 3 + 5
+        urls = ['/devices/device_a/readings/', '/devices/device_a/readings/?type=humidity&start={}&end={}'
+                .format(start, end), '/devices/device_b/readings/?limit=30',
+                '/devices/summary/', '/devices/summary/?type=temperature&start={}&end={}'.format(start, end),
+                '/devices/device_b/readings/series/?type=temperature&interval=3600',
+                '/devices/device_b/readings/?type=temperature&max_points=20',
+                '/devices/fleet/?type=temperature&by=mean', '/devices/fleet/?type=humidity&above=10&start={}&end={}'
+                .format(start, end),
+                '/devices/device_b/readings/series/?type=temperature&interval=7000&start={}&end={}'.format(start, end)]
+        for metric in ('max', 'min', 'mean', 'median', 'mode', 'quartiles'):
+            urls.append('/devices/device_b/readings/{}/?type=temperature&start={}&end={}'.format(metric, start, end))
+            urls.append('/devices/device_b/readings/{}/?type=temperature&start={}&end={}'
+                        .format(metric, start, start + 600))
+            if metric != 'quartiles':
+                urls.append('/devices/device_b/readings/{}/?type=temperature'.format(metric))
+        before = []
+        for url in urls:
+            request = self.client().get(url)
+            before.append((request.data, request.headers.get('X-Next-Cursor')))
+        query = json.dumps({'device_uuids': ['device_a', 'device_b'], 'start': start, 'end': end, 'stats': True})
+        query_before = self.client().post('/devices/readings/query', data=query).data
+
+        # When the first two days are compacted
+        compact(self.conn, 1635292800 + 2 * DAY)
+
+        # Then every route should answer the same from the db and segments together
+        for url, (expected, cursor) in zip(urls, before):
+            request = self.client().get(url)
+            self.assertEqual(request.status_code, 200, url)
+            self.assertEqual(request.data, expected, url)
+            self.assertEqual(request.headers.get('X-Next-Cursor'), cursor, url)
+        self.assertEqual(self.client().post('/devices/readings/query', data=query).data, query_before)
+
+        # And pages should follow on across the two
+        request = self.client().get('/devices/device_b/readings/?limit=30&after=' + before[2][1])
+        self.assertEqual([(r['date_created'], r['type']) for r in json.loads(request.data)],
+                         sorted((date, sensor_type) for device, sensor_type, _, date in self.rows
+                                if device == 'device_b')[30:60])
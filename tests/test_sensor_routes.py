@@ -1,19 +1,22 @@
 import json
 import pytest
 import sqlite3
+import struct
 import time
 import unittest
 import requests
+from unittest import mock
 
 from app import app
+from db import drop_tables, migrate
 
 class SensorRoutesTestCases(unittest.TestCase):
 
     def setUp(self):
         # Setup the SQLite DB
         conn = sqlite3.connect('test_database.db')
-        conn.execute('DROP TABLE IF EXISTS readings')
-        conn.execute('CREATE TABLE IF NOT EXISTS readings (device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)')
+        drop_tables(conn)
+        migrate(conn)
         
         self.device_uuid = 'test_device'
         self.temperature_device_uuid = 'test_device_temperature'
@@ -329,4 +332,470 @@ class SensorRoutesTestCases(unittest.TestCase):
         # And its quartile 1 value is
         self.assertEqual(device_with_most_readings['quartile_1_value'], 30.25)
         # And its quartile 3 value is
-        self.assertEqual(device_with_most_readings['quartile_3_value'], 55)
\ No newline at end of file
+        self.assertEqual(device_with_most_readings['quartile_3_value'], 55)
+
+    def test_device_readings_post_batch(self):
+        # Given a device UUID
+        # When we make a request with a JSON array of readings, one of them invalid
+        request = self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=
+            json.dumps([
+                {'type': 'temperature', 'value': 10, 'date_created': 1635335102},
+                {'type': 'humidity', 'value': 101},
+                {'type': 'abcdef', 'value': 10},
+                {'type': 'humidity', 'value': 30}
+            ]))
+
+        # Then we should receive a 201
+        self.assertEqual(request.status_code, 201)
+
+        # And every item should have its own result
+        data = json.loads(request.data)
+        self.assertEqual(data['accepted'], 2)
+        self.assertEqual(data['rejected'], 2)
+        self.assertEqual([result['status'] for result in data['results']],
+                         ['accepted', 'rejected', 'rejected', 'accepted'])
+        self.assertEqual(data['results'][1]['error'], 'invalid value')
+        self.assertEqual(data['results'][2]['error'], 'invalid type')
+
+        # And only the valid readings should be in the db
+        conn = sqlite3.connect('test_database.db')
+        cur = conn.cursor()
+        cur.execute('select count(*) from readings where device_uuid=?', (self.device_uuid,))
+        self.assertEqual(cur.fetchone()[0], 5)
+
+    def test_out_of_range_date_is_rejected(self):
+        for date_created in (-1, 2 ** 63):
+            # When we post a reading dated before the epoch or past SQLite's int64
+            request = self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=json.dumps(
+                {'type': 'temperature', 'value': 10, 'date_created': date_created}))
+
+            # Then we should receive a 400
+            self.assertEqual(request.status_code, 400)
+
+            # And within a batch only that item should be rejected
+            request = self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=json.dumps(
+                [{'type': 'temperature', 'value': 10, 'date_created': date_created},
+                 {'type': 'temperature', 'value': 10, 'date_created': 2 ** 63 - 1}]))
+            self.assertEqual(request.status_code, 201)
+            self.assertEqual(json.loads(request.data)['results'][0],
+                             {'index': 0, 'status': 'rejected', 'error': 'invalid date_created'})
+
+    def test_device_readings_post_ndjson(self):
+        # Given a device UUID
+        # When we make a request with an NDJSON body containing a broken line
+        body = '\n'.join([
+            json.dumps({'type': 'temperature', 'value': 10}),
+            '{not json',
+            json.dumps({'type': 'humidity', 'value': 20})
+        ])
+        request = self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=body,
+                                     content_type='application/x-ndjson')
+
+        # Then we should receive a 201 with the broken line rejected
+        self.assertEqual(request.status_code, 201)
+        data = json.loads(request.data)
+        self.assertEqual(data['accepted'], 2)
+        self.assertEqual(data['results'][1], {'index': 1, 'status': 'rejected', 'error': 'invalid reading'})
+
+        # When the whole batch is invalid
+        request = self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=
+            json.dumps([{'type': 'temperature', 'value': 10.5}]))
+
+        # Then we should receive a 400
+        self.assertEqual(request.status_code, 400)
+
+    def test_bulk_readings_post(self):
+        # Given an NDJSON body with readings for several devices
+        body = '\n'.join([
+            json.dumps({'device_uuid': self.device_uuid, 'type': 'temperature', 'value': 10}),
+            json.dumps({'device_uuid': 'bulk_device', 'type': 'humidity', 'value': 20,
+                        'date_created': 1635335102}),
+            json.dumps({'type': 'humidity', 'value': 20}),
+            json.dumps({'device_uuid': 'bulk_device', 'type': 'humidity', 'value': 200}),
+            '{not json'
+        ])
+
+        # When we post it to the bulk endpoint
+        request = self.client().post('/readings/bulk', data=body, content_type='application/x-ndjson')
+
+        # Then we should receive a 201
+        self.assertEqual(request.status_code, 201)
+
+        # And the response should report the accepted and rejected lines
+        data = json.loads(request.data)
+        self.assertEqual(data['accepted'], 2)
+        self.assertEqual(data['rejected'], 3)
+        self.assertEqual(data['errors'], [
+            {'line': 3, 'error': 'invalid device_uuid'},
+            {'line': 4, 'error': 'invalid value'},
+            {'line': 5, 'error': 'invalid reading'}
+        ])
+        self.assertTrue(data['readings_per_second'] > 0)
+
+        # And each reading should be stored against its own device
+        conn = sqlite3.connect('test_database.db')
+        cur = conn.cursor()
+        cur.execute('select count(*) from readings where device_uuid=?', ('bulk_device',))
+        self.assertEqual(cur.fetchone()[0], 1)
+        cur.execute('select count(*) from readings where device_uuid=?', (self.device_uuid,))
+        self.assertEqual(cur.fetchone()[0], 4)
+
+    def test_bulk_readings_failed_chunk(self):
+        # Given an NDJSON body whose last chunk holds a reading that passes validation but cannot be inserted
+        body = '\n'.join(json.dumps({'device_uuid': 'bulk_device', 'type': 'humidity', 'value': 20,
+                                      'date_created': date_created})
+                          for date_created in (1635335100, 1635335101, 1635335102, 2 ** 63))
+
+        # When we post it to the bulk endpoint in chunks of 2
+        with mock.patch('app.BULK_CHUNK_SIZE', 2), mock.patch('ingest.MAX_DATE', 2 ** 64):
+            request = self.client().post('/readings/bulk', data=body, content_type='application/x-ndjson')
+
+        # Then the earlier chunk should be committed and the failed one reported line by line
+        self.assertEqual(request.status_code, 201)
+        data = json.loads(request.data)
+        self.assertEqual((data['accepted'], data['rejected']), (2, 2))
+        self.assertEqual(data['errors'], [{'line': 3, 'error': 'insert failed'}, {'line': 4, 'error': 'insert failed'}])
+        conn = sqlite3.connect('test_database.db')
+        cur = conn.cursor()
+        cur.execute('select count(*) from readings where device_uuid=?', ('bulk_device',))
+        self.assertEqual(cur.fetchone()[0], 2)
+
+    def test_device_readings_metrics_empty_window(self):
+        # Given a date range without readings for the device
+        for metric in ('max', 'min'):
+            # When we ask for the max or min
+            request = self.client().get('/devices/{}/readings/{}/?type={}&start={}&end={}'.format(
+                self.date_range_device_uuid, metric, 'temperature', 1, 2))
+
+            # Then we should receive an empty list
+            self.assertEqual(request.status_code, 200)
+            self.assertEqual(json.loads(request.data), [])
+
+        for metric in ('mean', 'mode'):
+            # When we ask for the mean or mode
+            request = self.client().get('/devices/{}/readings/{}/?type={}&start={}&end={}'.format(
+                self.date_range_device_uuid, metric, 'temperature', 1, 2))
+
+            # Then we should be told there are no records
+            self.assertEqual(request.status_code, 200)
+            self.assertEqual(request.data, b'No records found')
+
+    def test_device_readings_metrics_from_rollups(self):
+        # Given a window covering whole minutes of the date range device readings
+        start, end = 1635335040, 1635335159
+
+        # When we ask for the max, min and mean
+        max_request = self.client().get('/devices/{}/readings/max/?type={}&start={}&end={}'.format(
+            self.date_range_device_uuid, 'temperature', start, end))
+        min_request = self.client().get('/devices/{}/readings/min/?type={}&start={}&end={}'.format(
+            self.date_range_device_uuid, 'temperature', start, end))
+        mean_request = self.client().get('/devices/{}/readings/mean/?type={}&start={}&end={}'.format(
+            self.date_range_device_uuid, 'temperature', start, end))
+
+        # Then they should match the raw readings
+        self.assertEqual(json.loads(max_request.data), [{'device_uuid': self.date_range_device_uuid,
+            'type': 'temperature', 'value': 55, 'date_created': 1635335120}])
+        self.assertEqual(json.loads(min_request.data), [{'device_uuid': self.date_range_device_uuid,
+            'type': 'temperature', 'value': 4, 'date_created': 1635335102}])
+        self.assertEqual(json.loads(mean_request.data)['value'], 27)
+
+    def test_device_readings_get_paginated(self):
+        # Given a device UUID
+        # When we ask for the first page of two readings
+        request = self.client().get('/devices/{}/readings/?limit={}'.format(self.mode_device_uuid, 2))
+
+        # Then we should receive a 200 with two readings and a cursor for the next page
+        self.assertEqual(request.status_code, 200)
+        readings = json.loads(request.data)
+        self.assertEqual(len(readings), 2)
+        cursor = request.headers['X-Next-Cursor']
+        self.assertIn('after=' + cursor.replace(':', '%3A'), request.headers['Link'])
+
+        # When we follow the cursors to the end
+        while cursor is not None:
+            request = self.client().get('/devices/{}/readings/?limit={}&after={}'.format(
+                self.mode_device_uuid, 2, cursor))
+            self.assertEqual(request.status_code, 200)
+            readings += json.loads(request.data)
+            cursor = request.headers.get('X-Next-Cursor')
+
+        # Then we should have seen every reading once, ordered by date
+        self.assertEqual(len(readings), 6)
+        dates = [reading['date_created'] for reading in readings]
+        self.assertEqual(dates, sorted(dates))
+        self.assertEqual(sorted(reading['value'] for reading in readings), [22, 22, 55, 55, 55, 100])
+
+        # And a bad limit or cursor should be rejected
+        self.assertEqual(self.client().get('/devices/{}/readings/?limit=0'.format(self.device_uuid)).status_code, 400)
+        self.assertEqual(self.client().get('/devices/{}/readings/?after=abc'.format(self.device_uuid)).status_code,
+                         400)
+
+    def test_device_readings_get_ndjson(self):
+        # Given a device UUID
+        # When we ask for its readings as NDJSON
+        request = self.client().get('/devices/{}/readings/?type={}'.format(self.temperature_device_uuid, 'temperature'),
+                                    headers={'Accept': 'application/x-ndjson'})
+
+        # Then we should receive one reading per line
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(request.mimetype, 'application/x-ndjson')
+        lines = request.data.decode().splitlines()
+        self.assertEqual([json.loads(line)['value'] for line in lines], [22, 50])
+
+    def test_device_readings_get_columns(self):
+        # Given a device UUID
+        url = '/devices/{}/readings/?type={}'.format(self.temperature_device_uuid, 'temperature')
+
+        # When we ask for its readings as columnar JSON
+        request = self.client().get(url, headers={'Accept': 'application/vnd.sensor.columns+json'})
+
+        # Then we should receive one list per field
+        self.assertEqual(request.status_code, 200)
+        columns = json.loads(request.data)
+        self.assertEqual(list(columns), ['device_uuid', 'type', 'value', 'date_created'])
+        self.assertEqual(columns['value'], [22, 50])
+        self.assertEqual(columns['type'], ['temperature', 'temperature'])
+
+        # And as CSV we should receive a header line and one line per reading
+        request = self.client().get(url, headers={'Accept': 'text/csv'})
+        self.assertEqual(request.mimetype, 'text/csv')
+        lines = request.data.decode().splitlines()
+        self.assertEqual(lines[0], 'device_uuid,type,value,date_created')
+        self.assertEqual([line.split(',')[2] for line in lines[1:]], ['22', '50'])
+
+    def test_device_readings_get_binary(self):
+        # Given a device UUID
+        # When we ask for its readings in the binary format
+        request = self.client().get('/devices/{}/readings/?type={}'.format(self.temperature_device_uuid,
+                                                                            'temperature'),
+                                    headers={'Accept': 'application/vnd.sensor.columns'})
+        self.assertEqual(request.status_code, 200)
+        data = request.data
+
+        # Then the header should name the columns
+        self.assertEqual(data[:5], b'SNSR\x01')
+        offset = 5
+
+        def strings():
+            nonlocal offset
+            count, = struct.unpack_from('<I', data, offset)
+            offset += 4
+            result = []
+            for _ in range(count):
+                length, = struct.unpack_from('<H', data, offset)
+                result.append(data[offset + 2:offset + 2 + length].decode())
+                offset += 2 + length
+            return result
+
+        names = strings()
+        self.assertEqual(names, ['device_uuid', 'type', 'value', 'date_created'])
+
+        # And the frames should decode to the readings, up to an empty frame
+        columns = {name: [] for name in names}
+        while True:
+            rows, = struct.unpack_from('<I', data, offset)
+            offset += 4
+            if rows == 0:
+                break
+            for name in names:
+                tag = data[offset:offset + 1]
+                offset += 1
+                if tag == b's':
+                    dictionary = strings()
+                    codes = struct.unpack_from('<{}I'.format(rows), data, offset)
+                    offset += 4 * rows
+                    columns[name] += [dictionary[code] for code in codes]
+                else:
+                    columns[name] += struct.unpack_from('<{}{}'.format(rows, 'q' if tag == b'i' else 'd'), data,
+                                                        offset)
+                    offset += 8 * rows
+        self.assertEqual(offset, len(data))
+        self.assertEqual(columns['device_uuid'], [self.temperature_device_uuid] * 2)
+        self.assertEqual(columns['value'], [22, 50])
+
+    def test_empty_binary_response(self):
+        # When we ask for the summary of a window without readings in the binary format
+        request = self.client().get('/devices/summary/?start=1&end=2',
+                                    headers={'Accept': 'application/vnd.sensor.columns'})
+        self.assertEqual(request.status_code, 200)
+
+        # Then the header should be followed by the empty frame ending the stream and nothing else
+        names = ['device_uuid', 'number_of_readings', 'max_reading_value', 'median_reading_value',
+                 'mean_reading_value', 'quartile_1_value', 'quartile_3_value']
+        header = 5 + 4 + sum(2 + len(name) for name in names)
+        self.assertEqual(request.data[header:], struct.pack('<I', 0))
+
+    def test_device_summary_columns(self):
+        # Given the summary as a JSON array
+        summary = json.loads(self.client().get('/devices/summary/').data)
+
+        # When we ask for it as columnar JSON
+        request = self.client().get('/devices/summary/', headers={'Accept': 'application/vnd.sensor.columns+json'})
+
+        # Then every column should match the fields of the summaries
+        self.assertEqual(request.status_code, 200)
+        columns = json.loads(request.data)
+        self.assertEqual(columns, {name: [device[name] for device in summary] for name in summary[0]})
+
+    def test_device_readings_get_max_points(self):
+        # Given a device UUID with three temperature readings
+        # When we ask for at most three of them
+        url = '/devices/{}/readings/?type={}&max_points={}'
+        request = self.client().get(url.format(self.device_uuid, 'temperature', 3))
+
+        # Then we should receive all of them
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual([reading['value'] for reading in json.loads(request.data)], [22, 50, 100])
+
+        # And too few points, no type or paging should be rejected
+        for query in ('type=temperature&max_points=2', 'max_points=10', 'type=temperature&max_points=10&limit=5'):
+            request = self.client().get('/devices/{}/readings/?{}'.format(self.device_uuid, query))
+            self.assertEqual(request.status_code, 400)
+
+    def test_device_readings_series(self):
+        # Given a device UUID
+        # When we ask for its temperature in buckets wider than its readings
+        request = self.client().get('/devices/{}/readings/series/?type={}&interval={}&agg={}'.format(
+            self.device_uuid, 'temperature', 10 ** 10, 'mean,count'))
+
+        # Then we should receive a single point
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(json.loads(request.data), [{'date_created': 0, 'mean': 172 / 3, 'count': 3}])
+
+        # And one second buckets should hold one reading each
+        request = self.client().get('/devices/{}/readings/series/?type={}&interval=1&agg=max'.format(
+            self.device_uuid, 'temperature'))
+        self.assertEqual([point['max'] for point in json.loads(request.data)], [22, 50, 100])
+
+        # And a missing interval or an unknown aggregate should be rejected
+        for query in ('type=temperature', 'type=temperature&interval=0', 'type=temperature&interval=60&agg=p99'):
+            request = self.client().get('/devices/{}/readings/series/?{}'.format(self.device_uuid, query))
+            self.assertEqual(request.status_code, 400)
+
+    def test_fleet_top(self):
+        # Given devices with temperature readings
+        # When we ask for the two with the highest temperature
+        request = self.client().get('/devices/fleet/?type=temperature&k=2')
+
+        # Then we should receive them, ties ordered by device UUID
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(json.loads(request.data), [{'device_uuid': self.device_uuid, 'max': 100},
+                                                    {'device_uuid': self.mode_device_uuid, 'max': 100}])
+
+        # And a threshold should return every device above it
+        request = self.client().get('/devices/fleet/?type=temperature&above=50')
+        self.assertEqual([device['device_uuid'] for device in json.loads(request.data)],
+                         [self.device_uuid, self.mode_device_uuid, self.date_range_device_uuid])
+
+        # And devices can be ranked by count or mean over a window
+        request = self.client().get('/devices/fleet/?type=temperature&by=count&k=1')
+        self.assertEqual(json.loads(request.data), [{'device_uuid': self.mode_device_uuid, 'count': 6}])
+        request = self.client().get('/devices/fleet/?type=temperature&by=mean&start=1635335100&end=1635335200')
+        self.assertEqual(json.loads(request.data), [{'device_uuid': self.date_range_device_uuid, 'mean': 27}])
+
+        # And a missing type or an unknown metric should be rejected
+        for query in ('by=max', 'type=temperature&by=median', 'type=temperature&k=0'):
+            self.assertEqual(self.client().get('/devices/fleet/?' + query).status_code, 400)
+
+    def test_devices_readings_query(self):
+        # Given several device UUIDs, one of them without readings
+        devices = [self.device_uuid, self.humidity_device_uuid, 'unknown_device', self.device_uuid]
+
+        # When we read their temperature at once, with stats
+        request = self.client().post('/devices/readings/query', data=json.dumps(
+            {'device_uuids': devices, 'type': 'temperature', 'stats': ['max', 'count']}))
+
+        # Then every device should get the readings of its own GET and its stats
+        self.assertEqual(request.status_code, 200)
+        result = json.loads(request.data)
+        self.assertEqual(sorted(result), sorted(set(devices)))
+        for device_uuid in set(devices):
+            expected = json.loads(self.client().get('/devices/{}/readings/?type=temperature'.format(device_uuid)).data
+                                  ) if device_uuid != 'unknown_device' else []
+            self.assertEqual(result[device_uuid]['readings'], expected)
+        self.assertEqual(result[self.device_uuid]['stats'], {'max': 100, 'count': 3})
+        self.assertEqual(result['unknown_device']['stats'], {'max': None, 'count': 0})
+
+        # And the readings can be left out
+        request = self.client().post('/devices/readings/query', data=json.dumps(
+            {'device_uuids': [self.date_range_device_uuid], 'start': 1635335100, 'end': 1635335115,
+             'stats': True, 'readings': False}))
+        self.assertEqual(json.loads(request.data)[self.date_range_device_uuid]['stats']['count'], 2)
+        self.assertNotIn('readings', json.loads(request.data)[self.date_range_device_uuid])
+
+        # And a malformed body should be rejected
+        for body in ('[]', '{}', '{"device_uuids": []}', '{"device_uuids": ["a"], "stats": ["p99"]}',
+                     '{"device_uuids": ["a"], "start": "soon"}', 'not json'):
+            self.assertEqual(self.client().post('/devices/readings/query', data=body).status_code, 400)
+
+    def test_device_readings_conditional_get(self):
+        for url in ('/devices/{}/readings/'.format(self.device_uuid),
+                    '/devices/{}/readings/max/?type=temperature'.format(self.device_uuid)):
+            # Given the ETag of a device endpoint
+            request = self.client().get(url)
+            self.assertEqual(request.status_code, 200)
+            etag = request.headers['ETag']
+            self.assertIsNotNone(request.headers.get('Last-Modified'))
+
+            # When we poll it with that ETag
+            request = self.client().get(url, headers={'If-None-Match': etag})
+
+            # Then we should receive a 304 without a body
+            self.assertEqual(request.status_code, 304)
+            self.assertEqual(request.data, b'')
+            self.assertEqual(request.headers['ETag'], etag)
+
+            # And once a reading is posted the full response should come back with a new ETag
+            self.client().post('/devices/{}/readings/'.format(self.device_uuid), data=json.dumps(
+                {'type': 'temperature', 'value': 10, 'date_created': 1635335102}))
+            request = self.client().get(url, headers={'If-None-Match': etag})
+            self.assertEqual(request.status_code, 200)
+            self.assertNotEqual(request.headers['ETag'], etag)
+
+    def test_conditional_get_validates_first(self):
+        # Given the current ETag of a device
+        etag = self.client().get('/devices/{}/readings/'.format(self.device_uuid)).headers['ETag']
+
+        for url in ('/devices/{}/readings/max/'.format(self.device_uuid),
+                    '/devices/{}/readings/quartiles/?type=temperature'.format(self.device_uuid),
+                    '/devices/{}/readings/?after=garbage'.format(self.device_uuid),
+                    '/devices/{}/readings/?limit=0'.format(self.device_uuid)):
+            # When a request the endpoint would reject is polled with it
+            request = self.client().get(url, headers={'If-None-Match': etag})
+
+            # Then we should receive a 400 rather than a 304
+            self.assertEqual(request.status_code, 400, url)
+
+    def test_bad_window_is_rejected(self):
+        # Given every route taking a start and end window
+        urls = ['/devices/{}/readings/'.format(self.device_uuid), '/devices/summary/',
+                '/devices/fleet/?type=temperature',
+                '/devices/{}/readings/series/?type=temperature&interval=60'.format(self.device_uuid)]
+        for metric in ('max', 'min', 'mean', 'median', 'mode', 'quartiles', 'stats'):
+            urls.append('/devices/{}/readings/{}/?type=temperature'.format(self.device_uuid, metric))
+        for url in urls:
+            for window in ('start=abc&end=1635335200', 'start=1635335100&end=1.5'):
+                # When the window is not made of integers
+                request = self.client().get(url + ('&' if '?' in url else '?') + window)
+
+                # Then we should receive a 400
+                self.assertEqual(request.status_code, 400, url)
+
+    def test_device_readings_stats(self):
+        # When we ask for several metrics of the date range device at once
+        request = self.client().get('/devices/{}/readings/stats/?type={}&metrics={}'.format(
+            self.date_range_device_uuid, 'temperature', 'max,min,mean,count'))
+
+        # Then they should match the separate endpoints
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(json.loads(request.data), {'max': 55, 'min': 4, 'mean': 27, 'count': 3})
+
+        # And an unknown metric should be rejected
+        request = self.client().get('/devices/{}/readings/stats/?type={}&metrics={}'.format(
+            self.date_range_device_uuid, 'temperature', 'max,p99'))
+        self.assertEqual(request.status_code, 400)
+
+        # And an empty window should only count its readings
+        request = self.client().get('/devices/{}/readings/stats/?type={}&start={}&end={}&metrics={}'.format(
+            self.date_range_device_uuid, 'temperature', 1, 2, 'median,count'))
+        self.assertEqual(json.loads(request.data), {'median': None, 'count': 0})
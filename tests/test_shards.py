@@ -0,0 +1,114 @@
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+from io import StringIO
+
+from app import app
+from db import get_pool, shard_index, shard_paths
+from segments import main as compact_main
+from shards import reshard
+
+
+class ShardRoutingTestCases(unittest.TestCase):
+
+    def test_shard_index_is_stable(self):
+        # Given a few devices
+        devices = ['device_{}'.format(i) for i in range(100)]
+
+        # Then they should always land in the same shard, spread over all of them
+        self.assertEqual([shard_index(device, 4) for device in devices], [shard_index(device, 4) for device in devices])
+        self.assertEqual({shard_index(device, 4) for device in devices}, {0, 1, 2, 3})
+        self.assertEqual(shard_paths('database.db', 1), ['database.db'])
+        self.assertEqual(shard_paths('database.db', 2), ['database.shard-0-of-2.db', 'database.shard-1-of-2.db'])
+
+
+class ShardedRouteTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'sharded.db')
+        app.config['TESTING'] = True
+        app.config['TEST_DATABASE'] = self.path
+        app.config['SHARDS'] = 2
+        self.client = app.test_client
+
+    def tearDown(self):
+        app.config['TEST_DATABASE'] = 'test_database.db'
+        app.config['SHARDS'] = 1
+        for path in [self.path] + shard_paths(self.path, 2) + shard_paths(self.path, 3):
+            get_pool(path).close()
+        shutil.rmtree(self.directory)
+
+    def count_readings(self, path):
+        conn = sqlite3.connect(path)
+        try:
+            return conn.execute('select count(*) from readings').fetchone()[0]
+        finally:
+            conn.close()
+
+    def test_compact_every_shard(self):
+        # Given old readings posted for devices of both shards
+        devices = ['device_{}'.format(i) for i in range(6)]
+        for device in devices:
+            self.client().post('/devices/{}/readings/'.format(device), data=json.dumps(
+                {'type': 'temperature', 'value': 10, 'date_created': 1635335100}))
+
+        # When the compaction script is run for the sharded database
+        with redirect_stdout(StringIO()):
+            compact_main(['--database', self.path, '--shards', '2', '--older-than', '0'])
+
+        # Then every shard should have its readings moved into segments
+        for path in shard_paths(self.path, 2):
+            self.assertEqual(self.count_readings(path), 0)
+            self.assertTrue(os.listdir(path + '.segments'))
+
+    def test_routes_and_summary_fan_out(self):
+        # Given readings posted for devices of both shards
+        devices = ['device_{}'.format(i) for i in range(6)]
+        self.assertEqual({shard_index(device, 2) for device in devices}, {0, 1})
+        for i, device in enumerate(devices):
+            request = self.client().post('/devices/{}/readings/'.format(device), data=json.dumps(
+                [{'type': 'temperature', 'value': value, 'date_created': 1635335100 + value} for value in range(i + 1)]))
+            self.assertEqual(request.status_code, 201)
+        request = self.client().post('/readings/bulk', data=''.join(json.dumps(
+            {'device_uuid': device, 'type': 'temperature', 'value': 50, 'date_created': 1635335200}) + '\n'
+            for device in devices))
+        self.assertEqual(request.status_code, 201)
+
+        # Then each device should live in exactly one shard
+        paths = shard_paths(self.path, 2)
+        self.assertEqual(sum(self.count_readings(path) for path in paths), 21 + 6)
+        for path in paths:
+            self.assertEqual(self.count_readings(path), sum(i + 2 for i, device in enumerate(devices)
+                                                            if paths[shard_index(device, 2)] == path))
+
+        # And per-device routes should read their shard
+        request = self.client().get('/devices/device_3/readings/max/?type=temperature')
+        self.assertEqual(json.loads(request.data)[0]['value'], 50)
+
+        # And the summary should merge every shard
+        summary = json.loads(self.client().get('/devices/summary/').data)
+        self.assertEqual([(s['device_uuid'], s['number_of_readings']) for s in summary],
+                         [('device_{}'.format(i), i + 2) for i in reversed(range(6))])
+
+        # And the fleet ranking should merge every shard
+        request = self.client().get('/devices/fleet/?type=temperature&by=count&k=3')
+        self.assertEqual(json.loads(request.data), [{'device_uuid': 'device_{}'.format(i), 'count': i + 2}
+                                                    for i in (5, 4, 3)])
+
+        # And a multi-device read should reach every shard
+        request = self.client().post('/devices/readings/query', data=json.dumps(
+            {'device_uuids': devices, 'stats': ['count'], 'readings': False}))
+        self.assertEqual(json.loads(request.data), {device: {'stats': {'count': i + 2}}
+                                                    for i, device in enumerate(devices)})
+
+        # When the readings are resharded to three shards
+        self.assertEqual(reshard(self.path, 2, 3), 27)
+
+        # Then the summary over the new shards should be the same
+        app.config['SHARDS'] = 3
+        self.assertEqual(json.loads(self.client().get('/devices/summary/').data), summary)
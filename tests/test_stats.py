@@ -0,0 +1,148 @@
+import unittest
+
+import numpy as np
+
+from stats import (HISTOGRAM_BINS, SUMMARY_COLUMNS, bucket_series, histogram_mode, histogram_quantile, histogram_stats,
+                   lttb, summary_columns)
+
+
+class HistogramTestCases(unittest.TestCase):
+
+    def test_histogram_stats_match_numpy(self):
+        # Given random readings and their value histogram
+        values = np.random.default_rng(15).integers(0, HISTOGRAM_BINS, 500)
+        stats = histogram_stats(np.bincount(values, minlength=HISTOGRAM_BINS))
+
+        # Then every metric should match NumPy over the raw values
+        self.assertEqual((stats['max'], stats['min'], stats['count']), (values.max(), values.min(), len(values)))
+        self.assertEqual(stats['mode'], np.argmax(np.bincount(values)))
+        self.assertAlmostEqual(stats['mean'], values.mean())
+        self.assertAlmostEqual(stats['stddev'], values.std())
+        for metric, q in (('q1', .25), ('median', .5), ('q3', .75)):
+            self.assertAlmostEqual(stats[metric], np.quantile(values, q))
+
+        # And only the metrics asked for should be returned
+        self.assertEqual(list(histogram_stats(np.bincount(values), ['count', 'max'])), ['count', 'max'])
+
+    def test_histogram_quantile_matches_numpy(self):
+        rng = np.random.default_rng(5)
+        for size in (1, 2, 3, 10, 1001):
+            # Given random readings and their value histogram
+            values = rng.integers(0, HISTOGRAM_BINS, size)
+            counts = np.bincount(values, minlength=HISTOGRAM_BINS)
+
+            # Then its quantiles should match np.quantile over the raw values
+            for q in (0, .25, .5, .75, 1):
+                self.assertAlmostEqual(histogram_quantile(counts, q).item(), np.quantile(values, q))
+
+    def test_histogram_mode(self):
+        # Given readings with a clear mode and a tie
+        self.assertEqual(histogram_mode(np.bincount([22, 22, 55, 55, 55, 100], minlength=HISTOGRAM_BINS)), 55)
+
+        # Then ties should go to the smallest value
+        self.assertEqual(histogram_mode(np.bincount([40, 30, 30, 40, 10], minlength=HISTOGRAM_BINS)), 30)
+
+
+class SummaryEngineTestCases(unittest.TestCase):
+
+    def test_summary_matches_per_device_numpy(self):
+        # Given random readings for many devices and their value histograms
+        rng = np.random.default_rng(7)
+        devices = np.array(['device_{}'.format(i) for i in rng.integers(0, 50, 5000)])
+        values = rng.integers(0, HISTOGRAM_BINS, 5000)
+        device_uuids, codes = np.unique(devices, return_inverse=True)
+        histograms = np.zeros((len(device_uuids), HISTOGRAM_BINS), dtype=np.int64)
+        np.add.at(histograms, (codes, values), 1)
+
+        # When we summarize them in one go
+        columns = dict(zip(SUMMARY_COLUMNS, summary_columns(device_uuids, histograms)))
+
+        # Then every device should match its own numpy statistics
+        self.assertEqual(len(columns['device_uuid']), len(device_uuids))
+        for i, device_uuid in enumerate(columns['device_uuid']):
+            device_values = values[devices == device_uuid]
+            self.assertEqual(columns['number_of_readings'][i], len(device_values))
+            self.assertEqual(columns['max_reading_value'][i], device_values.max())
+            self.assertAlmostEqual(columns['mean_reading_value'][i], device_values.mean())
+            self.assertAlmostEqual(columns['median_reading_value'][i], np.quantile(device_values, .5))
+            self.assertAlmostEqual(columns['quartile_1_value'][i], np.quantile(device_values, .25))
+            self.assertAlmostEqual(columns['quartile_3_value'][i], np.quantile(device_values, .75))
+
+        # And the devices should be sorted by number of readings
+        counts = columns['number_of_readings'].tolist()
+        self.assertEqual(counts, sorted(counts, reverse=True))
+
+    def test_summary_of_single_readings_and_no_readings(self):
+        # Given a device with a single reading and one without readings
+        histograms = np.zeros((2, HISTOGRAM_BINS), dtype=np.int64)
+        histograms[0, 42] = 1
+        columns = summary_columns(['device', 'empty_device'], histograms)
+
+        # Then every statistic should be that reading and the empty device left out
+        self.assertEqual(dict(zip(SUMMARY_COLUMNS, (column.tolist() for column in columns))), {
+            'device_uuid': ['device'],
+            'number_of_readings': [1],
+            'max_reading_value': [42],
+            'median_reading_value': [42],
+            'mean_reading_value': [42],
+            'quartile_1_value': [42],
+            'quartile_3_value': [42]
+        })
+
+        # And no devices should give empty columns
+        columns = summary_columns([], np.zeros((0, HISTOGRAM_BINS)))
+        self.assertEqual(len(columns), len(SUMMARY_COLUMNS))
+        self.assertTrue(all(len(column) == 0 for column in columns))
+
+
+class SeriesTestCases(unittest.TestCase):
+
+    def test_bucket_series_match_numpy(self):
+        # Given random readings sorted by date
+        rng = np.random.default_rng(21)
+        dates = np.sort(rng.integers(0, 10000, 300))
+        values = rng.integers(0, HISTOGRAM_BINS, 300)
+
+        # When they are bucketed by 600 seconds
+        starts, means, minimums, maximums, counts = bucket_series(dates, values, 600)
+
+        # Then every non-empty bucket should match NumPy over its readings
+        expected = sorted(set((dates // 600 * 600).tolist()))
+        self.assertEqual(starts.tolist(), expected)
+        for i, start in enumerate(expected):
+            bucket = values[(dates >= start) & (dates < start + 600)]
+            self.assertAlmostEqual(means[i], bucket.mean())
+            self.assertEqual((minimums[i], maximums[i], counts[i]), (bucket.min(), bucket.max(), len(bucket)))
+
+    def test_bucket_series_empty(self):
+        # Given no readings, then there should be no points for any aggregate
+        columns = bucket_series([], [], 60, ['count', 'mean'])
+        self.assertEqual([len(column) for column in columns], [0, 0, 0])
+
+    def test_lttb_matches_reference(self):
+        # Given a random walk of readings at random dates
+        rng = np.random.default_rng(22)
+        dates = 1600000000 + np.sort(rng.choice(10 ** 6, 1000, replace=False))
+        values = np.clip(np.cumsum(rng.integers(-3, 4, 1000)) + 50, 0, 100)
+
+        # When it is downsampled to 50 points
+        kept = lttb(dates, values, 50)
+
+        # Then the kept readings should match a plain implementation of LTTB
+        every = (len(dates) - 2) / 48
+        expected = [0]
+        for bucket in range(48):
+            low, high = int(bucket * every) + 1, int((bucket + 1) * every) + 1
+            following = slice(high, min(int((bucket + 2) * every) + 1, len(dates) - 1)) if bucket < 47 \
+                else slice(len(dates) - 1, len(dates))
+            mean_x, mean_y = dates[following].mean(), values[following].mean()
+            a = expected[-1]
+            areas = [abs((dates[a] - mean_x) * (values[i] - values[a]) - (dates[a] - dates[i]) * (mean_y - values[a]))
+                     for i in range(low, high)]
+            expected.append(low + int(np.argmax(areas)))
+        expected.append(len(dates) - 1)
+        self.assertEqual(kept.tolist(), expected)
+
+    def test_lttb_keeps_short_series(self):
+        # Given fewer readings than points, then every reading should be kept
+        self.assertEqual(lttb(np.arange(5), np.arange(5), 10).tolist(), [0, 1, 2, 3, 4])